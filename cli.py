@@ -2,20 +2,29 @@
 AppAgent - Chat-First Interactive CLI
 """
 import sys
+import functools
 import json
 import os
+import queue
 import threading
 import time
 from pathlib import Path
 from datetime import datetime
+from typing import TYPE_CHECKING, Callable, Dict
 
 sys.path.insert(0, str(Path(__file__).resolve().parent))
 
-import yaml
+try:
+    import orjson  # type: ignore
+except Exception:  # pragma: no cover - optional dependency
+    orjson = None
 
 LOG_DIR = Path(__file__).resolve().parent / "logs"
-from main import NovelIllustrationAgent
-from src.chat_agent import ChatAgent
+_LOG_BUFFER_SIZE = 64 * 1024
+# Agent classes pull in openai, yaml, playwright, etc.; they are imported inside
+# main_cli() so banner-only paths start fast. Keep new heavy imports there too.
+if TYPE_CHECKING:
+    from src.chat_agent import ChatAgent
 
 
 class C:
@@ -33,6 +42,14 @@ class C:
     RESET = "\033[0m"
 
 
+def styled(text: str, *styles: str) -> str:
+    """Wrap text in one merged SGR sequence (BOLD+BLUE -> ESC[1;94m) and a single reset."""
+    if not styles:
+        return text
+    params = ";".join(st[2:-1] for st in styles)
+    return f"\033[{params}m{text}{C.RESET}"
+
+
 TOOL_LABELS = {
     "web_search": "web_search",
     "generate_novel_illustrations": "generate_illustrations",
@@ -68,21 +85,50 @@ TOOL_LABELS = {
     "android_get_screen_size": "android_get_screen_size",
 }
 
+# Decision summaries that merely restate the next tool call are not echoed.
+_DECISION_SKIP_PREFIXES = ("正在分析", "决定调用")
+_QUIT_COMMANDS = frozenset(("q", "quit", "exit"))
+
 
 def _tool_call_text(name: str, args: dict) -> str:
     """Format tool call like: web_search("长沙旅游景点")"""
     label = TOOL_LABELS.get(name, name)
-    parts = []
-    for k, v in args.items():
-        if k == "session_id":
-            continue
-        sv = str(v)
-        if len(sv) > 50:
-            sv = sv[:47] + "..."
-        parts.append(f'"{sv}"' if isinstance(v, str) else str(v))
-    if parts:
-        return f'{label}({", ".join(parts)})'
-    return f"{label}()"
+    return f'{label}({", ".join(_arg_text(v) for k, v in args.items() if k != "session_id")})'
+
+
+def _arg_text(v: object) -> str:
+    sv = v if isinstance(v, str) else repr(v)
+    if len(sv) > 50:
+        sv = sv[:47] + "..."
+    return f'"{sv}"' if isinstance(v, str) else sv
+
+
+def _web_search_line(result: dict) -> str:
+    items = result.get("results") or []
+    titles = [str(r.get("title") or "")[:30] for r in items[:2] if isinstance(r, dict)]
+    return f"{len(items)} results" + (f" — {'; '.join(titles)}" if titles else "")
+
+
+def _list_devices_line(result: dict) -> str:
+    devs = result.get("devices") or []
+    return f"{len(devs)} device(s)" + (f": {', '.join(devs[:2])}" if devs else "")
+
+
+_RESULT_LINE_FORMATTERS: Dict[str, Callable[[dict], str]] = {
+    "web_search": _web_search_line,
+    "android_list_devices": _list_devices_line,
+    "android_start": lambda r: f"connected {r.get('device_id', '')} ({r.get('driver', 'adb')})",
+    "android_open_app": lambda r: f"launched {r.get('package', '')}",
+    "android_tap_coordinates": lambda r: f"tapped ({r.get('x', '?')}, {r.get('y', '?')})",
+    "android_tap_percent": lambda r: f"tapped ({r.get('x_pct', '?')}%, {r.get('y_pct', '?')}%)",
+    "android_tap_text": lambda r: f"tapped '{r.get('text', '')}'",
+    "android_find_elements": lambda r: f"found {r.get('count', 0)} elements",
+    "android_screenshot": lambda r: f"saved: {r.get('screenshot', '')}",
+    "android_dump_ui": lambda r: f"{len(r.get('xml') or '')} chars",
+    "android_get_screen_size": lambda r: f"{r.get('width', '?')}x{r.get('height', '?')} ({r.get('orientation', '')})",
+    "android_wait": lambda r: f"{r.get('wait_ms', 0)}ms",
+    "android_swipe": lambda r: f"{r.get('direction', '')}",
+}
 
 
 def _result_one_line(name: str, result: object) -> str:
@@ -92,69 +138,136 @@ def _result_one_line(name: str, result: object) -> str:
         err = result.get("error") or "unknown"
         msg = result.get("message") or ""
         return f"failed: {err}" + (f" - {msg[:60]}" if msg else "")
-    if name == "web_search":
-        items = result.get("results") or []
-        n = len(items)
-        titles = [str(r.get("title") or "")[:30] for r in items[:2] if isinstance(r, dict)]
-        return f"{n} results" + (f" — {'; '.join(titles)}" if titles else "")
-    if name == "android_list_devices":
-        devs = result.get("devices") or []
-        return f"{len(devs)} device(s)" + (f": {', '.join(devs[:2])}" if devs else "")
-    if name == "android_start":
-        return f"connected {result.get('device_id', '')} ({result.get('driver', 'adb')})"
-    if name == "android_open_app":
-        return f"launched {result.get('package', '')}"
-    if name == "android_tap_coordinates":
-        return f"tapped ({result.get('x', '?')}, {result.get('y', '?')})"
-    if name == "android_tap_percent":
-        return f"tapped ({result.get('x_pct', '?')}%, {result.get('y_pct', '?')}%)"
-    if name == "android_tap_text":
-        return f"tapped '{result.get('text', '')}'"
-    if name == "android_find_elements":
-        return f"found {result.get('count', 0)} elements"
-    if name == "android_screenshot":
-        return f"saved: {result.get('screenshot', '')}"
-    if name == "android_dump_ui":
-        return f"{len(result.get('xml') or '')} chars"
-    if name == "android_get_screen_size":
-        return f"{result.get('width', '?')}x{result.get('height', '?')} ({result.get('orientation', '')})"
-    if name == "android_wait":
-        return f"{result.get('wait_ms', 0)}ms"
-    if name == "android_swipe":
-        return f"{result.get('direction', '')}"
-    return "done"
+    fmt = _RESULT_LINE_FORMATTERS.get(name)
+    return fmt(result) if fmt else "done"
+
+
+# Second-resolution timestamp, reused across the bursts of writes in one tool step.
+_TS_CACHE = {"epoch": -1, "str": ""}
+
+
+def _log_timestamp() -> str:
+    t = int(time.time())
+    if t != _TS_CACHE["epoch"]:
+        _TS_CACHE["str"] = time.strftime("%Y-%m-%d %H:%M:%S", time.localtime(t))
+        _TS_CACHE["epoch"] = t
+    return _TS_CACHE["str"]
 
 
 def _log_write(f, line: str):
-    ts = datetime.now().strftime("%Y-%m-%d %H:%M:%S")
-    f.write(f"[{ts}] {line}\n")
-    f.flush()
+    f.write(f"[{_log_timestamp()}] {line}\n")
+
+
+def _log_write_lines(f, prefix: str, text: str):
+    """Log every line of text under one timestamp with a single write."""
+    head = f"[{_log_timestamp()}] {prefix}"
+    f.write("".join(f"{head}{line}\n" for line in text.splitlines()))
+
+
+class _QueuedLogFile:
+    """File-like log sink whose writes are done by a background thread.
+
+    The chat thread only enqueues strings; the writer drains the queue and
+    flushes when it goes idle for a second or when flush() is requested.
+    """
+
+    _FLUSH = object()
+
+    def __init__(self, path: Path):
+        self._f = open(path, "w", encoding="utf-8", buffering=_LOG_BUFFER_SIZE)
+        self._q: "queue.Queue[object]" = queue.Queue()
+        self._thread = threading.Thread(target=self._drain, name="chat-log-writer", daemon=True)
+        self._thread.start()
+
+    def _drain(self) -> None:
+        f, q = self._f, self._q
+        dirty = False
+        while True:
+            try:
+                item = q.get(timeout=1.0)
+            except queue.Empty:
+                if dirty:
+                    f.flush()
+                    dirty = False
+                continue
+            if item is None:
+                break
+            if item is self._FLUSH:
+                f.flush()
+                dirty = False
+            else:
+                f.write(item)
+                dirty = True
+        f.close()
+
+    def write(self, text: str) -> None:
+        self._q.put(text)
+
+    def flush(self) -> None:
+        self._q.put(self._FLUSH)
+
+    def close(self) -> None:
+        self._q.put(None)
+        self._thread.join()
+
+
+_THINKING_DOTS = ("", ".", "..", "...")
+_THINKING_FRAMES = tuple(
+    "\r" + styled(f"  Agent is thinking{dots}   ", C.GREY) for dots in _THINKING_DOTS
+)
+_THINKING_CLEAR = "\r" + " " * len(f"  Agent is thinking{_THINKING_DOTS[-1]}   ") + "\r"
 
 
 def _show_thinking_indicator(stop_event: threading.Event) -> None:
     """Show 'Agent is thinking...' with animated dots in grey until stop_event is set."""
+    write = sys.stdout.write
+    flush = sys.stdout.flush
     dots = 0
-    base = "Agent is thinking"
-    max_len = len(f"  {base}...   ")
     while not stop_event.is_set():
-        n = (dots % 4)  # 0, 1, 2, 3 dots -> dynamic loading
-        suffix = "." * n
-        msg = f"  {base}{suffix}   "
-        sys.stdout.write(f"\r{C.GREY}{msg}{C.RESET}")
-        sys.stdout.flush()
+        write(_THINKING_FRAMES[dots & 3])  # 0, 1, 2, 3 dots -> dynamic loading
+        flush()
         dots += 1
         stop_event.wait(0.35)
     # Clear the line when done
-    sys.stdout.write("\r" + " " * max_len + "\r")
-    sys.stdout.flush()
+    write(_THINKING_CLEAR)
+    flush()
+
+
+def _dumps_indented(obj: object) -> str:
+    if orjson is not None:
+        try:
+            return orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS).decode("utf-8")
+        except TypeError:
+            pass
+    return json.dumps(obj, ensure_ascii=False, indent=2)
+
+
+# Tool results whose payload fields can run to megabytes (page source, UI dumps).
+_BULKY_RESULT_KEYS = ("html", "source", "xml", "text", "screenshot")
+
+
+def _elide_bulky_fields(result: dict, max_len: int) -> dict:
+    """Replace oversize payload strings with a placeholder so they are never serialized."""
+    elided = None
+    for key in _BULKY_RESULT_KEYS:
+        v = result.get(key)
+        if isinstance(v, str) and len(v) > max_len:
+            if elided is None:
+                elided = dict(result)
+            elided[key] = f"<truncated {len(v)} chars>"
+    return result if elided is None else elided
 
 
 def _format_result_for_log(result: object, max_len: int = 4000) -> str:
     try:
-        if isinstance(result, dict):
-            s = json.dumps(result, ensure_ascii=False, indent=2)
-        else:
+        if not isinstance(result, dict):
             s = str(result)
+        elif len(result) <= 4:
+            # Most tool calls return a tiny ACK dict; skip JSON for those.
+            small = _elide_bulky_fields(result, max_len)
+            s = "{" + ", ".join(f"{k!r}: {v!r}" for k, v in small.items()) + "}"
+        else:
+            s = _dumps_indented(_elide_bulky_fields(result, max_len))
     except Exception:
         s = str(result)
     if len(s) > max_len:
@@ -162,122 +275,158 @@ def _format_result_for_log(result: object, max_len: int = 4000) -> str:
     return s
 
 
+# Trailing space keeps e.g. "runtime.txt" or "paths/novel.txt" intact.
+_NOVEL_PATH_PREFIXES = ("run ", "process ", "open ", "generate ", "path ")
+
+
 def parse_novel_path(user_input: str) -> str:
     s = user_input.strip()
-    for prefix in ["run", "process", "open", "generate", "path"]:
-        if s.lower().startswith(prefix):
-            s = s[len(prefix):].strip()
-    if (s.startswith('"') and s.endswith('"')) or (s.startswith("'") and s.endswith("'")):
+    sl = s.lower()
+    if sl.startswith(_NOVEL_PATH_PREFIXES):
+        for prefix in _NOVEL_PATH_PREFIXES:
+            if sl.startswith(prefix):
+                s = s[len(prefix):].strip()
+                break
+    if len(s) >= 2 and s[0] == s[-1] and s[0] in "\"'":
         s = s[1:-1]
     return s.strip()
 
 
+_BANNER_LINES = (
+    " █████╗ ██████╗ ██████╗  █████╗  ██████╗ ███████╗███╗   ██╗████████╗",
+    "██╔══██╗██╔══██╗██╔══██╗██╔══██╗██╔════╝ ██╔════╝████╗  ██║╚══██╔══╝",
+    "███████║██████╔╝██████╔╝███████║██║  ███╗█████╗  ██╔██╗ ██║   ██║   ",
+    "██╔══██║██╔═══╝ ██╔═══╝ ██╔══██║██║   ██║██╔══╝  ██║╚██╗██║   ██║   ",
+    "██║  ██║██║     ██║     ██║  ██║╚██████╔╝███████╗██║ ╚████║   ██║   ",
+    "╚═╝  ╚═╝╚═╝     ╚═╝     ╚═╝  ╚═╝ ╚═════╝ ╚══════╝╚═╝  ╚═══╝   ╚═╝   ",
+)
+# Gradient-style ASCII art: purple -> magenta
+_BANNER_COLORS = ("\033[38;5;135m", "\033[38;5;141m", "\033[38;5;177m",
+                  "\033[38;5;213m", "\033[38;5;219m", "\033[38;5;225m")
+_BANNER_TOOLS = ("Novel illustrations", "Android automation", "Browser automation", "Web search")
+
+# Banner is built once at import; only the working directory varies per call.
+_BANNER_HEAD = "\n".join(
+    [""]
+    + ["  " + styled(line, _BANNER_COLORS[i % len(_BANNER_COLORS)], C.BOLD)
+       for i, line in enumerate(_BANNER_LINES)]
+    + ["", "  " + styled("... Ready to go! What would you like me to do?", C.DIM), ""]
+)
+_BANNER_TAIL = "\n".join([
+    "",
+    "  " + styled(f"Tools: {' | '.join(_BANNER_TOOLS)}", C.DIM),
+    "",
+    "  " + styled("Tips: Enter to submit, ^C to interrupt, 'q' to quit", C.DIM),
+    "",
+    "",
+])
+
+
 def print_banner():
-    print()
-    # Gradient-style ASCII art: purple -> magenta
-    lines = [
-        " █████╗ ██████╗ ██████╗  █████╗  ██████╗ ███████╗███╗   ██╗████████╗",
-        "██╔══██╗██╔══██╗██╔══██╗██╔══██╗██╔════╝ ██╔════╝████╗  ██║╚══██╔══╝",
-        "███████║██████╔╝██████╔╝███████║██║  ███╗█████╗  ██╔██╗ ██║   ██║   ",
-        "██╔══██║██╔═══╝ ██╔═══╝ ██╔══██║██║   ██║██╔══╝  ██║╚██╗██║   ██║   ",
-        "██║  ██║██║     ██║     ██║  ██║╚██████╔╝███████╗██║ ╚████║   ██║   ",
-        "╚═╝  ╚═╝╚═╝     ╚═╝     ╚═╝  ╚═╝ ╚═════╝ ╚══════╝╚═╝  ╚═══╝   ╚═╝   ",
-    ]
-    colors = ["\033[38;5;135m", "\033[38;5;141m", "\033[38;5;177m",
-              "\033[38;5;213m", "\033[38;5;219m", "\033[38;5;225m"]
-    for i, line in enumerate(lines):
-        c = colors[i % len(colors)]
-        print(f"  {c}{C.BOLD}{line}{C.RESET}")
-    print()
-    print(f"  {C.DIM}... Ready to go! What would you like me to do?{C.RESET}")
     cwd = os.path.abspath(".")
-    print(f"  {C.DIM}Working directory: {cwd}{C.RESET}")
-    print()
-    tools = ["Novel illustrations", "Android automation", "Browser automation", "Web search"]
-    print(f"  {C.DIM}Tools: {' | '.join(tools)}{C.RESET}")
-    print()
-    print(f"  {C.DIM}Tips: Enter to submit, ^C to interrupt, 'q' to quit{C.RESET}")
-    print()
+    sys.stdout.write(f"{_BANNER_HEAD}  {styled(f'Working directory: {cwd}', C.DIM)}\n{_BANNER_TAIL}")
+    sys.stdout.flush()
 
 
-def run_chat(chat_agent: ChatAgent):
+def _iter_user_inputs():
+    """Yield stripped user lines: prompted input() on a TTY, plain line reads when piped."""
+    stdin = sys.stdin
+    if stdin is not None and not stdin.isatty():
+        # Scripted sessions (heredoc / pipe) skip input()'s per-call prompt handling.
+        yield from (line.strip() for line in iter(stdin.readline, ""))
+        return
+    prompt = "  " + styled("> ", C.BOLD)
+    while True:
+        yield input(prompt).strip()
+
+
+def run_chat(chat_agent: "ChatAgent"):
     """Main chat loop with clean output."""
     LOG_DIR.mkdir(parents=True, exist_ok=True)
     log_name = f"agent_{datetime.now().strftime('%Y%m%d_%H%M%S')}.log"
     log_path = LOG_DIR / log_name
-    log_file = open(log_path, "w", encoding="utf-8")
-    _log_write(log_file, "=== Chat session started ===")
+    # The log is read post-mortem: a background thread does the disk I/O and
+    # flushes only when idle, on failure and on exit.
+    log_file = _QueuedLogFile(log_path)
+    # Hot-path helpers bound once so the per-step callbacks avoid global/attribute lookups.
+    log = functools.partial(_log_write, log_file)
+    log_lines = functools.partial(_log_write_lines, log_file)
+    tool_call_text, result_one_line = _tool_call_text, _result_one_line
+    green, red, dim, magenta = C.GREEN, C.RED, C.DIM, C.MAGENTA
+    log("=== Chat session started ===")
 
     history = []
     _stop_ref: list = []
     _indicator_ref: list = []
 
+    def _interrupt_indicator():
+        """Stop the thinking indicator once; later calls in the same turn are no-ops."""
+        if not _stop_ref or _stop_ref[0].is_set():
+            return
+        _stop_ref[0].set()
+        _indicator_ref[0].join(timeout=0.5)
+
     def on_step_start(step_index: int, name: str, args: dict):
-        if _stop_ref and _indicator_ref:
-            _stop_ref[0].set()
-            _indicator_ref[0].join(timeout=0.5)
-        desc = _tool_call_text(name, args)
-        print(f"  {C.GREEN}● {desc}{C.RESET}")
-        _log_write(log_file, f"  [tool_call] {name} | args: {args}")
+        _interrupt_indicator()
+        desc = tool_call_text(name, args)
+        print("  " + styled(f"● {desc}", green))
+        log(f"  [tool_call] {name} | args: {args}")
 
     def on_step_end(step_index: int, name: str, result: dict):
         log_text = _format_result_for_log(result)
-        for line in log_text.splitlines():
-            _log_write(log_file, f"  [tool_result] {line}")
+        log_lines("  [tool_result] ", log_text)
         if isinstance(result, dict) and result.get("success") is False:
             err_key = result.get("error") or "unknown"
             err_msg = result.get("message") or ""
             detail = f"{err_key}: {err_msg}" if err_msg else err_key
-            print(f"  {C.RED}  ✗ {detail}{C.RESET}")
+            print("  " + styled(f"  ✗ {detail}", red))
             return
-        summary = _result_one_line(name, result)
-        print(f"  {C.DIM}  └ {summary}{C.RESET}")
+        summary = result_one_line(name, result)
+        print("  " + styled(f"  └ {summary}", dim))
 
     def on_event(event_name: str, payload: dict):
         if event_name == "state_change":
-            _log_write(log_file, f"[state] {payload.get('state', 'unknown')}")
+            state = payload.get("state", "unknown")
+            log(f"[state] {state}")
+            if state == "failed":
+                log_file.flush()
             return
         if event_name == "plan_created":
-            _log_write(log_file, f"[plan] {json.dumps(payload.get('plan', {}), ensure_ascii=False)}")
+            log(f"[plan] {json.dumps(payload.get('plan', {}), ensure_ascii=False)}")
             return
         if event_name == "thinking":
-            if _stop_ref and _indicator_ref:
-                _stop_ref[0].set()
-                _indicator_ref[0].join(timeout=0.5)
+            _interrupt_indicator()
             text = str(payload.get("text", "")).strip()
             if text:
                 for line in text.splitlines():
                     line = line.strip()
                     if line:
-                        print(f"  {C.MAGENTA}● {line}{C.RESET}")
-                _log_write(log_file, f"[thinking] {text}")
+                        print("  " + styled(f"● {line}", magenta))
+                log(f"[thinking] {text}")
             return
         if event_name == "tool_insight":
             text = str(payload.get("text", "")).strip()
             if text:
-                print(f"  {C.DIM}  ℹ {text}{C.RESET}")
-                _log_write(log_file, f"[tool_insight] {text}")
+                print("  " + styled(f"  ℹ {text}", dim))
+                log(f"[tool_insight] {text}")
             return
         if event_name == "decision_summary":
             text = str(payload.get("text", "")).strip()
-            if text and not text.startswith("正在分析") and not text.startswith("决定调用"):
-                if _stop_ref and _indicator_ref:
-                    _stop_ref[0].set()
-                    _indicator_ref[0].join(timeout=0.5)
-                print(f"  {C.DIM}● {text}{C.RESET}")
-                _log_write(log_file, f"[decision] {text}")
+            if text and not text.startswith(_DECISION_SKIP_PREFIXES):
+                _interrupt_indicator()
+                print("  " + styled(f"● {text}", dim))
+                log(f"[decision] {text}")
             return
 
     try:
-        while True:
-            user_input = input(f"  {C.BOLD}> {C.RESET}").strip()
+        for user_input in _iter_user_inputs():
             if not user_input:
                 continue
-            if user_input.lower() in ("q", "quit", "exit"):
-                _log_write(log_file, "=== Session ended (user quit) ===")
-                print(f"\n  {C.DIM}Log: {log_path}{C.RESET}\n")
+            if user_input.lower() in _QUIT_COMMANDS:
+                log("=== Session ended (user quit) ===")
+                print(f"\n  {styled(f'Log: {log_path}', C.DIM)}\n")
                 return
-            _log_write(log_file, f"[user] {user_input}")
+            log(f"[user] {user_input}")
             print()
             stop_thinking = threading.Event()
             indicator = threading.Thread(target=_show_thinking_indicator, args=(stop_thinking,), daemon=True)
@@ -295,16 +444,17 @@ def run_chat(chat_agent: ChatAgent):
                     on_event=on_event,
                 )
             finally:
-                stop_thinking.set()
-                indicator.join(timeout=0.5)
+                _interrupt_indicator()
             reply = result.get("reply", "")
-            _log_write(log_file, f"[agent_reply] {reply}")
+            log(f"[agent_reply] {reply}")
             if reply:
-                print(f"\n  {C.GREEN}● {reply}{C.RESET}\n")
+                print(f"\n  {styled(f'● {reply}', C.GREEN)}\n")
             else:
                 print()
             history.append({"role": "user", "content": user_input})
             history.append({"role": "assistant", "content": reply})
+        log("=== Session ended (end of input) ===")
+        print(f"\n  {styled(f'Log: {log_path}', C.DIM)}\n")
     finally:
         log_file.close()
 
@@ -312,12 +462,14 @@ def run_chat(chat_agent: ChatAgent):
 def main_cli():
     print_banner()
     try:
+        from src.chat_agent import ChatAgent
+
         chat_agent = ChatAgent(config_path="config/settings.yaml")
         run_chat(chat_agent)
     except KeyboardInterrupt:
-        print(f"\n  {C.DIM}Interrupted.{C.RESET}\n")
+        print(f"\n  {styled('Interrupted.', C.DIM)}\n")
     except Exception as e:
-        print(f"  {C.RED}Error: {e}{C.RESET}")
+        print("  " + styled(f"Error: {e}", C.RED))
         import traceback
         traceback.print_exc()
     return 0
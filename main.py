@@ -3,23 +3,87 @@ Agent Novel 主程序
 将小说切分为片段 -> 筛选片段 -> 生成提示词 -> 生成插图
 """
 import argparse
+import copy
+import functools
+import hashlib
 import json
+import logging
+import os
+import queue
 import re
+import threading
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import List, Dict
-import yaml
-from dotenv import load_dotenv
+from typing import TYPE_CHECKING, Callable, List, Dict, Optional
+from logging.handlers import RotatingFileHandler
+from tqdm import tqdm
 
-from src.novel_processor import NovelProcessor
-from src.fragment_filter import FragmentFilter
-from src.prompt_generator import PromptGenerator
-from src.sd_client import SDClient
-from src.character_state_machine import CharacterStateMachine
-from src.markdown_generator import MarkdownGenerator
 from src.api_cost_tracker import APICostTracker
+from src.llm_cache import LLMCache
 
-# 加载环境变量
-load_dotenv()
+# 组件模块会拉起 openai / pydantic / PIL / numba 等重依赖，在 setup_components 与实际使用处导入，
+# 使 `python main.py --help` 等路径快速启动；新增的重依赖也请放在使用处导入
+if TYPE_CHECKING:
+    from src.sd_client import SDClient
+
+try:
+    import orjson  # 可选：更快的 JSON 序列化
+except ImportError:
+    orjson = None
+
+logger = logging.getLogger(__name__)
+
+
+# 文件名中不允许出现的字符
+_SANITIZE_RE = re.compile(r'[<>:"/\\|?*]')
+
+
+def _safe_chapter_dir(output_path: Path, chapter_num: int, chapter_title: str) -> Path:
+    """章节输出目录：第N章_<清理后的标题（最多50字符）>"""
+    safe_title = _SANITIZE_RE.sub('_', chapter_title).strip()[:50]
+    return output_path / f"第{chapter_num}章_{safe_title}"
+
+
+def _write_json(path: Path, obj) -> None:
+    """写入缩进 JSON 文件（优先使用 orjson，未安装时回退到标准库 json）"""
+    if orjson is not None:
+        path.write_bytes(orjson.dumps(obj, option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS))
+        return
+    with open(path, 'w', encoding='utf-8') as f:
+        json.dump(obj, f, ensure_ascii=False, indent=2)
+
+
+def _json_line(obj) -> bytes:
+    """序列化为一行 JSONL（UTF-8 字节，含换行符）"""
+    if orjson is not None:
+        return orjson.dumps(obj, option=orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE)
+    return (json.dumps(obj, ensure_ascii=False) + "\n").encode('utf-8')
+
+
+def _read_yaml_config(config_path: str) -> dict:
+    """解析 YAML 配置（按 绝对路径 + 修改时间 缓存：同一文件重复加载不再解析，文件修改后重新读取）"""
+    path = Path(config_path).resolve()
+    return _parse_yaml_config(str(path), path.stat().st_mtime_ns)
+
+
+@functools.lru_cache(maxsize=8)
+def _parse_yaml_config(path: str, mtime_ns: int) -> dict:
+    """实际解析 YAML；mtime_ns 只用于缓存键"""
+    import yaml
+    with open(path, 'r', encoding='utf-8') as f:
+        return yaml.safe_load(f) or {}
+
+
+def _mark_unfiltered(fragments: List[Dict]) -> List[Dict]:
+    """未经筛选时为所有片段写入默认筛选结果（全部选中，视觉描述取原文前200字）"""
+    for frag in fragments:
+        frag['filter_result'] = {
+            'selected': True,
+            'score': 5.0,
+            'reason': '未筛选',
+            'visual_description': frag['text'][:200]
+        }
+    return fragments
 
 
 class NovelIllustrationAgent:
@@ -32,7 +96,12 @@ class NovelIllustrationAgent:
         Args:
             config_path: 配置文件路径
         """
+        # 加载环境变量
+        from dotenv import load_dotenv
+        load_dotenv()
+        
         self.config = self.load_config(config_path)
+        self._sd_client: Optional["SDClient"] = None
         self.setup_components()
     
     def load_config(self, config_path: str) -> dict:
@@ -42,13 +111,18 @@ class NovelIllustrationAgent:
             print(f"⚠️ 配置文件不存在: {config_path}，使用默认配置")
             return {}
         
-        with open(config_file, 'r', encoding='utf-8') as f:
-            config = yaml.safe_load(f)
+        # 返回副本，避免调用方修改缓存中的配置
+        config = copy.deepcopy(_read_yaml_config(str(config_file)))
         print(f"✅ 已加载配置文件: {config_path}")
         return config
     
     def setup_components(self):
-        """初始化各个组件"""
+        """初始化各个组件（SD客户端在首次生成图片时创建）"""
+        from src.novel_processor import NovelProcessor
+        from src.fragment_filter import FragmentFilter
+        from src.prompt_generator import PromptGenerator
+        from src.character_state_machine import CharacterStateMachine
+        
         # 小说处理器
         novel_config = self.config.get('novel_processor', {})
         self.processor = NovelProcessor(
@@ -66,7 +140,8 @@ class NovelIllustrationAgent:
         
         # 人物状态机
         self.character_state_machine = CharacterStateMachine(
-            model=llm_config.get('model', 'gpt-4o-mini')
+            model=llm_config.get('model', 'gpt-4o-mini'),
+            max_retries=llm_config.get('max_retries', 2),
         )
         
         # 提示词生成器（传入人物状态机）
@@ -77,19 +152,462 @@ class NovelIllustrationAgent:
             lora=prompt_config.get('lora', None),
             character_state_machine=self.character_state_machine
         )
+    
+    @property
+    def sd_client(self) -> "SDClient":
+        """SD客户端（懒加载：--skip-generation 时不导入 requests/PIL）"""
+        if self._sd_client is None:
+            from src.sd_client import SDClient
+            sd_config = self.config.get('sd', {})
+            self._sd_client = SDClient(
+                url=sd_config.get('url', 'http://127.0.0.1:7860'),
+                output_dir=sd_config.get('output_dir', 'output'),
+                width=sd_config.get('width', 512),
+                height=sd_config.get('height', 768),
+                steps=sd_config.get('steps', 25),
+                cfg_scale=sd_config.get('cfg_scale', 7),
+                sampler_name=sd_config.get('sampler_name', 'DPM++ 2M Karras')
+            )
+        return self._sd_client
+    
+    def _update_characters(self, fragments: List[Dict], cost_tracker: APICostTracker):
+        """
+        并发调用LLM提取各片段人物信息，再按片段顺序合并进人物状态机
         
-        # SD客户端
+        Args:
+            fragments: 章节片段列表
+            cost_tracker: API 消耗追踪器
+        """
+        csm = self.character_state_machine
+        concurrency = self.config.get('llm', {}).get('concurrency', 8)
+        batch_size = max(1, self.config.get('character_state', {}).get('batch_size', 1))
+        # 每 batch_size 个片段合并为一次LLM调用，各批次再并发请求
+        chunks = [fragments[k:k + batch_size] for k in range(0, len(fragments), batch_size)]
+        with ThreadPoolExecutor(max_workers=max(1, concurrency)) as pool:
+            # map 保持提交顺序，合并结果与串行执行一致
+            extracted = pool.map(
+                lambda chunk: csm.extract_characters_marshaled(
+                    [frag['text'] for frag in chunk], cost_tracker=cost_tracker,
+                ),
+                chunks,
+            )
+            with tqdm(total=len(fragments), desc="人物状态", unit="段", leave=False) as progress:
+                for chunk, results in zip(chunks, extracted):
+                    for frag, result in zip(chunk, results):
+                        csm.apply_extracted_characters(result, frag['text'], fragment_index=frag.get('index'))
+                    progress.update(len(chunk))
+    
+    def _generate_chapter_images(
+        self,
+        fragments_with_prompts: List[Dict],
+        chapter_dir: Path,
+        chapter_num: int,
+    ) -> List[Optional[str]]:
+        """
+        用有界线程池并发调用SD生成一个章节的插图
+        
+        Args:
+            fragments_with_prompts: 带 prompts 字段的片段列表
+            chapter_dir: 章节输出目录
+            chapter_num: 章节号（用于日志）
+        
+        Returns:
+            与片段一一对应的图片路径列表，失败项为None
+        """
+        total = len(fragments_with_prompts)
+        # 在主线程中创建客户端，避免工作线程并发懒加载
+        sd_client = self.sd_client
         sd_config = self.config.get('sd', {})
-        self.sd_client = SDClient(
-            url=sd_config.get('url', 'http://127.0.0.1:7860'),
-            output_dir=sd_config.get('output_dir', 'output'),
-            width=sd_config.get('width', 512),
-            height=sd_config.get('height', 768),
-            steps=sd_config.get('steps', 25),
-            cfg_scale=sd_config.get('cfg_scale', 7),
-            sampler_name=sd_config.get('sampler_name', 'DPM++ 2M Karras')
+        resume = sd_config.get('resume', True)
+        
+        batch_size = max(1, sd_config.get('batch_size', 1))
+        image_paths: List[Optional[str]] = [None] * total
+        
+        # 先做续跑检查，剩余请求按（正面, 负面）提示词分组：WebUI 的 batch_size 只能对同一提示词出多张
+        pending: Dict[tuple, list] = {}
+        for i, fragment in enumerate(fragments_with_prompts):
+            prompts = fragment['prompts']
+            # 生成文件名（在章节内重新编号）
+            target = chapter_dir / f"illustration_{i+1:04d}.png"
+            sidecar = target.with_suffix(".meta.json")
+            request_hash = hashlib.sha256("\x00".join(map(str, (
+                prompts['positive_prompt'], prompts['negative_prompt'],
+                sd_client.width, sd_client.height, sd_client.steps,
+                sd_client.cfg_scale, sd_client.sampler_name,
+            ))).encode('utf-8')).hexdigest()
+            
+            # 续跑：图片已存在且请求参数未变时直接复用
+            if resume and target.exists() and sidecar.exists():
+                try:
+                    if json.loads(sidecar.read_text(encoding='utf-8')).get('request_hash') == request_hash:
+                        logger.debug("跳过已存在的插图: %s", target)
+                        image_paths[i] = str(target)
+                        continue
+                except (OSError, ValueError):
+                    pass
+            
+            logger.debug("待生成插图 %d/%d (章节 %s) 片段索引: %s 原文: %s...",
+                         i + 1, total, chapter_num, fragment['index'], fragment['text'][:100])
+            key = (prompts['positive_prompt'], prompts['negative_prompt'])
+            pending.setdefault(key, []).append((i, target, sidecar, request_hash))
+        
+        # 每组再按 batch_size 切成若干次请求
+        jobs = [
+            (positive, negative, items[k:k + batch_size])
+            for (positive, negative), items in pending.items()
+            for k in range(0, len(items), batch_size)
+        ]
+        
+        def run_job(job):
+            positive, negative, items = job
+            if len(items) == 1:
+                paths = [sd_client.generate_illustration(
+                    prompt=positive,
+                    negative_prompt=negative,
+                    output_filename=items[0][1].name,
+                    output_dir=str(chapter_dir)
+                )]
+            else:
+                paths = sd_client.generate_batch(
+                    positive, negative,
+                    [target.name for _, target, _, _ in items],
+                    output_dir=str(chapter_dir)
+                )
+            for (i, _, sidecar, request_hash), image_path in zip(items, paths):
+                if image_path:
+                    sidecar.write_text(json.dumps({'request_hash': request_hash}), encoding='utf-8')
+                image_paths[i] = image_path
+            return len(items)
+        
+        # 并发数保守设置，避免 SD 显存溢出
+        max_workers = max(1, sd_config.get('max_concurrency', 2))
+        with ThreadPoolExecutor(max_workers=max_workers) as pool, \
+                tqdm(total=total, initial=total - sum(len(j[2]) for j in jobs),
+                     desc=f"章节 {chapter_num} 插图", unit="张", leave=False) as bar:
+            for done in pool.map(run_job, jobs):
+                bar.update(done)
+        return image_paths
+    
+    def _dedupe_fragments(self, fragments: List[Dict]):
+        """
+        按文本哈希去重（全书范围，见 process_novel 中的 _seen_fragments）
+        
+        Returns:
+            (首次出现的片段列表, [(重复片段, 首次出现的片段), ...])
+        """
+        unique = []
+        duplicates = []
+        for frag in fragments:
+            key = hashlib.blake2b(frag['text'].encode('utf-8'), digest_size=16).digest()
+            first = self._seen_fragments.setdefault(key, frag)
+            if first is frag:
+                unique.append(frag)
+            else:
+                duplicates.append((frag, first))
+        return unique, duplicates
+    
+    def _run_stage1(
+        self,
+        chapter_num: int,
+        chapter: Dict,
+        chapter_dir: Path,
+        do_step1: bool = True,
+        skip_filter: bool = False,
+        cost_tracker: Optional[APICostTracker] = None,
+    ) -> List[Dict]:
+        """阶段1：单章节人物状态更新 + 片段筛选，返回选中的片段"""
+        chapter_title = chapter['title']
+        fragments = chapter['fragments']
+        
+        print(f"\n{'='*60}")
+        print(f"📖 章节 {chapter_num}: {chapter_title}")
+        print(f"{'='*60}")
+        
+        chapter_dir.mkdir(parents=True, exist_ok=True)
+        
+        if do_step1:
+            print(f"\n[步骤 1/3] 人物状态更新 + 片段筛选（章节 {chapter_num}）...")
+            unique, duplicates = self._dedupe_fragments(fragments)
+            if duplicates:
+                print(f"♻️ 跳过 {len(duplicates)} 个重复片段（复用首次出现时的结果）")
+            self._update_characters(unique, cost_tracker)
+            # 每章检查点：后续阶段崩溃时，重跑可加载已提取的人物状态
+            self.character_state_machine.save(str(self._character_state_file))
+            if not skip_filter:
+                filter_config = self.config.get('fragment_filter', {})
+                if filter_config.get('use_custom_criteria', False):
+                    filtered = self.filter_agent.filter_with_criteria(
+                        unique,
+                        criteria=filter_config.get('custom_criteria', ''),
+                        min_score=filter_config.get('min_score', 6.0),
+                        max_selected=filter_config.get('max_selected'),
+                        cost_tracker=cost_tracker,
+                        batch_size=filter_config.get('batch_size', 1),
+                    )
+                else:
+                    filtered = self.filter_agent.filter_batch(
+                        unique,
+                        min_score=filter_config.get('min_score', 6.0),
+                        max_selected=filter_config.get('max_selected'),
+                        cost_tracker=cost_tracker,
+                        batch_size=filter_config.get('batch_size', 1),
+                    )
+                # 重复片段只复制筛选结果，不再单独入选（相同文本生成的插图相同）
+                for frag, first in duplicates:
+                    if 'filter_result' in first:
+                        frag['filter_result'] = dict(first['filter_result'])
+            else:
+                filtered = _mark_unfiltered(fragments)
+            print(f"✅ 章节 {chapter_num} 选中 {len(filtered)} 个片段")
+        else:
+            filtered = _mark_unfiltered(fragments)
+        
+        return filtered
+    
+    def _run_stage2(
+        self,
+        chapter_num: int,
+        filtered: List[Dict],
+        do_step2: bool = True,
+        cost_tracker: Optional[APICostTracker] = None,
+        batch_size: int = 1,
+    ) -> List[Dict]:
+        """阶段2：为单章节选中的片段生成提示词"""
+        if do_step2:
+            print(f"\n[步骤 2/3] 生成提示词（章节 {chapter_num}）...")
+            return self.prompt_generator.batch_generate(
+                filtered,
+                cost_tracker=cost_tracker,
+                batch_size=batch_size,
+            )
+        return self.prompt_generator.batch_generate(
+            filtered,
+            cost_tracker=None,
         )
     
+    def _run_stage3(
+        self,
+        chapter_num: int,
+        chapter_title: str,
+        fragments_with_prompts: List[Dict],
+        chapter_dir: Path,
+        output_path: Path,
+        generate_images: bool = True,
+    ):
+        """阶段3：生成单章节插图并保存章节元数据，返回 (章节结果列表, 生成图片数)"""
+        if generate_images:
+            print(f"\n[步骤 4/4] 生成插图（章节 {chapter_num}）...")
+            image_paths = self._generate_chapter_images(fragments_with_prompts, chapter_dir, chapter_num)
+            for fragment, image_path in zip(fragments_with_prompts, image_paths):
+                fragment['image_path'] = image_path
+                fragment['generated'] = image_path is not None
+            # 转换为相对路径（相对于输出目录）：chapter_dir 由 output_path 拼接而来，去掉前缀即可
+            output_prefix = str(output_path) + os.sep
+            rel_paths = [
+                (image_path[len(output_prefix):] if image_path.startswith(output_prefix) else image_path)
+                if image_path else None
+                for image_path in image_paths
+            ]
+        else:
+            print(f"\n[步骤 4/4] 跳过图片生成")
+            rel_paths = [None] * len(fragments_with_prompts)
+        
+        # 按列（图片路径）一次性构建章节结果，两种分支共用同一份记录结构
+        chapter_results = [
+            {
+                'index': fragment['index'],
+                'chapter_num': chapter_num,
+                'chapter_title': chapter_title,
+                'text': fragment['text'],
+                'image_path': rel_path,
+                'prompts': fragment.get('prompts', {}),
+                'filter_score': fragment.get('filter_result', {}).get('score', 0),
+                'generated': rel_path is not None
+            }
+            for fragment, rel_path in zip(fragments_with_prompts, rel_paths)
+        ]
+        total_generated = sum(rel_path is not None for rel_path in rel_paths)
+        
+        # 保存章节元数据
+        if self.config.get('output', {}).get('save_metadata', True):
+            metadata_file = chapter_dir / "metadata.json"
+            _write_json(metadata_file, chapter_results)
+            print(f"\n✅ 章节 {chapter_num} 元数据已保存至: {metadata_file}")
+        
+        return chapter_results, total_generated
+    
+    def _run_pipelined(
+        self,
+        chapters_data: Dict,
+        chapter_order: List[int],
+        chapter_titles: Dict[int, str],
+        chapter_dirs: Dict[int, Path],
+        output_path: Path,
+        on_chapter: Callable[[int, str, List[Dict]], None],
+        skip_filter: bool = False,
+        skip_generation: bool = False,
+        cost_tracker: Optional[APICostTracker] = None,
+        prompt_batch_size: int = 1,
+    ):
+        """
+        按章节流水线执行三个阶段：主线程做阶段1，两个工作线程分别做阶段2和阶段3，
+        阶段间用有界队列衔接（背压），不再等待全书完成上一阶段
+        
+        Args:
+            on_chapter: 每章阶段3完成后按章节顺序调用 (章节号, 标题, 章节结果列表)
+        
+        Returns:
+            (选中片段总数, 生成图片总数)
+        """
+        prompts_q: "queue.Queue" = queue.Queue(maxsize=2)
+        sd_q: "queue.Queue" = queue.Queue(maxsize=2)
+        errors: List[BaseException] = []
+        generated = [0]
+        
+        def prompt_worker():
+            while (item := prompts_q.get()) is not None:
+                if errors:
+                    continue  # 已出错：继续取队列避免上游阻塞
+                chapter_num, chapter_title, chapter_dir, filtered = item
+                try:
+                    fragments_with_prompts = self._run_stage2(
+                        chapter_num, filtered, cost_tracker=cost_tracker, batch_size=prompt_batch_size,
+                    )
+                    sd_q.put((chapter_num, chapter_title, chapter_dir, fragments_with_prompts))
+                except BaseException as e:
+                    errors.append(e)
+            sd_q.put(None)
+        
+        def sd_worker():
+            while (item := sd_q.get()) is not None:
+                if errors:
+                    continue
+                chapter_num, chapter_title, chapter_dir, fragments_with_prompts = item
+                try:
+                    chapter_results, n = self._run_stage3(
+                        chapter_num, chapter_title, fragments_with_prompts,
+                        chapter_dir, output_path, generate_images=not skip_generation,
+                    )
+                    generated[0] += n
+                    on_chapter(chapter_num, chapter_title, chapter_results)
+                except BaseException as e:
+                    errors.append(e)
+        
+        workers = [
+            threading.Thread(target=prompt_worker, name="stage2-prompts", daemon=True),
+            threading.Thread(target=sd_worker, name="stage3-sd", daemon=True),
+        ]
+        for w in workers:
+            w.start()
+        
+        total_selected = 0
+        try:
+            for chapter_num in chapter_order:
+                if errors:
+                    break
+                chapter_dir = chapter_dirs[chapter_num]
+                filtered = self._run_stage1(
+                    chapter_num, chapters_data[chapter_num], chapter_dir,
+                    skip_filter=skip_filter, cost_tracker=cost_tracker,
+                )
+                total_selected += len(filtered)
+                prompts_q.put((chapter_num, chapter_titles[chapter_num], chapter_dir, filtered))
+        except BaseException as e:
+            # 阶段1失败或 Ctrl-C：通知工作线程只取空队列、不再处理已排队的章节
+            errors.append(e)
+            raise
+        finally:
+            prompts_q.put(None)
+            for w in workers:
+                w.join()
+        
+        if errors:
+            raise errors[0]
+        return total_selected, generated[0]
+    
+    def _run_barrier(
+        self,
+        chapters_data: Dict,
+        chapter_order: List[int],
+        chapter_titles: Dict[int, str],
+        chapter_dirs: Dict[int, Path],
+        output_path: Path,
+        on_chapter: Callable[[int, str, List[Dict]], None],
+        do_step1: bool = True,
+        skip_filter: bool = False,
+        skip_generation: bool = False,
+        cost_tracker: Optional[APICostTracker] = None,
+        prompt_batch_size: int = 1,
+        confirm_steps: bool = False,
+        run_all: bool = True,
+    ):
+        """
+        全书逐阶段执行（每个阶段处理完所有章节再进入下一阶段），阶段间可询问用户确认
+        
+        Returns:
+            (选中片段总数, 生成图片总数)；用户中止时返回 None
+        """
+        total_selected = 0
+        total_generated = 0
+        filtered_per_chapter = {}  # chapter_num -> list of filtered fragments
+        for chapter_num in chapter_order:
+            filtered = self._run_stage1(
+                chapter_num, chapters_data[chapter_num], chapter_dirs[chapter_num],
+                do_step1=do_step1, skip_filter=skip_filter, cost_tracker=cost_tracker,
+            )
+            filtered_per_chapter[chapter_num] = filtered
+            total_selected += len(filtered)
+        
+        # ---------- 阶段2：提示词生成 ----------
+        do_step2 = True
+        if confirm_steps and not run_all:
+            step2_estimate_cny = cost_tracker.estimate_step_cost(
+                "step2",
+                num_calls=total_selected,
+                avg_input_chars=1000,
+                avg_output_chars=300,
+            )
+            print(f"\n📌 步骤 2/3：Prompt 生成")
+            print(f"   预计 API 调用：约 {total_selected} 次")
+            print(f"   预计费用：约 {step2_estimate_cny:.4f} 元")
+            r = input("   Proceed? (y=yes / n=abort / a=run all): ").strip().lower()
+            if r == "n":
+                print("\n   Aborted by user.")
+                return None
+            elif r == "a":
+                run_all = True
+        
+        fragments_with_prompts_per_chapter = {}
+        for chapter_num in chapter_order:
+            fragments_with_prompts_per_chapter[chapter_num] = self._run_stage2(
+                chapter_num, filtered_per_chapter[chapter_num],
+                do_step2=do_step2, cost_tracker=cost_tracker, batch_size=prompt_batch_size,
+            )
+        
+        # ---------- 阶段3：生成插图 ----------
+        do_step3 = True
+        if confirm_steps and not run_all:
+            print(f"\n📌 步骤 3/3：生成插图（本地 SD 模型）")
+            print(f"   预计生成图片：{total_selected} 张")
+            print(f"   费用：0 元（本地模型）")
+            r = input("   Proceed? (y=yes / n=abort / a=run all): ").strip().lower()
+            if r == "n":
+                print("\n   Aborted by user.")
+                return None
+            elif r == "a":
+                run_all = True
+        
+        for chapter_num in chapter_order:
+            chapter_title = chapter_titles[chapter_num]
+            chapter_results, generated = self._run_stage3(
+                chapter_num, chapter_title, fragments_with_prompts_per_chapter[chapter_num],
+                chapter_dirs[chapter_num], output_path, generate_images=do_step3 and not skip_generation,
+            )
+            total_generated += generated
+            on_chapter(chapter_num, chapter_title, chapter_results)
+        
+        return total_selected, total_generated
+    
     def process_novel(
         self,
         novel_path: str,
@@ -99,6 +617,7 @@ class NovelIllustrationAgent:
         generate_markdown: bool = True,
         confirm_steps: bool = False,
         run_all: bool = True,
+        use_cache: bool = True,
     ) -> Dict:
         """
         处理完整流程
@@ -111,6 +630,7 @@ class NovelIllustrationAgent:
             generate_markdown: 是否生成 Markdown
             confirm_steps: 是否在每步前询问用户并报价
             run_all: 为 True 时不询问直接执行；为 False 且 confirm_steps 为 True 时每步询问
+            use_cache: 是否按内容哈希复用之前运行的筛选/提示词 LLM 结果
         """
         print("=" * 60)
         print("🚀 开始处理小说插图生成流程")
@@ -123,11 +643,62 @@ class NovelIllustrationAgent:
         model = llm_config.get('model', 'gpt-4o-mini')
         cost_tracker = APICostTracker(model=model)
         
+        # 文本哈希 -> 首次出现的片段，阶段1据此跳过重复片段的 LLM 调用
+        self._seen_fragments: Dict[bytes, Dict] = {}
+        
+        # LLM 结果缓存：重跑时已处理过的片段不再请求；无论完成、中止还是异常都在结束时关闭
+        llm_cache = LLMCache(str(output_path / ".llm_cache.sqlite")) if use_cache else None
+        self._attach_llm_cache(llm_cache)
+        try:
+            return self._process_stages(
+                novel_path,
+                output_dir,
+                output_path,
+                cost_tracker,
+                llm_cache,
+                skip_filter=skip_filter,
+                skip_generation=skip_generation,
+                generate_markdown=generate_markdown,
+                confirm_steps=confirm_steps,
+                run_all=run_all,
+            )
+        finally:
+            self._attach_llm_cache(None)
+            if llm_cache is not None:
+                llm_cache.close()
+    
+    def _attach_llm_cache(self, llm_cache: Optional[LLMCache]):
+        """筛选、提示词生成和人物提取共用同一个 LLM 缓存（None 表示解除）"""
+        self.filter_agent.cache = llm_cache
+        self.prompt_generator.cache = llm_cache
+        self.character_state_machine.cache = llm_cache
+    
+    def _process_stages(
+        self,
+        novel_path: str,
+        output_dir: str,
+        output_path: Path,
+        cost_tracker: APICostTracker,
+        llm_cache: Optional[LLMCache],
+        skip_filter: bool = False,
+        skip_generation: bool = False,
+        generate_markdown: bool = True,
+        confirm_steps: bool = False,
+        run_all: bool = True,
+    ) -> Dict:
+        """process_novel 的主体：加载人物状态、切分小说并执行各阶段（LLM 缓存由调用方打开和关闭）"""
         # 0. 初始化人物状态机（如果存在保存的状态，可以加载）
-        character_state_file = output_path / "character_state.json"
+        csm = self.character_state_machine
+        character_state_file = output_path / csm.STATE_FILE_NAME
+        legacy_state_file = output_path / csm.LEGACY_STATE_FILE_NAME
+        self._character_state_file = character_state_file
         if character_state_file.exists():
             print("\n[初始化] 加载人物状态机...")
-            self.character_state_machine.load(str(character_state_file))
+            csm.load(str(character_state_file))
+        elif legacy_state_file.exists():
+            # 旧版 JSON 状态：加载后首次保存即写为新格式
+            print("\n[初始化] 加载人物状态机（旧版 JSON）...")
+            csm.load(str(legacy_state_file))
         else:
             print("\n[初始化] 创建新的人物状态机...")
         
@@ -152,15 +723,23 @@ class NovelIllustrationAgent:
             }
             total_fragments = len(fragments)
         
+        # 章节顺序、标题和输出目录只计算一次，三个阶段共用
+        chapter_order = sorted(chapters_data)
+        chapter_titles = {num: chapters_data[num]['title'] for num in chapter_order}
+        chapter_dirs = {
+            num: _safe_chapter_dir(output_path, num, chapter_titles[num])
+            for num in chapter_order
+        }
+        
         # ---------- 阶段1：片段打分（人物状态更新 + 筛选）----------
-        step1_estimate_cny = cost_tracker.estimate_step_cost(
-            "step1",
-            num_calls=total_fragments * 2,  # 人物状态 + 筛选 各一次/片段
-            avg_input_chars=1200,
-            avg_output_chars=400,
-        )
         do_step1 = True
         if confirm_steps and not run_all:
+            step1_estimate_cny = cost_tracker.estimate_step_cost(
+                "step1",
+                num_calls=total_fragments * 2,  # 人物状态 + 筛选 各一次/片段
+                avg_input_chars=1200,
+                avg_output_chars=400,
+            )
             print(f"\n📌 步骤 1/3：片段打分（人物状态更新 + 片段筛选）")
             print(f"   预计 API 调用：约 {total_fragments * 2} 次（人物 {total_fragments} + 筛选 {total_fragments}）")
             print(f"   预计费用（qwen 输入 0.012 元/千 tokens）：约 {step1_estimate_cny:.4f} 元")
@@ -171,199 +750,60 @@ class NovelIllustrationAgent:
             elif r == "a":
                 run_all = True
         
-        filtered_per_chapter = {}  # chapter_num -> list of filtered fragments
-        all_results = {}
-        total_selected = 0
-        total_generated = 0
+        prompt_batch_size = self.config.get('prompt_generator', {}).get('batch_size', 1)
         
-        for chapter_num in sorted(chapters_data.keys()):
-            chapter = chapters_data[chapter_num]
-            chapter_title = chapter['title']
-            fragments = chapter['fragments']
-            
-            print(f"\n{'='*60}")
-            print(f"📖 章节 {chapter_num}: {chapter_title}")
-            print(f"{'='*60}")
-            
-            safe_title = re.sub(r'[<>:"/\\|?*]', '_', chapter_title)
-            safe_title = safe_title.strip()[:50]
-            chapter_dir = output_path / f"第{chapter_num}章_{safe_title}"
-            chapter_dir.mkdir(parents=True, exist_ok=True)
-            
-            if do_step1:
-                print(f"\n[步骤 1/3] 人物状态更新 + 片段筛选（章节 {chapter_num}）...")
-                for frag in fragments:
-                    self.character_state_machine.update_character_from_text(
-                        frag['text'],
-                        fragment_index=frag.get('index'),
-                        cost_tracker=cost_tracker,
-                    )
-                if not skip_filter:
-                    filter_config = self.config.get('fragment_filter', {})
-                    if filter_config.get('use_custom_criteria', False):
-                        filtered = self.filter_agent.filter_with_criteria(
-                            fragments,
-                            criteria=filter_config.get('custom_criteria', ''),
-                            min_score=filter_config.get('min_score', 6.0),
-                            max_selected=filter_config.get('max_selected'),
-                            cost_tracker=cost_tracker,
-                        )
-                    else:
-                        filtered = self.filter_agent.filter_batch(
-                            fragments,
-                            min_score=filter_config.get('min_score', 6.0),
-                            max_selected=filter_config.get('max_selected'),
-                            cost_tracker=cost_tracker,
-                        )
-                else:
-                    filtered = fragments
-                    for frag in filtered:
-                        frag['filter_result'] = {
-                            'selected': True,
-                            'score': 5.0,
-                            'reason': '未筛选',
-                            'visual_description': frag['text'][:200]
-                        }
-                print(f"✅ 章节 {chapter_num} 选中 {len(filtered)} 个片段")
-            else:
-                filtered = fragments
-                for frag in filtered:
-                    frag['filter_result'] = {
-                        'selected': True,
-                        'score': 5.0,
-                        'reason': '未筛选',
-                        'visual_description': frag['text'][:200]
-                    }
-            
-            filtered_per_chapter[chapter_num] = filtered
-            total_selected += len(filtered)
+        # 章节结果逐章追加写入 overview.jsonl，不在内存中累积全书结果
+        save_metadata = self.config.get('output', {}).get('save_metadata', True)
+        overview_jsonl = output_path / "overview.jsonl"
+        overview_f = open(overview_jsonl, 'wb') if save_metadata else None
         
-        # ---------- 阶段2：提示词生成 ----------
-        step2_estimate_cny = cost_tracker.estimate_step_cost(
-            "step2",
-            num_calls=total_selected,
-            avg_input_chars=1000,
-            avg_output_chars=300,
-        )
-        do_step2 = True
-        if confirm_steps and not run_all:
-            print(f"\n📌 步骤 2/3：Prompt 生成")
-            print(f"   预计 API 调用：约 {total_selected} 次")
-            print(f"   预计费用：约 {step2_estimate_cny:.4f} 元")
-            r = input("   Proceed? (y=yes / n=abort / a=run all): ").strip().lower()
-            if r == "n":
-                print("\n   Aborted by user.")
-                return {'aborted': True}
-            elif r == "a":
-                run_all = True
+        def record_chapter(chapter_num: int, chapter_title: str, chapter_results: List[Dict]):
+            if overview_f is not None:
+                record = {'chapter_num': chapter_num, 'title': chapter_title, 'results': chapter_results}
+                overview_f.write(_json_line(record))
+                overview_f.flush()
         
-        fragments_with_prompts_per_chapter = {}
-        for chapter_num in sorted(chapters_data.keys()):
-            chapter = chapters_data[chapter_num]
-            chapter_title = chapter['title']
-            filtered = filtered_per_chapter[chapter_num]
-            
-            if do_step2:
-                print(f"\n[步骤 2/3] 生成提示词（章节 {chapter_num}）...")
-                fragments_with_prompts = self.prompt_generator.batch_generate(
-                    filtered,
+        # 无需逐步确认时，章节在三个阶段间流水线执行；逐步确认需要全书统计，保持阶段屏障
+        pipelined = (
+            not (confirm_steps and not run_all)
+            and self.config.get('novel_processor', {}).get('pipeline_chapters', True)
+        )
+        try:
+            if pipelined:
+                totals = self._run_pipelined(
+                    chapters_data,
+                    chapter_order,
+                    chapter_titles,
+                    chapter_dirs,
+                    output_path,
+                    record_chapter,
+                    skip_filter=skip_filter,
+                    skip_generation=skip_generation,
                     cost_tracker=cost_tracker,
+                    prompt_batch_size=prompt_batch_size,
                 )
             else:
-                fragments_with_prompts = self.prompt_generator.batch_generate(
-                    filtered,
-                    cost_tracker=None,
+                totals = self._run_barrier(
+                    chapters_data,
+                    chapter_order,
+                    chapter_titles,
+                    chapter_dirs,
+                    output_path,
+                    record_chapter,
+                    do_step1=do_step1,
+                    skip_filter=skip_filter,
+                    skip_generation=skip_generation,
+                    cost_tracker=cost_tracker,
+                    prompt_batch_size=prompt_batch_size,
+                    confirm_steps=confirm_steps,
+                    run_all=run_all,
                 )
-            
-            fragments_with_prompts_per_chapter[chapter_num] = (chapter_title, fragments_with_prompts)
-        
-        # ---------- 阶段3：生成插图 ----------
-        do_step3 = True
-        if confirm_steps and not run_all:
-            print(f"\n📌 步骤 3/3：生成插图（本地 SD 模型）")
-            print(f"   预计生成图片：{total_selected} 张")
-            print(f"   费用：0 元（本地模型）")
-            r = input("   Proceed? (y=yes / n=abort / a=run all): ").strip().lower()
-            if r == "n":
-                print("\n   Aborted by user.")
-                return {'aborted': True}
-            elif r == "a":
-                run_all = True
-        
-        for chapter_num in sorted(chapters_data.keys()):
-            chapter_title, fragments_with_prompts = fragments_with_prompts_per_chapter[chapter_num]
-            safe_title = re.sub(r'[<>:"/\\|?*]', '_', chapter_title)
-            safe_title = safe_title.strip()[:50]
-            chapter_dir = output_path / f"第{chapter_num}章_{safe_title}"
-            chapter_results = []
-            
-            if do_step3 and not skip_generation:
-                print(f"\n[步骤 4/4] 生成插图（章节 {chapter_num}）...")
-                for i, fragment in enumerate(fragments_with_prompts):
-                    print(f"\n生成插图 {i+1}/{len(fragments_with_prompts)} (章节 {chapter_num})")
-                    print(f"片段索引: {fragment['index']}")
-                    print(f"原文: {fragment['text'][:100]}...")
-                    
-                    prompts = fragment['prompts']
-                    
-                    # 生成文件名（在章节内重新编号）
-                    filename = f"illustration_{i+1:04d}.png"
-                    
-                    # 调用SD生成图片（指定章节目录）
-                    image_path = self.sd_client.generate_illustration(
-                        prompt=prompts['positive_prompt'],
-                        negative_prompt=prompts['negative_prompt'],
-                        output_filename=filename,
-                        output_dir=str(chapter_dir)
-                    )
-                    
-                    fragment['image_path'] = image_path
-                    fragment['generated'] = image_path is not None
-                    
-                    # 转换为相对路径（相对于输出目录）
-                    if image_path:
-                        rel_path = Path(image_path).relative_to(output_path)
-                        image_path = str(rel_path)
-                    
-                    chapter_results.append({
-                        'index': fragment['index'],
-                        'chapter_num': chapter_num,
-                        'chapter_title': chapter_title,
-                        'text': fragment['text'],
-                        'image_path': image_path,
-                        'prompts': prompts,
-                        'filter_score': fragment.get('filter_result', {}).get('score', 0),
-                        'generated': image_path is not None
-                    })
-                    
-                    if image_path:
-                        total_generated += 1
-            else:
-                print(f"\n[步骤 4/4] 跳过图片生成")
-                # 为每个片段创建结果字典
-                for fragment in fragments_with_prompts:
-                    chapter_results.append({
-                        'index': fragment['index'],
-                        'chapter_num': chapter_num,
-                        'chapter_title': chapter_title,
-                        'text': fragment['text'],
-                        'image_path': None,
-                        'prompts': fragment.get('prompts', {}),
-                        'filter_score': fragment.get('filter_result', {}).get('score', 0),
-                        'generated': False
-                    })
-            
-            # 保存章节元数据
-            if self.config.get('output', {}).get('save_metadata', True):
-                metadata_file = chapter_dir / "metadata.json"
-                with open(metadata_file, 'w', encoding='utf-8') as f:
-                    json.dump(chapter_results, f, ensure_ascii=False, indent=2)
-                print(f"\n✅ 章节 {chapter_num} 元数据已保存至: {metadata_file}")
-            
-            all_results[chapter_num] = {
-                'title': chapter_title,
-                'results': chapter_results
-            }
+        finally:
+            if overview_f is not None:
+                overview_f.close()
+        if totals is None:
+            return {'aborted': True}
+        total_selected, total_generated = totals
         
         # 保存人物状态机
         self.character_state_machine.save(str(character_state_file))
@@ -377,14 +817,16 @@ class NovelIllustrationAgent:
                 'total_fragments': total_fragments,
                 'total_selected': total_selected,
                 'total_generated': total_generated,
-                'chapters': all_results
+                'chapters_file': overview_jsonl.name
             }
-            with open(overview_file, 'w', encoding='utf-8') as f:
-                json.dump(overview_data, f, ensure_ascii=False, indent=2)
+            _write_json(overview_file, overview_data)
             print(f"\n✅ 总览元数据已保存至: {overview_file}")
         
-        # API 消耗汇总
+        # API 消耗汇总（先合并各工作线程的记录）
+        cost_tracker.flush()
         print("\n" + cost_tracker.get_summary())
+        if llm_cache is not None:
+            print(f"  LLM 缓存: 命中 {llm_cache.hits} 次，未命中 {llm_cache.misses} 次")
         
         # 生成Markdown文件
         md_file_path = None
@@ -393,7 +835,8 @@ class NovelIllustrationAgent:
             print("📝 生成Markdown文件...")
             print("=" * 60)
             try:
-                md_generator = MarkdownGenerator(output_dir=output_dir)
+                from src.markdown_generator import MarkdownGenerator
+                md_generator = MarkdownGenerator(output_dir=output_dir, max_workers=os.cpu_count() or 4)
                 md_file_path = md_generator.generate_markdown(
                     novel_path=novel_path,
                     output_dir=output_dir,
@@ -414,11 +857,35 @@ class NovelIllustrationAgent:
             'total_fragments': total_fragments,
             'selected_fragments': total_selected,
             'generated_images': total_generated,
-            'chapters': all_results,
+            'chapters_file': str(overview_jsonl) if save_metadata else None,
             'markdown_file': md_file_path
         }
 
 
+_QUIET_LOGGERS = ("httpx", "httpcore", "openai", "urllib3")
+
+
+def _setup_logging(output_dir: str):
+    """控制台输出 INFO 及以上；逐片段的 DEBUG 细节写入输出目录下的滚动日志文件"""
+    log_dir = Path(output_dir)
+    log_dir.mkdir(parents=True, exist_ok=True)
+    file_handler = RotatingFileHandler(
+        log_dir / "novel_agent.log", maxBytes=5 * 1024 * 1024, backupCount=3, encoding='utf-8'
+    )
+    file_handler.setLevel(logging.DEBUG)
+    file_handler.setFormatter(logging.Formatter("%(asctime)s %(levelname)s %(name)s: %(message)s"))
+    stream_handler = logging.StreamHandler()
+    stream_handler.setLevel(logging.INFO)
+    stream_handler.setFormatter(logging.Formatter("%(message)s"))
+    root = logging.getLogger()
+    root.setLevel(logging.DEBUG)
+    root.addHandler(file_handler)
+    root.addHandler(stream_handler)
+    # HTTP 客户端库会逐请求打 INFO/DEBUG 日志
+    for name in _QUIET_LOGGERS:
+        logging.getLogger(name).setLevel(logging.WARNING)
+
+
 def main():
     """主函数"""
     parser = argparse.ArgumentParser(description='Agent Novel - 小说插图生成工具')
@@ -429,6 +896,7 @@ def main():
     parser.add_argument('--skip-generation', action='store_true', help='跳过图片生成（只生成提示词）')
     parser.add_argument('--skip-markdown', action='store_true', help='跳过 Markdown 文件生成')
     parser.add_argument('--confirm', action='store_true', help='每步前询问并显示预计费用（y/n/a 一键执行后续）')
+    parser.add_argument('--no-cache', action='store_true', help='不使用 LLM 结果缓存（输出目录下的 .llm_cache.sqlite）')
     parser.add_argument('--run-all', action='store_true', help='一键执行，不询问（默认即不询问；与 --confirm 同用时先询问，选 a 后等效）')
     
     args = parser.parse_args()
@@ -439,6 +907,8 @@ def main():
         print(f"❌ 错误: 小说文件不存在: {args.novel}")
         return
     
+    _setup_logging(args.output)
+    
     # 创建Agent并处理
     agent = NovelIllustrationAgent(config_path=args.config)
     result = agent.process_novel(
@@ -449,6 +919,7 @@ def main():
         generate_markdown=not args.skip_markdown,
         confirm_steps=args.confirm,
         run_all=not args.confirm or args.run_all,
+        use_cache=not args.no_cache,
     )
     
     # 打印统计信息
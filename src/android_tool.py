@@ -3,22 +3,80 @@ Android automation helpers based on ADB + optional uiautomator2.
 """
 from __future__ import annotations
 
+import io
+import os
+import queue
 import re
+import shlex
+import shutil
 import subprocess
-import uuid
+import threading
+import time
+import xml.etree.ElementTree as ET
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
-from typing import Any, Dict, Optional
+from typing import Any, Dict, Optional, Tuple
 
-try:
-    import uiautomator2 as u2  # type: ignore
-except Exception:  # pragma: no cover - optional dependency
-    u2 = None
+# uiautomator2 pulls in adbutils/requests/lxml; import it only when a session needs a driver.
+_u2: Any = None
+_u2_tried = False
 
 
-_SESSIONS: Dict[str, Dict[str, Any]] = {}
+def _get_u2() -> Any:
+    global _u2, _u2_tried
+    if not _u2_tried:
+        _u2_tried = True
+        try:
+            import uiautomator2 as u2  # type: ignore
+            _u2 = u2
+        except Exception:  # pragma: no cover - optional dependency
+            _u2 = None
+    return _u2
+
 
+# adbutils talks to the local adb server over its socket protocol, so shell/get-state/devices
+# need no adb fork. Falls back to the adb CLI when missing or when the server isn't reachable.
+_adb_client: Any = None
+_adb_client_tried = False
+
+
+def _get_adb_client() -> Any:
+    global _adb_client, _adb_client_tried
+    if not _adb_client_tried:
+        _adb_client_tried = True
+        try:
+            import adbutils  # type: ignore
+            client = adbutils.AdbClient(host="127.0.0.1", port=5037)
+            client.server_version()  # the CLI would auto-start the server; adbutils won't
+            _adb_client = client
+        except Exception:  # pragma: no cover - optional dependency
+            _adb_client = None
+    return _adb_client
 
-def _run_adb(args: list[str], timeout_s: int = 20) -> subprocess.CompletedProcess:
+
+_SESSIONS: Dict[str, Dict[str, Any]] = {}
+_BOUNDS_RE = re.compile(r"\[(\d+),(\d+)\]\[(\d+),(\d+)\]")
+_WM_SIZE_RE = re.compile(r"(\d+)x(\d+)")
+_KEYMAP = {"back": "4", "home": "3", "enter": "66", "recent": "187"}
+_ADB_IME = "com.android.adbkeyboard/.AdbIME"
+
+# Devices change on human timescales, so cache them briefly instead of forking
+# `adb devices` on every action.
+_DEVICES_TTL_S = 3.0
+_NO_DEVICES_TTL_S = 1.0  # an empty list goes stale faster: someone may be plugging a device in
+_DEVICES_CACHE: Dict[str, Any] = {"t": 0.0, "val": None}
+# device_id -> (width, height) in the natural (rotation 0) orientation; never changes.
+_SCREEN_CACHE: Dict[str, Tuple[int, int]] = {}
+# device_id -> (timestamp, rotation). Apps switch to landscape at will, so rotation is only
+# trusted for about a second: enough to cover a burst of taps/swipes, short enough to follow a turn.
+_ROTATION_TTL_S = 1.0
+_ROTATION_CACHE: Dict[str, Tuple[float, int]] = {}
+_ROTATION_RE = re.compile(r"SurfaceOrientation:\s*(\d)")
+# device_id -> uiautomator2 driver connected ahead of time by warm_sessions()
+_WARM_DRIVERS: Dict[str, Any] = {}
+
+
+def _run_adb_text(args: list[str], timeout_s: int = 20) -> subprocess.CompletedProcess:
     return subprocess.run(
         ["adb"] + args,
         capture_output=True,
@@ -29,21 +87,114 @@ def _run_adb(args: list[str], timeout_s: int = 20) -> subprocess.CompletedProces
     )
 
 
+class _ShellChannel:
+    """A long-lived `adb -s <did> shell` child; commands are piped through stdin.
+
+    Each command is followed by an echo of a unique sentinel plus its exit status,
+    and stdout is read until that sentinel shows up. stderr is merged into stdout.
+    """
+
+    def __init__(self, device_id: str):
+        self.device_id = device_id
+        self._marker = f"__END_{os.urandom(8).hex()}__"
+        self._lock = threading.Lock()
+        self._lines: "queue.Queue[Optional[str]]" = queue.Queue()
+        self.proc = subprocess.Popen(
+            ["adb", "-s", device_id, "shell"],
+            stdin=subprocess.PIPE,
+            stdout=subprocess.PIPE,
+            stderr=subprocess.STDOUT,
+            bufsize=0,
+        )
+        # Reader thread lets run() honour a timeout instead of blocking on readline().
+        threading.Thread(target=self._pump, name=f"adb-shell-{device_id}", daemon=True).start()
+
+    def _pump(self) -> None:
+        for raw in iter(self.proc.stdout.readline, b""):
+            self._lines.put(raw.decode("utf-8", errors="replace"))
+        self._lines.put(None)
+
+    @property
+    def alive(self) -> bool:
+        return self.proc.poll() is None
+
+    def run(self, cmd: str, timeout_s: float = 20) -> tuple[int, str]:
+        with self._lock:
+            self.proc.stdin.write(f"{cmd}; echo {self._marker}$?\n".encode("utf-8"))
+            self.proc.stdin.flush()
+            out: list[str] = []
+            while True:
+                try:
+                    line = self._lines.get(timeout=timeout_s)
+                except queue.Empty:
+                    self.close()
+                    raise subprocess.TimeoutExpired(cmd, timeout_s)
+                if line is None:
+                    raise RuntimeError("adb shell exited")
+                idx = line.find(self._marker)
+                if idx < 0:
+                    out.append(line)
+                    continue
+                # Output without a trailing newline lands on the sentinel line.
+                out.append(line[:idx])
+                rc = int(line[idx + len(self._marker):].strip() or 1)
+                return rc, "".join(out)
+
+    def close(self) -> None:
+        try:
+            self.proc.stdin.close()
+            self.proc.wait(timeout=2)
+        except Exception:
+            self.proc.kill()
+
+
+def _run_adb_shell(sess: Dict[str, Any], argv: list[str], timeout_s: int = 20) -> subprocess.CompletedProcess:
+    """Run `adb shell <argv>` via adbutils, or else through the session's persistent shell channel.
+
+    Returns a CompletedProcess so callers can treat it like `_run_adb_text`; since the
+    channel merges stderr into stdout, the output is also reported as stderr on failure.
+    """
+    # `adb shell a b c` joins argv with spaces for the device shell; do the same.
+    cmd = " ".join(argv)
+    client = _get_adb_client()
+    if client is not None:
+        ret = client.device(sess["device_id"]).shell2(cmd, timeout=timeout_s)
+        out = ret.output or ""
+        return subprocess.CompletedProcess(["shell", cmd], ret.returncode, stdout=out,
+                                           stderr=out if ret.returncode != 0 else "")
+    channel = sess.get("shell")
+    if channel is None or not channel.alive:
+        channel = sess["shell"] = _ShellChannel(sess["device_id"])
+    try:
+        rc, out = channel.run(cmd, timeout_s=timeout_s)
+    except Exception:
+        sess.pop("shell", None)
+        raise
+    return subprocess.CompletedProcess(["shell", cmd], rc, stdout=out, stderr=out if rc != 0 else "")
+
+
 def list_devices() -> Dict[str, Any]:
+    cached = _DEVICES_CACHE["val"]
+    ttl = _DEVICES_TTL_S if cached else _NO_DEVICES_TTL_S
+    if cached is not None and time.monotonic() - _DEVICES_CACHE["t"] < ttl:
+        return {"success": True, "devices": list(cached)}
+    client = _get_adb_client()
+    if client is not None:
+        try:
+            devices = [d.serial for d in client.list() if d.state == "device"]
+            _DEVICES_CACHE["t"], _DEVICES_CACHE["val"] = time.monotonic(), list(devices)
+            return {"success": True, "devices": devices}
+        except Exception:
+            pass
     try:
-        p = _run_adb(["devices"], timeout_s=10)
+        p = _run_adb_text(["devices"], timeout_s=10)
     except Exception as e:
         return {"success": False, "error": "adb_not_available", "message": str(e), "devices": []}
     if p.returncode != 0:
         return {"success": False, "error": "adb_error", "message": p.stderr.strip(), "devices": []}
-    devices: list[str] = []
-    for line in (p.stdout or "").splitlines()[1:]:
-        line = line.strip()
-        if not line:
-            continue
-        parts = line.split()
-        if len(parts) >= 2 and parts[1] == "device":
-            devices.append(parts[0])
+    rows = [line.split(None, 1) for line in (p.stdout or "").splitlines()[1:]]
+    devices = [r[0] for r in rows if len(r) == 2 and r[1].strip() == "device"]
+    _DEVICES_CACHE["t"], _DEVICES_CACHE["val"] = time.monotonic(), list(devices)
     return {"success": True, "devices": devices}
 
 
@@ -51,25 +202,93 @@ def _get_device_for_session(session_id: str) -> Optional[Dict[str, Any]]:
     return _SESSIONS.get(session_id)
 
 
-def start_session(device_id: Optional[str] = None) -> Dict[str, Any]:
-    listed = list_devices()
-    if not listed.get("success"):
-        return listed
-    devices = listed.get("devices", [])
-    if not devices:
-        return {"success": False, "error": "no_device", "message": "No Android device connected via ADB"}
-    chosen = device_id or devices[0]
-    if chosen not in devices:
-        return {"success": False, "error": "device_not_found", "device_id": chosen, "devices": devices}
+def _warm_one(u2: Any, device_id: str) -> Dict[str, Any]:
+    driver = u2.connect(device_id)
+    info = driver.info
+    w, h = info.get("displayWidth", 0), info.get("displayHeight", 0)
+    if w and h:
+        _remember_display(device_id, w, h, info.get("displayRotation", 0))
+    _WARM_DRIVERS[device_id] = driver
+    return {"success": True, "width": w, "height": h}
+
+
+def warm_sessions(device_ids: list[str]) -> Dict[str, Any]:
+    """Connect uiautomator2 to several devices in parallel so later start_session calls are instant."""
+    if not device_ids:
+        return {"success": True, "devices": {}}
+    u2 = _get_u2()
+    if u2 is None:
+        return {"success": False, "error": "uiautomator2_required", "devices": {}}
+
+    def probe(did: str) -> Dict[str, Any]:
+        try:
+            return _warm_one(u2, did)
+        except Exception as e:
+            return {"success": False, "error": "connect_failed", "message": str(e)}
+
+    with ThreadPoolExecutor(max_workers=min(8, len(device_ids))) as pool:
+        results = dict(zip(device_ids, pool.map(probe, device_ids)))
+    return {"success": True, "devices": results}
 
-    driver = None
+
+def _configure_driver(driver: Any, idle_timeout_ms: int, selector_timeout_ms: int) -> None:
+    """Shorten uiautomator2's idle/selector waits, which default to seconds and stall on dynamic screens."""
+    try:
+        driver.settings["wait_timeout"] = selector_timeout_ms / 1000.0
+        driver.jsonrpc.setConfigurator({
+            "waitForIdleTimeout": idle_timeout_ms,
+            "waitForSelectorTimeout": selector_timeout_ms,
+            "actionAcknowledgmentTimeout": idle_timeout_ms,
+        })
+    except Exception:
+        pass
+
+
+def _device_ready(device_id: str) -> bool:
+    """Cheap check for one known id via `adb get-state` instead of listing every device."""
+    client = _get_adb_client()
+    if client is not None:
+        try:
+            return client.device(device_id).get_state() == "device"
+        except Exception:
+            return False
+    try:
+        p = _run_adb_text(["-s", device_id, "get-state"], timeout_s=3)
+    except Exception:
+        return False
+    return p.returncode == 0 and (p.stdout or "").strip() == "device"
+
+
+def start_session(
+    device_id: Optional[str] = None,
+    idle_timeout_ms: int = 100,
+    selector_timeout_ms: int = 100,
+) -> Dict[str, Any]:
+    if device_id and _device_ready(device_id):
+        chosen = device_id
+    else:
+        listed = list_devices()
+        if not listed.get("success"):
+            return listed
+        devices = listed.get("devices", [])
+        if not devices:
+            return {"success": False, "error": "no_device", "message": "No Android device connected via ADB"}
+        chosen = device_id or devices[0]
+        if chosen not in devices:
+            return {"success": False, "error": "device_not_found", "device_id": chosen, "devices": devices}
+
+    driver = _WARM_DRIVERS.pop(chosen, None)
+    u2 = _get_u2() if driver is None else None
     if u2 is not None:
         try:
             driver = u2.connect(chosen)
         except Exception:
             driver = None
+    if driver is not None:
+        _configure_driver(driver, idle_timeout_ms, selector_timeout_ms)
 
-    sid = str(uuid.uuid4())
+    # Ids are only used as dict keys; no need for the uuid module.
+    sid = os.urandom(8).hex()
     _SESSIONS[sid] = {"device_id": chosen, "driver": driver}
     return {"success": True, "session_id": sid, "device_id": chosen, "driver": "uiautomator2" if driver else "adb"}
 
@@ -78,6 +297,17 @@ def stop_session(session_id: str) -> Dict[str, Any]:
     sess = _SESSIONS.pop(session_id, None)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    prev_ime = sess.get("prev_ime")
+    if prev_ime:
+        try:
+            _run_adb_shell(sess, ["ime", "set", prev_ime], timeout_s=5)
+        except Exception:
+            pass
+    channel = sess.get("shell")
+    if channel is not None:
+        channel.close()
+    _SCREEN_CACHE.pop(sess.get("device_id"), None)
+    _ROTATION_CACHE.pop(sess.get("device_id"), None)
     return {"success": True, "device_id": sess.get("device_id")}
 
 
@@ -85,7 +315,6 @@ def open_app(session_id: str, package: str) -> Dict[str, Any]:
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    did = sess["device_id"]
     driver = sess.get("driver")
     if driver is not None:
         try:
@@ -94,7 +323,7 @@ def open_app(session_id: str, package: str) -> Dict[str, Any]:
         except Exception:
             pass
     try:
-        p = _run_adb(["-s", did, "shell", "monkey", "-p", package, "-c", "android.intent.category.LAUNCHER", "1"])
+        p = _run_adb_shell(sess, ["monkey", "-p", package, "-c", "android.intent.category.LAUNCHER", "1"])
         if p.returncode != 0:
             return {"success": False, "error": "adb_error", "message": p.stderr.strip(), "package": package}
         return {"success": True, "package": package, "method": "adb_monkey"}
@@ -107,7 +336,6 @@ def wait(session_id: str, wait_ms: int = 1000) -> Dict[str, Any]:
     if not sess:
         return {"success": False, "error": "session_not_found"}
     try:
-        import time
         time.sleep(max(0, wait_ms) / 1000.0)
         return {"success": True, "wait_ms": wait_ms}
     except Exception as e:
@@ -135,11 +363,33 @@ def tap_text(session_id: str, text: str) -> Dict[str, Any]:
         return {"success": False, "error": "tap_failed", "text": text, "message": str(e)}
 
 
+def _adb_ime_input(sess: Dict[str, Any], text: str, clear: bool = False) -> bool:
+    """Type via ADBKeyboard's broadcast (one call for the whole string, handles non-ASCII).
+
+    The IME is checked and selected once per session; the previous IME is restored in stop_session.
+    Returns False when ADBKeyboard isn't installed so the caller can fall back to `input text`.
+    """
+    if "adb_ime" not in sess:
+        sess["adb_ime"] = False
+        p = _run_adb_shell(sess, ["ime", "list", "-s"], timeout_s=5)
+        if p.returncode == 0 and _ADB_IME in p.stdout.split():
+            prev = _run_adb_shell(sess, ["settings", "get", "secure", "default_input_method"], timeout_s=5)
+            if _run_adb_shell(sess, ["ime", "set", _ADB_IME], timeout_s=5).returncode == 0:
+                sess["adb_ime"] = True
+                if prev.returncode == 0 and prev.stdout.strip() not in ("", "null", _ADB_IME):
+                    sess["prev_ime"] = prev.stdout.strip()
+    if not sess["adb_ime"]:
+        return False
+    if clear and _run_adb_shell(sess, ["am", "broadcast", "-a", "ADB_CLEAR_TEXT"]).returncode != 0:
+        return False
+    p = _run_adb_shell(sess, ["am", "broadcast", "-a", "ADB_INPUT_TEXT", "--es", "msg", shlex.quote(text)])
+    return p.returncode == 0
+
+
 def input_text(session_id: str, text: str, clear: bool = False) -> Dict[str, Any]:
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    did = sess["device_id"]
     driver = sess.get("driver")
     if driver is not None:
         try:
@@ -149,9 +399,14 @@ def input_text(session_id: str, text: str, clear: bool = False) -> Dict[str, Any
             return {"success": True, "method": "uiautomator2_send_keys"}
         except Exception:
             pass
+    try:
+        if _adb_ime_input(sess, text, clear=clear):
+            return {"success": True, "method": "adb_ime_broadcast"}
+    except Exception:
+        pass
     safe = text.replace(" ", "%s")
     try:
-        p = _run_adb(["-s", did, "shell", "input", "text", safe])
+        p = _run_adb_shell(sess, ["input", "text", safe])
         if p.returncode != 0:
             return {"success": False, "error": "adb_error", "message": p.stderr.strip()}
         return {"success": True, "method": "adb_input_text"}
@@ -163,11 +418,9 @@ def press_key(session_id: str, key: str) -> Dict[str, Any]:
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    did = sess["device_id"]
-    keymap = {"back": "4", "home": "3", "enter": "66", "recent": "187"}
-    code = keymap.get(key.lower(), key)
+    code = _KEYMAP.get(key.lower(), key)
     try:
-        p = _run_adb(["-s", did, "shell", "input", "keyevent", str(code)])
+        p = _run_adb_shell(sess, ["input", "keyevent", str(code)])
         if p.returncode != 0:
             return {"success": False, "error": "adb_error", "message": p.stderr.strip(), "key": key}
         return {"success": True, "key": key}
@@ -179,22 +432,32 @@ def dump_ui(session_id: str, max_chars: int = 20000) -> Dict[str, Any]:
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found", "xml": ""}
-    did = sess["device_id"]
     driver = sess.get("driver")
     if driver is not None:
         try:
             xml = driver.dump_hierarchy(compressed=False) or ""
-            xml = xml[:max_chars] + ("\n... (truncated)" if len(xml) > max_chars else "")
+            if len(xml) > max_chars:
+                xml = xml[:max_chars] + "\n... (truncated)"
             return {"success": True, "xml": xml, "method": "uiautomator2_dump"}
         except Exception:
             pass
     try:
-        p1 = _run_adb(["-s", did, "shell", "uiautomator", "dump", "/sdcard/uidump.xml"])
-        if p1.returncode != 0:
-            return {"success": False, "error": "adb_error", "message": p1.stderr.strip(), "xml": ""}
-        p2 = _run_adb(["-s", did, "shell", "cat", "/sdcard/uidump.xml"])
-        xml = (p2.stdout or "").strip()
-        xml = xml[:max_chars] + ("\n... (truncated)" if len(xml) > max_chars else "")
+        # Stream the dump straight to host stdout instead of writing to /sdcard and cat-ing it back.
+        p = subprocess.run(
+            ["adb", "-s", sess["device_id"], "exec-out", "uiautomator", "dump", "/dev/tty"],
+            capture_output=True,
+            timeout=10,
+        )
+        raw = p.stdout or b""
+        start = raw.find(b"<?xml")
+        if p.returncode != 0 or start < 0:
+            message = (p.stderr or b"").decode(errors="ignore").strip() or raw.decode(errors="ignore").strip()
+            return {"success": False, "error": "adb_error", "message": message, "xml": ""}
+        # uiautomator appends "UI hierchary dumped to: /dev/tty" after the document.
+        end = raw.rfind(b">")
+        xml = raw[start:end + 1].decode("utf-8", errors="replace")
+        if len(xml) > max_chars:
+            xml = xml[:max_chars] + "\n... (truncated)"
         return {"success": True, "xml": xml, "method": "adb_uiautomator_dump"}
     except Exception as e:
         return {"success": False, "error": "dump_failed", "message": str(e), "xml": ""}
@@ -202,8 +465,12 @@ def dump_ui(session_id: str, max_chars: int = 20000) -> Dict[str, Any]:
 
 def _coerce_int(val: Any) -> int:
     """Coerce value to int, handling lists like [540, 2299] from malformed LLM calls."""
+    if isinstance(val, int) and not isinstance(val, bool):
+        return val
+    if isinstance(val, float):
+        return int(val)
     if isinstance(val, (list, tuple)):
-        val = val[0] if len(val) == 1 else val[0]
+        val = val[0]
     return int(float(str(val).strip()))
 
 
@@ -219,9 +486,9 @@ def tap_coordinates(session_id: str, x: Any = 0, y: Any = 0) -> Dict[str, Any]:
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    did = sess["device_id"]
     driver = sess.get("driver")
-    disp = _get_display_info(session_id) or {}
+    # Only reported back for logging, so don't query the device for it.
+    disp = _cached_display_info(sess["device_id"]) or {}
     screen_info = f"{disp.get('width', '?')}x{disp.get('height', '?')} rot={disp.get('rotation', '?')}"
     if driver is not None:
         try:
@@ -230,7 +497,7 @@ def tap_coordinates(session_id: str, x: Any = 0, y: Any = 0) -> Dict[str, Any]:
         except Exception:
             pass
     try:
-        p = _run_adb(["-s", did, "shell", "input", "tap", str(x), str(y)])
+        p = _run_adb_shell(sess, ["input", "tap", str(x), str(y)])
         if p.returncode != 0:
             return {"success": False, "error": "adb_error", "message": f"adb input tap {x} {y} failed: {p.stderr.strip()}"}
         return {"success": True, "x": x, "y": y, "screen": screen_info, "method": "adb_input_tap"}
@@ -282,34 +549,31 @@ def tap_content_desc(session_id: str, desc: str) -> Dict[str, Any]:
         return {"success": False, "error": "tap_failed", "desc": desc, "message": str(e)}
 
 
+def _swipe_coords(w: int, h: int, direction: str, d: float) -> Tuple[int, int, int, int]:
+    """Start/end points of a swipe centred on the screen, covering d*0.8 of the axis."""
+    cx, cy = w // 2, h // 2
+    if direction == "up":
+        return cx, int(cy + h * d * 0.4), cx, int(cy - h * d * 0.4)
+    if direction == "down":
+        return cx, int(cy - h * d * 0.4), cx, int(cy + h * d * 0.4)
+    if direction == "left":
+        return int(cx + w * d * 0.4), cy, int(cx - w * d * 0.4), cy
+    return int(cx - w * d * 0.4), cy, int(cx + w * d * 0.4), cy
+
+
 def swipe(session_id: str, direction: str = "up", distance_pct: float = 0.5, duration_ms: int = 300) -> Dict[str, Any]:
     """Swipe in a direction. direction: up/down/left/right. distance_pct: 0.0-1.0 fraction of screen."""
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    did = sess["device_id"]
     driver = sess.get("driver")
     direction = direction.lower()
     if direction not in ("up", "down", "left", "right"):
         return {"success": False, "error": "invalid_direction", "message": "direction must be up/down/left/right"}
-    if driver is not None:
-        try:
-            info = driver.info
-            w = info.get("displayWidth", 1080)
-            h = info.get("displayHeight", 1920)
-        except Exception:
-            w, h = 1080, 1920
-    else:
-        w, h = 1080, 1920
-    cx, cy = w // 2, h // 2
-    d = distance_pct
-    coord_map = {
-        "up":    (cx, int(cy + h * d * 0.4), cx, int(cy - h * d * 0.4)),
-        "down":  (cx, int(cy - h * d * 0.4), cx, int(cy + h * d * 0.4)),
-        "left":  (int(cx + w * d * 0.4), cy, int(cx - w * d * 0.4), cy),
-        "right": (int(cx - w * d * 0.4), cy, int(cx + w * d * 0.4), cy),
-    }
-    x1, y1, x2, y2 = coord_map[direction]
+    disp = _get_display_info(session_id) or {}
+    w = disp.get("width", 1080)
+    h = disp.get("height", 1920)
+    x1, y1, x2, y2 = _swipe_coords(w, h, direction, distance_pct)
     if driver is not None:
         try:
             driver.swipe(x1, y1, x2, y2, duration=duration_ms / 1000.0)
@@ -317,7 +581,7 @@ def swipe(session_id: str, direction: str = "up", distance_pct: float = 0.5, dur
         except Exception:
             pass
     try:
-        p = _run_adb(["-s", did, "shell", "input", "swipe",
+        p = _run_adb_shell(sess, ["input", "swipe",
                        str(x1), str(y1), str(x2), str(y2), str(duration_ms)])
         if p.returncode != 0:
             return {"success": False, "error": "adb_error", "message": p.stderr.strip()}
@@ -336,74 +600,111 @@ def find_elements(session_id: str, text: str = "", resource_id: str = "",
     if driver is None:
         return {"success": False, "error": "uiautomator2_required", "elements": []}
     try:
-        kwargs: Dict[str, Any] = {}
-        if text:
-            kwargs["textContains"] = text
-        if resource_id:
-            kwargs["resourceIdMatches"] = f".*{resource_id}.*"
-        if content_desc:
-            kwargs["descriptionContains"] = content_desc
-        if class_name:
-            kwargs["className"] = class_name
-        if not kwargs:
+        if not (text or resource_id or content_desc or class_name):
             return {"success": False, "error": "no_criteria", "message": "Provide at least one of: text, resource_id, content_desc, class_name", "elements": []}
-        selector = driver(**kwargs)
-        count = min(selector.count, max_results)
+        # One hierarchy dump, filtered locally, instead of a JSON-RPC round trip per selector/.info call.
+        # Not compressed: uiautomator2 selectors search the uncompressed tree as well.
+        xml = driver.dump_hierarchy(compressed=False) or ""
+        rid_re = re.compile(re.escape(resource_id)) if resource_id else None
         elements = []
-        for i in range(count):
-            el = selector[i]
-            try:
-                info = el.info
-                bounds = info.get("bounds", {})
-                elements.append({
-                    "index": i,
-                    "text": info.get("text", ""),
-                    "resource_id": info.get("resourceName", ""),
-                    "content_desc": info.get("contentDescription", ""),
-                    "class_name": info.get("className", ""),
-                    "bounds": {
-                        "left": bounds.get("left", 0),
-                        "top": bounds.get("top", 0),
-                        "right": bounds.get("right", 0),
-                        "bottom": bounds.get("bottom", 0),
-                    },
-                    "clickable": info.get("clickable", False),
-                    "enabled": info.get("enabled", True),
-                })
-            except Exception:
-                pass
+        for _, node in ET.iterparse(io.BytesIO(xml.encode("utf-8")), events=("start",)):
+            if node.tag != "node":
+                continue
+            attrs = node.attrib
+            if text and text not in attrs.get("text", ""):
+                continue
+            if rid_re is not None and not rid_re.search(attrs.get("resource-id", "")):
+                continue
+            if content_desc and content_desc not in attrs.get("content-desc", ""):
+                continue
+            if class_name and attrs.get("class", "") != class_name:
+                continue
+            m = _BOUNDS_RE.match(attrs.get("bounds", ""))
+            left, top, right, bottom = (int(v) for v in m.groups()) if m else (0, 0, 0, 0)
+            elements.append({
+                "index": len(elements),
+                "text": attrs.get("text", ""),
+                "resource_id": attrs.get("resource-id", ""),
+                "content_desc": attrs.get("content-desc", ""),
+                "class_name": attrs.get("class", ""),
+                "bounds": {"left": left, "top": top, "right": right, "bottom": bottom},
+                "clickable": attrs.get("clickable") == "true",
+                "enabled": attrs.get("enabled", "true") == "true",
+            })
+            if len(elements) >= max_results:
+                break
         return {"success": True, "count": len(elements), "elements": elements}
     except Exception as e:
         return {"success": False, "error": "find_failed", "message": str(e), "elements": []}
 
 
+def _swap_for_rotation(w: int, h: int, rotation: int) -> Tuple[int, int]:
+    """Swap width/height for a 90/270 degree rotation (the same swap maps both ways)."""
+    return (h, w) if rotation % 2 else (w, h)
+
+
+def _read_rotation_adb(sess: Dict[str, Any]) -> int:
+    try:
+        p = _run_adb_shell(sess, ["dumpsys", "input", "|", "grep", "-m", "1", "SurfaceOrientation"], timeout_s=5)
+        m = _ROTATION_RE.search(p.stdout or "")
+        if m:
+            return int(m.group(1))
+    except Exception:
+        pass
+    return 0
+
+
+def _remember_display(device_id: str, w: int, h: int, rotation: int) -> None:
+    _SCREEN_CACHE[device_id] = _swap_for_rotation(w, h, rotation)
+    _ROTATION_CACHE[device_id] = (time.monotonic(), rotation)
+
+
+def _cached_display_info(device_id: str) -> Optional[Dict[str, Any]]:
+    """Display info from the caches, or None if the size is unknown or the rotation is stale."""
+    natural = _SCREEN_CACHE.get(device_id)
+    rot = _ROTATION_CACHE.get(device_id)
+    if natural is None or rot is None or time.monotonic() - rot[0] >= _ROTATION_TTL_S:
+        return None
+    w, h = _swap_for_rotation(natural[0], natural[1], rot[1])
+    return {"width": w, "height": h, "rotation": rot[1]}
+
+
 def _get_display_info(session_id: str) -> Optional[Dict[str, Any]]:
     """Internal: get display width, height, and rotation from the device."""
     sess = _get_device_for_session(session_id)
     if not sess:
         return None
     did = sess["device_id"]
+    cached = _cached_display_info(did)
+    if cached is not None:
+        return cached
     driver = sess.get("driver")
-    rotation = 0
-    w, h = 0, 0
     if driver is not None:
         try:
             info = driver.info
             w = info.get("displayWidth", 0)
             h = info.get("displayHeight", 0)
             rotation = info.get("displayRotation", 0)
+            if w and h:
+                _remember_display(did, w, h, rotation)
+                return {"width": w, "height": h, "rotation": rotation}
         except Exception:
             pass
-    if not (w and h):
+    # adb fallback: `wm size` reports the natural size, which never changes; the rotation does.
+    natural = _SCREEN_CACHE.get(did)
+    if natural is None:
         try:
-            p = _run_adb(["-s", did, "shell", "wm", "size"])
-            m = re.search(r"(\d+)x(\d+)", p.stdout or "")
+            p = _run_adb_shell(sess, ["wm", "size"])
+            m = _WM_SIZE_RE.search(p.stdout or "")
             if m:
-                w, h = int(m.group(1)), int(m.group(2))
+                natural = _SCREEN_CACHE[did] = (int(m.group(1)), int(m.group(2)))
         except Exception:
             pass
-    if not (w and h):
+    if natural is None:
         return None
+    rotation = _read_rotation_adb(sess)
+    _ROTATION_CACHE[did] = (time.monotonic(), rotation)
+    w, h = _swap_for_rotation(natural[0], natural[1], rotation)
     return {"width": w, "height": h, "rotation": rotation}
 
 
@@ -447,7 +748,6 @@ def tap_percent(session_id: str, x_pct: Any = 50, y_pct: Any = 50) -> Dict[str,
     sess = _get_device_for_session(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    did = sess["device_id"]
     driver = sess.get("driver")
     if driver is not None:
         try:
@@ -460,7 +760,7 @@ def tap_percent(session_id: str, x_pct: Any = 50, y_pct: Any = 50) -> Dict[str,
         except Exception:
             pass
     try:
-        p = _run_adb(["-s", did, "shell", "input", "tap", str(x), str(y)])
+        p = _run_adb_shell(sess, ["input", "tap", str(x), str(y)])
         if p.returncode != 0:
             return {"success": False, "error": "adb_error", "message": p.stderr.strip()}
         return {
@@ -472,6 +772,72 @@ def tap_percent(session_id: str, x_pct: Any = 50, y_pct: Any = 50) -> Dict[str,
         return {"success": False, "error": "tap_failed", "message": str(e)}
 
 
+def _batch_op_command(op: Dict[str, Any]) -> str:
+    kind = op.get("op")
+    if kind == "tap":
+        return f"input tap {_coerce_int(op.get('x'))} {_coerce_int(op.get('y'))}"
+    if kind == "key":
+        return f"input keyevent {_KEYMAP.get(str(op.get('code')).lower(), op.get('code'))}"
+    if kind == "sleep":
+        return f"sleep {max(0, float(op.get('ms', 0))) / 1000.0:g}"
+    if kind == "text":
+        return "input text " + str(op.get("s", "")).replace(" ", "%s")
+    raise ValueError(f"unknown op: {kind!r}")
+
+
+def _run_single_op(session_id: str, op: Dict[str, Any]) -> Dict[str, Any]:
+    kind = op.get("op")
+    if kind == "tap":
+        return tap_coordinates(session_id, op.get("x"), op.get("y"))
+    if kind == "key":
+        return press_key(session_id, str(op.get("code")))
+    if kind == "sleep":
+        return wait(session_id, int(op.get("ms", 0)))
+    return input_text(session_id, str(op.get("s", "")))
+
+
+def batch(session_id: str, ops: list[Dict[str, Any]]) -> Dict[str, Any]:
+    """Run a chain of simple actions in one `adb shell` round-trip.
+
+    ops items: {"op": "tap", "x", "y"} / {"op": "key", "code"} / {"op": "sleep", "ms"} / {"op": "text", "s"}.
+    Commands are chained with `&&`; if one exits nonzero, it and the remaining ops are retried
+    one by one. If the shell call itself fails (e.g. times out), nothing is replayed.
+    """
+    sess = _get_device_for_session(session_id)
+    if not sess:
+        return {"success": False, "error": "session_not_found"}
+    try:
+        cmds = [_batch_op_command(op) for op in ops]
+    except (ValueError, TypeError, IndexError) as e:
+        return {"success": False, "error": "invalid_op", "message": str(e)}
+    if not cmds:
+        return {"success": True, "ops": 0, "method": "adb_shell_batch"}
+
+    # Echo a marker before each op so a failure can be located without re-running earlier ops.
+    marker = "__OP__"
+    script = " && ".join(f"echo {marker}{i} && {cmd}" for i, cmd in enumerate(cmds))
+    try:
+        p = _run_adb_shell(sess, [script], timeout_s=20 + sum(
+            float(op.get("ms", 0)) / 1000.0 for op in ops if op.get("op") == "sleep"))
+    except Exception as e:
+        # Some ops may already have run on the device; replaying them could repeat taps or text.
+        return {
+            "success": False, "error": "batch_failed", "message": str(e),
+            "ops": len(cmds), "method": "adb_shell_batch",
+        }
+    if p.returncode == 0:
+        return {"success": True, "ops": len(cmds), "method": "adb_shell_batch"}
+
+    started = sum(1 for line in (p.stdout or "").splitlines() if line.startswith(marker))
+    failed_at = max(0, started - 1)
+    results = [_run_single_op(session_id, op) for op in ops[failed_at:]]
+    ok = all(r.get("success") for r in results)
+    return {
+        "success": ok, "ops": len(cmds), "method": "per_op_fallback",
+        "fallback_from": failed_at, "results": results,
+    }
+
+
 def screenshot(session_id: str, output_path: str) -> Dict[str, Any]:
     sess = _get_device_for_session(session_id)
     if not sess:
@@ -487,14 +853,26 @@ def screenshot(session_id: str, output_path: str) -> Dict[str, Any]:
         except Exception:
             pass
     try:
-        p = subprocess.run(
-            ["adb", "-s", did, "exec-out", "screencap", "-p"],
-            capture_output=True,
-            timeout=30,
-        )
-        if p.returncode != 0:
-            return {"success": False, "error": "adb_error", "message": (p.stderr or b"").decode(errors="ignore")}
-        out.write_bytes(p.stdout or b"")
+        # Stream the PNG straight into the file instead of buffering it (tens of MB on 4K screens).
+        with subprocess.Popen(["adb", "-s", did, "exec-out", "screencap", "-p"],
+                              stdout=subprocess.PIPE, stderr=subprocess.PIPE) as p:
+            # exec-out can stall on a wedged device; keep the 30 s ceiling while streaming.
+            killer = threading.Timer(30, p.kill)
+            killer.start()
+            try:
+                with out.open("wb") as f:
+                    shutil.copyfileobj(p.stdout, f, length=1 << 20)
+                err = p.stderr.read()
+                rc = p.wait(timeout=30)
+            except BaseException:
+                p.kill()
+                out.unlink(missing_ok=True)
+                raise
+            finally:
+                killer.cancel()
+        if rc != 0:
+            out.unlink(missing_ok=True)
+            return {"success": False, "error": "adb_error", "message": (err or b"").decode(errors="ignore")}
         return {"success": True, "screenshot": str(out), "method": "adb_screencap"}
     except Exception as e:
         return {"success": False, "error": "screenshot_failed", "message": str(e)}
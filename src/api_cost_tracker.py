@@ -1,8 +1,13 @@
 """
 API 消耗追踪模块：统计 LLM 调用的 Token 消耗并按人民币结算
 """
+import functools
+import io
+import sys
+import threading
+from array import array
 from dataclasses import dataclass, field
-from typing import Optional, Dict, Any
+from typing import Optional, Dict, Any, List, Tuple
 
 
 # 定价标准（人民币/千Token）
@@ -11,8 +16,21 @@ PRICING = {
     "openai": {"input": 0.0, "output": 0.0},     # 可后续配置
 }
 
+# Batch API 按同步价格的一半计费
+BATCH_PRICE_FACTOR = 0.5
 
-@dataclass
+# Python 3.10+ 的 dataclass 支持 slots，省去每个实例的 __dict__
+_DATACLASS_KW = {"slots": True} if sys.version_info >= (3, 10) else {}
+
+
+@functools.lru_cache(maxsize=16)
+def _price_for(model: str) -> Tuple[str, Dict[str, float]]:
+    """按模型名解析 (模型类型, 定价)，同名模型重复构造时直接复用"""
+    model_type = "qwen" if "qwen" in model.lower() else "openai"
+    return model_type, PRICING.get(model_type, PRICING["qwen"])
+
+
+@dataclass(**_DATACLASS_KW)
 class TokenUsage:
     """单次调用的 Token 使用量"""
     input_tokens: int = 0
@@ -23,7 +41,7 @@ class TokenUsage:
         return self.input_tokens + self.output_tokens
 
 
-@dataclass
+@dataclass(**_DATACLASS_KW)
 class StepCost:
     """单步消耗汇总"""
     step_name: str
@@ -49,38 +67,75 @@ class APICostTracker:
     
     def __init__(self, model: str = "qwen3.5-397b-a17b"):
         self.model = model
-        self._steps: Dict[str, StepCost] = {}
-        self._model_type = "qwen" if "qwen" in model.lower() else "openai"
-        self._price = PRICING.get(self._model_type, PRICING["qwen"])
-    
-    def _cny_per_1k_input(self) -> float:
-        return self._price["input"]
-    
-    def _cny_per_1k_output(self) -> float:
-        return self._price["output"]
+        # 按列存储各步骤汇总：_step_index 给出步骤在各列中的下标
+        self._step_index: Dict[str, int] = {}
+        self._input_arr = array("q")
+        self._output_arr = array("q")
+        self._cost_arr = array("d")
+        self._calls_arr = array("q")
+        # LLM 调用可能来自多个工作线程：各线程先追加到自己的缓冲区（无锁），
+        # 汇总时由 flush() 加锁一次性合并
+        self._lock = threading.Lock()
+        self._locals = threading.local()
+        # 线程 -> 缓冲区；线程退出后其缓冲区在下一次 flush() 合并完即移除
+        self._buffers: Dict[threading.Thread, List[Tuple[str, int, int, float]]] = {}
+        self._model_type, self._price = _price_for(model)
+        # 预先换算为 元/token，tokens_to_cny 只做两次乘法
+        self._p_in = self._price["input"] / 1000.0
+        self._p_out = self._price["output"] / 1000.0
     
     def tokens_to_cny(self, input_tokens: int, output_tokens: int) -> float:
         """将 token 数转换为人民币（元）"""
-        return (
-            input_tokens / 1000.0 * self._cny_per_1k_input() +
-            output_tokens / 1000.0 * self._cny_per_1k_output()
-        )
+        return input_tokens * self._p_in + output_tokens * self._p_out
     
     def record_usage(
         self,
         step_name: str,
         input_tokens: int = 0,
         output_tokens: int = 0,
+        price_factor: float = 1.0,
     ) -> float:
         """
         记录一次 API 调用消耗，返回本次费用（元）
+        
+        price_factor: 相对同步价格的折扣（Batch API 为 BATCH_PRICE_FACTOR）
         """
-        cost = self.tokens_to_cny(input_tokens, output_tokens)
-        if step_name not in self._steps:
-            self._steps[step_name] = StepCost(step_name=step_name)
-        self._steps[step_name].add_usage(input_tokens, output_tokens, cost)
+        cost = self.tokens_to_cny(input_tokens, output_tokens) * price_factor
+        self._local_buffer().append((step_name, input_tokens, output_tokens, price_factor))
         return cost
     
+    def _local_buffer(self) -> List[Tuple[str, int, int, float]]:
+        """当前线程的记录缓冲区（首次使用时登记，仅此处加锁）"""
+        buffer = getattr(self._locals, "buffer", None)
+        if buffer is None:
+            buffer = self._locals.buffer = []
+            with self._lock:
+                self._buffers[threading.current_thread()] = buffer
+        return buffer
+    
+    def flush(self):
+        """将各线程缓冲区中的记录合并到步骤汇总（并移除已退出线程的缓冲区）"""
+        with self._lock:
+            for thread, buffer in list(self._buffers.items()):
+                # 先判断存活再复制：线程若已退出，复制到的就是它的全部记录
+                alive = thread.is_alive()
+                items = buffer[:]
+                # 只删除已复制的部分，期间其他线程新追加的记录保留到下次
+                del buffer[:len(items)]
+                for step_name, input_tokens, output_tokens, price_factor in items:
+                    idx = self._step_index.get(step_name)
+                    if idx is None:
+                        idx = self._step_index[step_name] = len(self._calls_arr)
+                        for col in (self._input_arr, self._output_arr, self._calls_arr):
+                            col.append(0)
+                        self._cost_arr.append(0.0)
+                    self._input_arr[idx] += input_tokens
+                    self._output_arr[idx] += output_tokens
+                    self._cost_arr[idx] += self.tokens_to_cny(input_tokens, output_tokens) * price_factor
+                    self._calls_arr[idx] += 1
+                if not alive:
+                    del self._buffers[thread]
+    
     def record_from_response(self, step_name: str, response: Any) -> float:
         """
         从 OpenAI 兼容的 response 中读取 usage 并记录
@@ -96,9 +151,14 @@ class APICostTracker:
     
     def estimate_tokens(self, text: str) -> int:
         """粗略估计文本的 token 数（中英混合约 1.5 字符/token）"""
-        if not text:
+        return self.estimate_tokens_from_len(len(text)) if text else 0
+    
+    @staticmethod
+    def estimate_tokens_from_len(n_chars: int) -> int:
+        """按字符数估计 token 数（不构造字符串）"""
+        if n_chars <= 0:
             return 0
-        return max(1, int(len(text) / 1.5))
+        return max(1, int(n_chars / 1.5))
     
     def estimate_step_cost(
         self,
@@ -110,25 +170,44 @@ class APICostTracker:
         """
         估算某步骤的总费用（用于确认前展示）
         """
-        input_tokens = self.estimate_tokens("x" * avg_input_chars) * num_calls
-        output_tokens = self.estimate_tokens("x" * avg_output_chars) * num_calls
+        input_tokens = self.estimate_tokens_from_len(avg_input_chars) * num_calls
+        output_tokens = self.estimate_tokens_from_len(avg_output_chars) * num_calls
         return self.tokens_to_cny(input_tokens, output_tokens)
     
+    def _step_view(self, step_name: str, idx: int) -> StepCost:
+        """由各列数据构造单步汇总（只读视图）"""
+        return StepCost(
+            step_name=step_name,
+            input_tokens=self._input_arr[idx],
+            output_tokens=self._output_arr[idx],
+            cost_cny=self._cost_arr[idx],
+            calls=self._calls_arr[idx],
+        )
+    
     def get_step_cost(self, step_name: str) -> Optional[StepCost]:
-        return self._steps.get(step_name)
+        self.flush()
+        idx = self._step_index.get(step_name)
+        return None if idx is None else self._step_view(step_name, idx)
     
     def get_total_cost(self) -> float:
-        return sum(s.cost_cny for s in self._steps.values())
+        self.flush()
+        return float(sum(self._cost_arr))
     
     def get_summary(self) -> str:
-        lines = ["API 消耗汇总（人民币）："]
-        for name, step in self._steps.items():
-            lines.append(
-                f"  - {name}: {step.input_tokens} 输入 + {step.output_tokens} 输出 tokens, "
-                f"约 {step.cost_cny:.4f} 元 ({step.calls} 次调用)"
-            )
-        lines.append(f"  合计: {self.get_total_cost():.4f} 元")
-        return "\n".join(lines)
+        self.flush()
+        buf = io.StringIO()
+        buf.write("API 消耗汇总（人民币）：\n")
+        for name, idx in self._step_index.items():
+            buf.write("  - %s: %d 输入 + %d 输出 tokens, 约 %.4f 元 (%d 次调用)\n" % (
+                name, self._input_arr[idx], self._output_arr[idx], self._cost_arr[idx], self._calls_arr[idx],
+            ))
+        buf.write("  合计: %.4f 元" % sum(self._cost_arr))
+        return buf.getvalue()
     
     def reset(self):
-        self._steps.clear()
+        with self._lock:
+            for buffer in self._buffers.values():
+                buffer.clear()
+            self._step_index.clear()
+            for col in (self._input_arr, self._output_arr, self._cost_arr, self._calls_arr):
+                del col[:]
@@ -1,35 +1,109 @@
 """
 Browser automation tool using Playwright with persistent sessions.
-All Playwright sync API calls run in a separate process to avoid
-"Sync API inside asyncio loop" when the main process has an event loop.
+All Playwright sync API calls run on dedicated worker threads to avoid
+"Sync API inside asyncio loop" when the calling thread has an event loop.
 """
 from __future__ import annotations
 
-import multiprocessing
+import os
+import queue
+import threading
 import uuid
 from pathlib import Path
-from typing import Any, Dict, List, Optional
+from typing import Any, Dict, List, Optional, Set
 
+from playwright.sync_api import TimeoutError as PWTimeout
 from playwright.sync_api import sync_playwright
 
 _SESSIONS: Dict[str, Dict[str, Any]] = {}
-_REQ_Q: Optional[multiprocessing.Queue] = None
-_RES_Q: Optional[multiprocessing.Queue] = None
-_PROC: Optional[multiprocessing.Process] = None
-
-
-def _run_in_browser_process(op: str, *args, **kwargs):
-    """Run a browser operation in the worker process (no asyncio there)."""
-    global _REQ_Q, _RES_Q, _PROC
-    if _PROC is None or not _PROC.is_alive():
-        _REQ_Q = multiprocessing.Queue()
-        _RES_Q = multiprocessing.Queue()
-        _PROC = multiprocessing.Process(
-            target=_browser_worker_process,
-            args=(_REQ_Q, _RES_Q),
-            daemon=True,
-        )
-        _PROC.start()
+# Screenshot directories already created by this process.
+_MADE_DIRS: Set[str] = set()
+# Playwright sync objects are bound to the thread that started their driver, so each worker thread
+# owns one long-lived Playwright + Browser (thread-local); each session gets its own cheap BrowserContext.
+_WORKER_STATE = threading.local()
+# Sessions started with reuse=False get a dedicated worker so they progress in parallel.
+_DEFAULT_WORKER: Optional["_BrowserWorker"] = None
+_SESSION_WORKERS: Dict[str, "_BrowserWorker"] = {}
+_WORKERS_LOCK = threading.Lock()
+
+
+def _tune_worker_thread() -> None:
+    """Opt-in: pin this worker thread to APPAGENT_BROWSER_CPUS (e.g. "2,3") and nudge its priority.
+
+    Off by default, since pinning every per-session worker to the same cores would serialize them.
+    Linux applies both calls to the calling thread only; unsupported or unprivileged calls are ignored.
+    """
+    cpus = os.getenv("APPAGENT_BROWSER_CPUS", "").strip()
+    if not cpus:
+        return
+    try:
+        os.sched_setaffinity(0, {int(c) for c in cpus.split(",") if c.strip()})
+    except (AttributeError, OSError, ValueError):
+        pass
+    try:
+        os.nice(-5)
+    except (AttributeError, OSError):
+        pass
+
+
+class _BrowserWorker:
+    """One Playwright thread; it never owns an asyncio loop, so the sync API is fine there."""
+
+    def __init__(self, name: str) -> None:
+        self._requests: "queue.Queue[Any]" = queue.Queue()
+        # One request is in flight per worker, so the reply is a single preallocated slot handed
+        # back by releasing a lock the caller blocks on (no Queue/Condition allocation per call).
+        self._reply: Any = None
+        self._reply_ready = threading.Lock()
+        self._reply_ready.acquire()
+        self._lock = threading.Lock()
+        # Sticky liveness: _loop swallows every exception, so the thread only ends via stop().
+        self.alive = True
+        self._thread = threading.Thread(target=self._loop, name=name, daemon=True)
+        self._thread.start()
+
+    def call(self, op: str, args: tuple, kwargs: dict) -> Any:
+        with self._lock:
+            self._requests.put((op, args, kwargs))
+            self._reply_ready.acquire()
+            ok, value = self._reply
+            self._reply = None
+        if not ok:
+            raise value
+        return value
+
+    def stop(self) -> None:
+        self.alive = False
+        self._requests.put(None)
+
+    def _loop(self) -> None:
+        _tune_worker_thread()
+        while True:
+            task = self._requests.get()
+            if task is None:
+                break
+            op, args, kwargs = task
+            try:
+                self._reply = (True, _DISPATCH[op](*args, **kwargs))
+            except BaseException as e:
+                # Same process: the live exception (with its worker-side traceback) is raised as-is.
+                self._reply = (False, e)
+            self._reply_ready.release()
+
+
+def _default_worker() -> _BrowserWorker:
+    global _DEFAULT_WORKER
+    worker = _DEFAULT_WORKER
+    if worker is not None and worker.alive:
+        return worker
+    with _WORKERS_LOCK:
+        if _DEFAULT_WORKER is None or not _DEFAULT_WORKER.alive:
+            _DEFAULT_WORKER = _BrowserWorker("browser-worker")
+        return _DEFAULT_WORKER
+
+
+def _run_in_browser_thread(op: str, *args, **kwargs):
+    """Run a browser operation on the worker thread that owns the session (args[0])."""
     # Backward-compat: allow callers to pass ("op", args_tuple, kwargs_dict)
     # as positional args, and normalize to real (*args, **kwargs).
     call_args = args
@@ -43,81 +117,132 @@ def _run_in_browser_process(op: str, *args, **kwargs):
         call_args = args[0]
         call_kwargs = args[1]
 
-    _REQ_Q.put((op, call_args, call_kwargs))
-    ok, value = _RES_Q.get()
-    if not ok:
-        if isinstance(value, BaseException):
-            raise value
-        if isinstance(value, (list, tuple)) and len(value) >= 2:
-            raise RuntimeError(f"{value[0]}: {value[1]}")
-        raise RuntimeError(str(value))
-    return value
+    worker = None
+    if call_args and isinstance(call_args[0], str):
+        if call_args[0] not in _SESSIONS:
+            # Unknown session: the impl only builds its "session_not_found" result and touches no
+            # Playwright object, so answer on the calling thread without a worker round-trip.
+            return _DISPATCH[op](*call_args, **call_kwargs)
+        worker = _SESSION_WORKERS.get(call_args[0])
+    return (worker or _default_worker()).call(op, call_args, call_kwargs)
 
 
-def _browser_worker_process(req_q: multiprocessing.Queue, res_q: multiprocessing.Queue) -> None:
-    """Run in child process: no asyncio, so Playwright sync API is fine."""
-    while True:
-        task = req_q.get()
-        if task is None:
-            break
-        op, args, kwargs = task
-        try:
-            out = _DISPATCH[op](*args, **kwargs)
-            res_q.put((True, out))
-        except BaseException as e:
-            try:
-                res_q.put((False, e))
-            except Exception:
-                res_q.put((False, (type(e).__name__, str(e))))
+def _classify_err(e: BaseException) -> str:
+    """Map a Playwright exception to the "error" code returned by the tool functions."""
+    return "timeout" if isinstance(e, PWTimeout) else "browser_error"
 
 
-def _start_session_impl(headless: bool) -> Dict[str, Any]:
+def _start_session_impl(headless: bool, reuse: bool = True) -> Dict[str, Any]:
     # Reuse existing session by default to avoid repeated Playwright bootstrap.
-    if _SESSIONS:
+    if reuse and _SESSIONS:
         sid = next(iter(_SESSIONS.keys()))
         return {"session_id": sid, "reused": True}
-    p = sync_playwright().start()
-    browser = p.chromium.launch(headless=headless)
-    page = browser.new_page()
+    st = _WORKER_STATE
+    browser = getattr(st, "browser", None)
+    if browser is not None and st.headless != headless:
+        _shutdown_impl()  # no live sessions here, so relaunching in the requested mode is safe
+        browser = None
+    if browser is None:
+        st.pw = sync_playwright().start()
+        browser = st.browser = st.pw.chromium.launch(headless=headless)
+        st.headless = headless
+    context = browser.new_context()
+    page = context.new_page()
     session_id = str(uuid.uuid4())
-    _SESSIONS[session_id] = {"playwright": p, "browser": browser, "page": page}
+    _SESSIONS[session_id] = {
+        "context": context,
+        "page": page,
+        "owner": threading.current_thread(),
+        "cache": {},  # page source keyed by DOM version; cleared by every action
+    }
     return {"session_id": session_id}
 
 
-def start_session(headless: bool = False) -> Dict[str, Any]:
-    """Start a browser session and return session_id."""
-    return _run_in_browser_process("start_session", (), {"headless": headless})
+def start_session(headless: bool = False, reuse: bool = True) -> Dict[str, Any]:
+    """Start a browser session and return session_id.
+
+    reuse=False always creates a new session on its own worker thread (and browser), so
+    several sessions can be driven in parallel from different caller threads.
+    """
+    if reuse:
+        return _run_in_browser_thread("start_session", (), {"headless": headless})
+    worker = _BrowserWorker("browser-session")
+    try:
+        res = worker.call("start_session", (), {"headless": headless, "reuse": False})
+    except BaseException:
+        worker.stop()
+        raise
+    _SESSION_WORKERS[res["session_id"]] = worker
+    return res
 
 
 def _close_session_impl(session_id: str) -> Dict[str, Any]:
     sess = _SESSIONS.pop(session_id, None)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    sess["browser"].close()
-    sess["playwright"].stop()
+    sess["context"].close()
+    return {"success": True}
+
+
+def _shutdown_impl() -> Dict[str, Any]:
+    """Close this worker's sessions and tear down its browser and Playwright driver."""
+    me = threading.current_thread()
+    for sid, sess in list(_SESSIONS.items()):
+        if sess["owner"] is not me:
+            continue
+        _SESSIONS.pop(sid, None)
+        try:
+            sess["context"].close()
+        except Exception:
+            pass
+    st = _WORKER_STATE
+    if getattr(st, "browser", None) is not None:
+        st.browser.close()
+    if getattr(st, "pw", None) is not None:
+        st.pw.stop()
+    st.pw = st.browser = st.headless = None
     return {"success": True}
 
 
 def close_session(session_id: str) -> Dict[str, Any]:
-    """Close a browser session."""
-    return _run_in_browser_process("close_session", (session_id,), {})
+    """Close a browser session (its context); the shared browser stays up for the next session."""
+    res = _run_in_browser_thread("close_session", (session_id,), {})
+    worker = _SESSION_WORKERS.pop(session_id, None)
+    if worker is not None:
+        # A dedicated worker served only this session: release its browser and thread too.
+        worker.call("shutdown", (), {})
+        worker.stop()
+    return res
+
+
+def shutdown() -> Dict[str, Any]:
+    """Close every session and every worker's browser."""
+    for sid in list(_SESSION_WORKERS):
+        worker = _SESSION_WORKERS.pop(sid)
+        worker.call("shutdown", (), {})
+        worker.stop()
+    return _run_in_browser_thread("shutdown", (), {})
 
 
 def _open_url_impl(session_id: str, url: str, wait_ms: int) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    sess["cache"].clear()
     page = sess["page"]
     try:
         page.goto(url, wait_until="domcontentloaded")
         if wait_ms > 0:
-            page.wait_for_timeout(wait_ms)
+            # wait_ms is now an upper bound: return as soon as the network goes quiet.
+            try:
+                page.wait_for_load_state("networkidle", timeout=wait_ms)
+            except PWTimeout:
+                pass
         return {"success": True, "url": url, "title": page.title()}
     except Exception as e:
-        err = str(e).lower()
         return {
             "success": False,
-            "error": "timeout" if "timeout" in err or "timeout" in type(e).__name__.lower() else "browser_error",
+            "error": _classify_err(e),
             "url": url,
             "message": str(e),
         }
@@ -128,22 +253,22 @@ def open_url(
     url: str,
     wait_ms: int = 2000,
 ) -> Dict[str, Any]:
-    """Open a URL in an existing session."""
-    return _run_in_browser_process("open_url", (session_id, url, wait_ms), {})
+    """Open a URL in an existing session, waiting up to wait_ms for the network to go idle."""
+    return _run_in_browser_thread("open_url", (session_id, url, wait_ms), {})
 
 
 def _fill_selector_impl(session_id: str, selector: str, text: str) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    sess["cache"].clear()
     try:
         sess["page"].fill(selector, text)
         return {"success": True}
     except Exception as e:
-        err = str(e).lower()
         return {
             "success": False,
-            "error": "timeout" if "timeout" in err or "timeout" in type(e).__name__.lower() else "browser_error",
+            "error": _classify_err(e),
             "selector": selector,
             "message": str(e),
         }
@@ -151,21 +276,21 @@ def _fill_selector_impl(session_id: str, selector: str, text: str) -> Dict[str,
 
 def fill_selector(session_id: str, selector: str, text: str) -> Dict[str, Any]:
     """Fill a selector with text."""
-    return _run_in_browser_process("fill_selector", (session_id, selector, text), {})
+    return _run_in_browser_thread("fill_selector", (session_id, selector, text), {})
 
 
 def _click_selector_impl(session_id: str, selector: str) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    sess["cache"].clear()
     try:
         sess["page"].click(selector)
         return {"success": True}
     except Exception as e:
-        err = str(e).lower()
         return {
             "success": False,
-            "error": "timeout" if "timeout" in err or "timeout" in type(e).__name__.lower() else "browser_error",
+            "error": _classify_err(e),
             "selector": selector,
             "message": str(e),
         }
@@ -173,7 +298,188 @@ def _click_selector_impl(session_id: str, selector: str) -> Dict[str, Any]:
 
 def click_selector(session_id: str, selector: str) -> Dict[str, Any]:
     """Click a selector."""
-    return _run_in_browser_process("click_selector", (session_id, selector), {})
+    return _run_in_browser_thread("click_selector", (session_id, selector), {})
+
+
+# In-page helpers installed once per session (init script + current document), so the hot calls
+# below evaluate a short `window.__appagent.*` expression instead of re-sending kilobytes of JS.
+_HELPERS_JS = """
+window.__appagent = window.__appagent || {
+  getVisibleInputs: () => {
+      // Columnar result (one array per field) keeps key names off the wire; see _INPUT_FIELDS.
+      const cols = { tag: [], type: [], placeholder: [], name: [], id: [], text: [] };
+      for (const e of document.querySelectorAll('input, textarea, button')) {
+          const rect = e.getBoundingClientRect();
+          if (!(rect.width > 0 && rect.height > 0 && e.offsetParent !== null)) continue;
+          const tag = e.tagName.toLowerCase();
+          cols.tag.push(tag);
+          cols.type.push((e.type || '').toLowerCase());
+          cols.placeholder.push((e.placeholder || '').trim());
+          cols.name.push((e.name || '').trim());
+          cols.id.push((e.id || '').trim());
+          cols.text.push(tag === 'button' ? (e.textContent || '').trim().slice(0, 80) : '');
+      }
+      return cols;
+  },
+  clickByText: (needle) => {
+    const norm = (s) => (s || "").replace(/\\s+/g, "").trim();
+    const n = norm(needle);
+    const selectors = ["button", "a", "[role='button']", "div", "span"];
+    const nodes = document.querySelectorAll(selectors.join(","));
+    for (const el of nodes) {
+      const txt = norm(el.innerText || el.textContent || "");
+      if (!txt || !txt.includes(n)) continue;
+      const rect = el.getBoundingClientRect();
+      const style = window.getComputedStyle(el);
+      if (rect.width <= 0 || rect.height <= 0) continue;
+      if (style.visibility === "hidden" || style.display === "none") continue;
+      el.click();
+      return true;
+    }
+    return false;
+  },
+  checkAgreement: () => {
+    const isVisible = (el) => {
+      const rect = el.getBoundingClientRect();
+      const st = window.getComputedStyle(el);
+      return rect.width > 0 && rect.height > 0 && st.visibility !== "hidden" && st.display !== "none";
+    };
+    const keys = ["我已阅读并同意", "同意", "用户协议", "隐私政策", "青少年个人信息保护规则"];
+    const norm = (s) => (s || "").replace(/\\s+/g, "");
+    const hasKey = (txt) => {
+      const n = norm(txt);
+      return keys.some((k) => n.includes(norm(k)));
+    };
+    const tryClick = (el) => {
+      if (!el || !isVisible(el)) return false;
+      try { el.click(); return true; } catch (_) { return false; }
+    };
+    const checkboxLike = (scope) => {
+      if (!scope) return [];
+      const sels = [
+        'input[type="checkbox"]',
+        '[role="checkbox"]',
+        '[aria-checked]',
+        '.checkbox',
+        '[class*="checkbox"]',
+        '[class*="check"]',
+        '[class*="agree"]',
+        '[class*="protocol"]'
+      ];
+      return Array.from(scope.querySelectorAll(sels.join(","))).filter(isVisible);
+    };
+
+    // 0) Fast path: a single usable native checkbox on the page is the agreement box;
+    //    skip the text-anchor scan over every label/span/div.
+    const natives = Array.from(document.querySelectorAll('input[type="checkbox"]:not(:disabled)')).filter(isVisible);
+    if (natives.length === 1) {
+      const cb = natives[0];
+      if (cb.checked) return { clicked: true, method: "already_checked" };
+      const label = cb.id ? document.querySelector(`label[for="${cb.id}"]`) : null;
+      if (tryClick(label) || tryClick(cb)) return { clicked: true, method: "single_checkbox" };
+    }
+
+    // 1) Prefer agreement-area targeted checkbox, avoid unrelated checkboxes.
+    const textAnchors = Array.from(document.querySelectorAll("label, span, div, p, a, li")).filter(
+      (el) => isVisible(el) && hasKey(el.innerText || el.textContent || "")
+    );
+
+    for (const anchor of textAnchors) {
+      const scopes = [anchor, anchor.parentElement, anchor.parentElement?.parentElement].filter(Boolean);
+      for (const scope of scopes) {
+        const cbs = checkboxLike(scope);
+        for (const cb of cbs) {
+          if (cb.tagName.toLowerCase() === "input" && cb.type === "checkbox") {
+            if (cb.checked) return { clicked: true, method: "already_checked" };
+            if (cb.disabled) continue;
+            if (cb.id) {
+              const label = document.querySelector(`label[for="${cb.id}"]`);
+              if (tryClick(label) || tryClick(cb)) return { clicked: true, method: "checkbox_input_or_label" };
+            } else if (tryClick(cb)) {
+              return { clicked: true, method: "checkbox_input" };
+            }
+          } else {
+            if (tryClick(cb)) return { clicked: true, method: "checkbox_like" };
+          }
+        }
+      }
+
+      // 2) Click small left-side icon in same row (common custom checkbox UI).
+      const row = anchor.closest("label, div, p, li, section") || anchor.parentElement;
+      if (row) {
+        const rowRect = row.getBoundingClientRect();
+        const aRect = anchor.getBoundingClientRect();
+        const candidates = Array.from(row.querySelectorAll("*")).filter((el) => {
+          if (!isVisible(el)) return false;
+          const r = el.getBoundingClientRect();
+          const w = r.width;
+          const h = r.height;
+          const squareLike = w >= 8 && h >= 8 && w <= 32 && h <= 32;
+          const leftOfText = r.right <= aRect.left + 8;
+          const nearRow = Math.abs(r.top - rowRect.top) < 30 || Math.abs(r.bottom - rowRect.bottom) < 30;
+          return squareLike && leftOfText && nearRow;
+        });
+        for (const c of candidates) {
+          if (tryClick(c)) return { clicked: true, method: "left_icon_fallback" };
+        }
+      }
+
+      // 3) Last fallback: clicking the anchor text row itself may toggle checkbox.
+      if (tryClick(anchor)) return { clicked: true, method: "anchor_text_fallback" };
+    }
+
+    // 4) Final fallback: visible unchecked native checkbox anywhere.
+    const boxes = Array.from(document.querySelectorAll('input[type="checkbox"]')).filter(isVisible);
+    for (const box of boxes) {
+      if (box.checked) return { clicked: true, method: "already_checked_global" };
+      if (!box.disabled && tryClick(box)) return { clicked: true, method: "checkbox_global_fallback" };
+    }
+
+    return { clicked: false, method: "not_found" };
+  },
+  markByPlaceholder: (needle) => {
+    document.querySelectorAll('[data-appagent-target]').forEach((el) => el.removeAttribute('data-appagent-target'));
+    const n = (needle || "").trim();
+    for (const el of document.querySelectorAll("input[placeholder], textarea[placeholder]")) {
+      const ph = (el.getAttribute("placeholder") || "").trim();
+      if (n && !ph.includes(n)) continue;
+      const rect = el.getBoundingClientRect();
+      const st = window.getComputedStyle(el);
+      if (rect.width <= 0 || rect.height <= 0 || st.visibility === "hidden" || st.display === "none") continue;
+      if (el.disabled) continue;
+      el.setAttribute("data-appagent-target", "1");
+      return true;
+    }
+    return false;
+  },
+};
+"""
+
+# Column order of the getVisibleInputs result.
+_INPUT_FIELDS = ("tag", "type", "placeholder", "name", "id", "text")
+
+# Call expressions for each helper, built once rather than formatted on every call.
+_HELPER_CALLS = {
+    name: f"(args) => window.__appagent.{name}(...args)"
+    for name in ("getVisibleInputs", "clickByText", "checkAgreement", "markByPlaceholder")
+}
+
+
+def _call_helper(sess: Dict[str, Any], name: str, *args: Any) -> Any:
+    page = sess["page"]
+    if not sess.get("helpers_installed"):
+        page.context.add_init_script(_HELPERS_JS)
+        sess["helpers_installed"] = True
+    expr = _HELPER_CALLS[name]
+    try:
+        return page.evaluate(expr, list(args))
+    except Exception:
+        # Document loaded before the init script was registered: install into it and retry.
+        # If the helpers are present the error came from the helper itself, so don't re-run it.
+        if page.evaluate("() => !!window.__appagent"):
+            raise
+        page.evaluate(_HELPERS_JS)
+        return page.evaluate(expr, list(args))
 
 
 def _get_visible_inputs_impl(session_id: str) -> Dict[str, Any]:
@@ -181,33 +487,17 @@ def _get_visible_inputs_impl(session_id: str) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found", "inputs": []}
-    page = sess["page"]
-    script = """
-    () => {
-        const els = document.querySelectorAll('input, textarea, button');
-        return Array.from(els).filter(e => {
-            const rect = e.getBoundingClientRect();
-            return rect.width > 0 && rect.height > 0 && (e.offsetParent !== null);
-        }).map(e => ({
-            tag: e.tagName.toLowerCase(),
-            type: (e.type || '').toLowerCase(),
-            placeholder: (e.placeholder || '').trim(),
-            name: (e.name || '').trim(),
-            id: (e.id || '').trim(),
-            text: e.tagName.toLowerCase() === 'button' ? (e.textContent || '').trim().slice(0, 80) : ''
-        }));
-    }
-    """
     try:
-        inputs = page.evaluate(script)
-        return {"success": True, "inputs": inputs or []}
+        cols = _call_helper(sess, "getVisibleInputs") or {}
+        rows = zip(*(cols.get(k, ()) for k in _INPUT_FIELDS))
+        return {"success": True, "inputs": [dict(zip(_INPUT_FIELDS, row)) for row in rows]}
     except Exception as e:
         return {"success": False, "error": str(e), "inputs": []}
 
 
 def get_visible_inputs(session_id: str) -> Dict[str, Any]:
     """Get visible input/textarea/button elements on the current page (for login form discovery)."""
-    return _run_in_browser_process("get_visible_inputs", (session_id,), {})
+    return _run_in_browser_thread("get_visible_inputs", (session_id,), {})
 
 
 def _fill_by_placeholder_impl(
@@ -218,35 +508,23 @@ def _fill_by_placeholder_impl(
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    sess["cache"].clear()
     page = sess["page"]
     try:
-        # get_by_placeholder matches substring by default
+        # One in-page walk finds the first visible+enabled input/textarea whose placeholder contains
+        # the needle and tags it, so the fill is a single locator call instead of a per-candidate RPC loop.
+        marked = _call_helper(sess, "markByPlaceholder", placeholder_substring)
+        if marked:
+            # The marker is left in place: markByPlaceholder clears stale ones before tagging.
+            page.locator('[data-appagent-target="1"]').fill(text, timeout=15000)
+            return {"success": True, "placeholder": placeholder_substring, "method": "visible_placeholder"}
+        # Nothing visible yet (e.g. the form is still rendering): let Playwright wait for it.
         page.get_by_placeholder(placeholder_substring).first.fill(text, timeout=15000)
         return {"success": True, "placeholder": placeholder_substring, "method": "get_by_placeholder"}
     except Exception as e:
-        # Fallback: fill first visible+enabled input/textarea whose placeholder contains substring.
-        try:
-            locator = page.locator("input[placeholder], textarea[placeholder]")
-            count = locator.count()
-            target = None
-            needle = (placeholder_substring or "").strip()
-            for i in range(count):
-                item = locator.nth(i)
-                ph = (item.get_attribute("placeholder") or "").strip()
-                if needle and needle not in ph:
-                    continue
-                if item.is_visible() and item.is_enabled():
-                    target = item
-                    break
-            if target is not None:
-                target.fill(text, timeout=15000)
-                return {"success": True, "placeholder": placeholder_substring, "method": "visible_placeholder_fallback"}
-        except Exception:
-            pass
-        err = str(e).lower()
         return {
             "success": False,
-            "error": "timeout" if "timeout" in err or "timeout" in type(e).__name__.lower() else "browser_error",
+            "error": _classify_err(e),
             "placeholder": placeholder_substring,
             "message": str(e),
         }
@@ -258,7 +536,7 @@ def fill_by_placeholder(
     text: str,
 ) -> Dict[str, Any]:
     """Fill the first input whose placeholder contains the given substring (e.g. 输入手机号, 输入验证码)."""
-    return _run_in_browser_process(
+    return _run_in_browser_thread(
         "fill_by_placeholder",
         (session_id, placeholder_substring, text),
         {},
@@ -269,6 +547,7 @@ def _click_by_text_impl(session_id: str, text_substring: str) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    sess["cache"].clear()
     page = sess["page"]
     try:
         page.get_by_text(text_substring).first.click(timeout=15000)
@@ -276,36 +555,14 @@ def _click_by_text_impl(session_id: str, text_substring: str) -> Dict[str, Any]:
     except Exception as e:
         # Fallback: click first visible element whose text includes substring.
         try:
-            clicked = page.evaluate(
-                """
-                (needle) => {
-                  const norm = (s) => (s || "").replace(/\\s+/g, "").trim();
-                  const n = norm(needle);
-                  const selectors = ["button", "a", "[role='button']", "div", "span"];
-                  const nodes = document.querySelectorAll(selectors.join(","));
-                  for (const el of nodes) {
-                    const txt = norm(el.innerText || el.textContent || "");
-                    if (!txt || !txt.includes(n)) continue;
-                    const rect = el.getBoundingClientRect();
-                    const style = window.getComputedStyle(el);
-                    if (rect.width <= 0 || rect.height <= 0) continue;
-                    if (style.visibility === "hidden" || style.display === "none") continue;
-                    el.click();
-                    return true;
-                  }
-                  return false;
-                }
-                """,
-                text_substring,
-            )
+            clicked = _call_helper(sess, "clickByText", text_substring)
             if clicked:
                 return {"success": True, "text": text_substring, "method": "dom_click_fallback"}
         except Exception:
             pass
-        err = str(e).lower()
         return {
             "success": False,
-            "error": "timeout" if "timeout" in err or "timeout" in type(e).__name__.lower() else "browser_error",
+            "error": _classify_err(e),
             "text": text_substring,
             "message": str(e),
         }
@@ -313,123 +570,30 @@ def _click_by_text_impl(session_id: str, text_substring: str) -> Dict[str, Any]:
 
 def click_by_text(session_id: str, text_substring: str) -> Dict[str, Any]:
     """Click the first element whose visible text contains the given substring (e.g. 获取验证码, 登录)."""
-    return _run_in_browser_process("click_by_text", (session_id, text_substring), {})
+    return _run_in_browser_thread("click_by_text", (session_id, text_substring), {})
 
 
 def _check_agreement_impl(session_id: str) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    page = sess["page"]
+    sess["cache"].clear()
     try:
-        result = page.evaluate(
-            """
-            () => {
-              const isVisible = (el) => {
-                const rect = el.getBoundingClientRect();
-                const st = window.getComputedStyle(el);
-                return rect.width > 0 && rect.height > 0 && st.visibility !== "hidden" && st.display !== "none";
-              };
-              const keys = ["我已阅读并同意", "同意", "用户协议", "隐私政策", "青少年个人信息保护规则"];
-              const norm = (s) => (s || "").replace(/\\s+/g, "");
-              const hasKey = (txt) => {
-                const n = norm(txt);
-                return keys.some((k) => n.includes(norm(k)));
-              };
-              const tryClick = (el) => {
-                if (!el || !isVisible(el)) return false;
-                try { el.click(); return true; } catch (_) { return false; }
-              };
-              const checkboxLike = (scope) => {
-                if (!scope) return [];
-                const sels = [
-                  'input[type="checkbox"]',
-                  '[role="checkbox"]',
-                  '[aria-checked]',
-                  '.checkbox',
-                  '[class*="checkbox"]',
-                  '[class*="check"]',
-                  '[class*="agree"]',
-                  '[class*="protocol"]'
-                ];
-                return Array.from(scope.querySelectorAll(sels.join(","))).filter(isVisible);
-              };
-
-              // 1) Prefer agreement-area targeted checkbox, avoid unrelated checkboxes.
-              const textAnchors = Array.from(document.querySelectorAll("label, span, div, p, a, li")).filter(
-                (el) => isVisible(el) && hasKey(el.innerText || el.textContent || "")
-              );
-
-              for (const anchor of textAnchors) {
-                const scopes = [anchor, anchor.parentElement, anchor.parentElement?.parentElement].filter(Boolean);
-                for (const scope of scopes) {
-                  const cbs = checkboxLike(scope);
-                  for (const cb of cbs) {
-                    if (cb.tagName.toLowerCase() === "input" && cb.type === "checkbox") {
-                      if (cb.checked) return { clicked: true, method: "already_checked" };
-                      if (cb.disabled) continue;
-                      if (cb.id) {
-                        const label = document.querySelector(`label[for="${cb.id}"]`);
-                        if (tryClick(label) || tryClick(cb)) return { clicked: true, method: "checkbox_input_or_label" };
-                      } else if (tryClick(cb)) {
-                        return { clicked: true, method: "checkbox_input" };
-                      }
-                    } else {
-                      if (tryClick(cb)) return { clicked: true, method: "checkbox_like" };
-                    }
-                  }
-                }
-
-                // 2) Click small left-side icon in same row (common custom checkbox UI).
-                const row = anchor.closest("label, div, p, li, section") || anchor.parentElement;
-                if (row) {
-                  const rowRect = row.getBoundingClientRect();
-                  const aRect = anchor.getBoundingClientRect();
-                  const candidates = Array.from(row.querySelectorAll("*")).filter((el) => {
-                    if (!isVisible(el)) return false;
-                    const r = el.getBoundingClientRect();
-                    const w = r.width;
-                    const h = r.height;
-                    const squareLike = w >= 8 && h >= 8 && w <= 32 && h <= 32;
-                    const leftOfText = r.right <= aRect.left + 8;
-                    const nearRow = Math.abs(r.top - rowRect.top) < 30 || Math.abs(r.bottom - rowRect.bottom) < 30;
-                    return squareLike && leftOfText && nearRow;
-                  });
-                  for (const c of candidates) {
-                    if (tryClick(c)) return { clicked: true, method: "left_icon_fallback" };
-                  }
-                }
-
-                // 3) Last fallback: clicking the anchor text row itself may toggle checkbox.
-                if (tryClick(anchor)) return { clicked: true, method: "anchor_text_fallback" };
-              }
-
-              // 4) Final fallback: visible unchecked native checkbox anywhere.
-              const boxes = Array.from(document.querySelectorAll('input[type="checkbox"]')).filter(isVisible);
-              for (const box of boxes) {
-                if (box.checked) return { clicked: true, method: "already_checked_global" };
-                if (!box.disabled && tryClick(box)) return { clicked: true, method: "checkbox_global_fallback" };
-              }
-
-              return { clicked: false, method: "not_found" };
-            }
-            """
-        )
+        result = _call_helper(sess, "checkAgreement")
         if isinstance(result, dict) and result.get("clicked"):
             return {"success": True, "method": result.get("method", "unknown")}
         return {"success": False, "error": "agreement_not_found", "message": "No clickable agreement checkbox found"}
     except Exception as e:
-        err = str(e).lower()
         return {
             "success": False,
-            "error": "timeout" if "timeout" in err or "timeout" in type(e).__name__.lower() else "browser_error",
+            "error": _classify_err(e),
             "message": str(e),
         }
 
 
 def check_agreement(session_id: str) -> Dict[str, Any]:
     """Try to check agreement checkbox/label on current page before login actions."""
-    return _run_in_browser_process("check_agreement", (session_id,), {})
+    return _run_in_browser_thread("check_agreement", (session_id,), {})
 
 
 def _get_text_impl(
@@ -440,6 +604,7 @@ def _get_text_impl(
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
+    # Not cached: this is how the agent observes a page that may still be changing on its own.
     text = (sess["page"].inner_text(selector) or "").strip()[:max_chars]
     return {"success": True, "text": text}
 
@@ -450,7 +615,28 @@ def get_text(
     max_chars: int = 2000,
 ) -> Dict[str, Any]:
     """Get text from a selector."""
-    return _run_in_browser_process("get_text", (session_id, selector, max_chars), {})
+    return _run_in_browser_thread("get_text", (session_id, selector, max_chars), {})
+
+
+# The DOM version is bumped by a MutationObserver on any change (modals rendered after an XHR,
+# countdowns, validation errors); the random id changes with every new document. When the
+# caller already holds the source for the current version, only the version string comes back.
+_PAGE_SOURCE_JS = """
+([n, seen]) => {
+  let st = window.__appagentDom;
+  if (!st) {
+    st = window.__appagentDom = { id: Math.random().toString(36).slice(2), v: 0 };
+    new MutationObserver(() => { st.v++; }).observe(document, {
+      subtree: true, childList: true, attributes: true, characterData: true,
+    });
+  }
+  const version = st.id + ":" + st.v;
+  if (version === seen) return [version, null, false];
+  const dt = document.doctype ? new XMLSerializer().serializeToString(document.doctype) : "";
+  const html = (dt + document.documentElement.outerHTML).trim();
+  return [version, html.slice(0, n), html.length > n];
+}
+"""
 
 
 def _get_page_source_impl(session_id: str, max_chars: int) -> Dict[str, Any]:
@@ -458,12 +644,14 @@ def _get_page_source_impl(session_id: str, max_chars: int) -> Dict[str, Any]:
     if not sess:
         return {"success": False, "error": "session_not_found", "html": ""}
     try:
-        html = sess["page"].content()
-        if html is None:
-            html = ""
-        html = html.strip()
-        if len(html) > max_chars:
-            html = html[:max_chars] + "\n... (truncated)"
+        cache = sess["cache"]
+        key = ("html", max_chars)
+        seen, html = cache.get(key, (None, None))
+        # Trim and slice in the page so only max_chars cross the CDP socket, not the whole DOM.
+        version, head, truncated = sess["page"].evaluate(_PAGE_SOURCE_JS, [max_chars, seen])
+        if head is not None:
+            html = head + "\n... (truncated)" if truncated else head
+            cache[key] = (version, html)
         return {"success": True, "html": html}
     except Exception as e:
         return {"success": False, "error": str(e), "html": ""}
@@ -473,35 +661,99 @@ def get_page_source(
     session_id: str,
     max_chars: int = 18000,
 ) -> Dict[str, Any]:
-    """Get the current page HTML source so the agent can see the page structure (forms, inputs, buttons)."""
-    return _run_in_browser_process("get_page_source", (session_id, max_chars), {})
+    """Get the current page HTML source so the agent can see the page structure (forms, inputs, buttons).
+
+    Truncation to max_chars happens in the page. The result is reused only while the DOM
+    is unchanged (tracked in the page by a MutationObserver) and no action has run since.
+    """
+    return _run_in_browser_thread("get_page_source", (session_id, max_chars), {})
+
+
+def _ensure_parent_dir(path: str) -> None:
+    """mkdir -p the file's directory once per process; screenshot traces reuse a few folders."""
+    parent = os.path.dirname(path) or "."
+    if parent not in _MADE_DIRS:
+        os.makedirs(parent, exist_ok=True)
+        _MADE_DIRS.add(parent)
 
 
 def _screenshot_impl(
     session_id: str,
     screenshot_path: str,
     full_page: bool,
+    return_bytes: bool = False,
 ) -> Dict[str, Any]:
     sess = _SESSIONS.get(session_id)
     if not sess:
         return {"success": False, "error": "session_not_found"}
-    Path(screenshot_path).parent.mkdir(parents=True, exist_ok=True)
+    if return_bytes:
+        png = sess["page"].screenshot(full_page=full_page)
+        res: Dict[str, Any] = {"success": True, "png": png}
+        if screenshot_path:
+            _ensure_parent_dir(screenshot_path)
+            Path(screenshot_path).write_bytes(png)
+            res["screenshot"] = screenshot_path
+        return res
+    _ensure_parent_dir(screenshot_path)
     sess["page"].screenshot(path=screenshot_path, full_page=full_page)
     return {"success": True, "screenshot": screenshot_path}
 
 
 def screenshot(
     session_id: str,
-    screenshot_path: str,
+    screenshot_path: str = "",
     full_page: bool = True,
+    return_bytes: bool = False,
+) -> Dict[str, Any]:
+    """Take a screenshot.
+
+    With return_bytes=True the PNG comes back as result["png"] (and is also written to
+    screenshot_path when one is given); otherwise the file is written directly.
+    """
+    return _run_in_browser_thread(
+        "screenshot", (session_id, screenshot_path, full_page, return_bytes), {}
+    )
+
+
+def _run_batch_impl(
+    session_id: str,
+    steps: List[Any],
+    stop_on_error: bool = True,
 ) -> Dict[str, Any]:
-    """Take a screenshot."""
-    return _run_in_browser_process("screenshot", (session_id, screenshot_path, full_page), {})
+    results: List[Dict[str, Any]] = []
+    for step in steps:
+        op, args, kwargs = (list(step) + [(), {}])[:3]
+        try:
+            if op not in _DISPATCH or op in ("start_session", "close_session", "shutdown", "run_batch"):
+                raise ValueError(f"unsupported batch op: {op!r}")
+            res = _DISPATCH[op](session_id, *(args or ()), **(kwargs or {}))
+        except Exception as e:
+            res = {"success": False, "error": "batch_step_failed", "message": f"{type(e).__name__}: {e}"}
+        results.append({"op": op, **res})
+        if stop_on_error and not res.get("success", False):
+            break
+    ok = len(results) == len(steps) and all(r.get("success", False) for r in results)
+    return {"success": ok, "completed": len(results), "results": results}
+
+
+def run_batch(
+    session_id: str,
+    steps: List[Any],
+    stop_on_error: bool = True,
+) -> Dict[str, Any]:
+    """Run several page operations in one worker round-trip.
+
+    steps: list of (op, args, kwargs) using the _DISPATCH op names, with session_id omitted,
+    e.g. [("check_agreement", (), {}), ("fill_by_placeholder", ("手机号", "138..."), {}),
+    ("click_by_text", ("获取验证码",), {})].
+    """
+    return _run_in_browser_thread("run_batch", (session_id, list(steps), stop_on_error), {})
 
 
 _DISPATCH: Dict[str, Any] = {
     "start_session": _start_session_impl,
     "close_session": _close_session_impl,
+    "shutdown": _shutdown_impl,
     "open_url": _open_url_impl,
     "fill_selector": _fill_selector_impl,
     "click_selector": _click_selector_impl,
@@ -512,4 +764,5 @@ _DISPATCH: Dict[str, Any] = {
     "get_text": _get_text_impl,
     "get_page_source": _get_page_source_impl,
     "screenshot": _screenshot_impl,
+    "run_batch": _run_batch_impl,
 }
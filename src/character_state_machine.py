@@ -2,25 +2,200 @@
 人物状态机模块：管理小说中所有人物的外貌、年龄、性别等信息
 支持替名映射，确保人物特征的一致性
 """
+import functools
 import json
 import re
+import sys
+import threading
+import time
 from typing import Dict, List, Optional, Set, Any
 from pathlib import Path
 import openai
 import os
 from dotenv import load_dotenv
+from src.api_cost_tracker import BATCH_PRICE_FACTOR
 
 load_dotenv()
 
+# 可选：msgpack 比 JSON 解析/序列化更快，未安装时状态文件仍使用 JSON
+try:
+    import msgpack
+except ImportError:
+    msgpack = None
+
+# 可选：orjson 解析 LLM 返回的 JSON 和读写 JSON 状态文件更快，未安装时使用标准库 json
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+_json_loads = orjson.loads if orjson is not None else json.loads
+_JSON_WRITE_BUFFER = 1 << 20
+
+# 可选：Aho-Corasick 自动机一次扫描匹配所有人名，未安装时逐个名称做子串检查
+try:
+    import ahocorasick
+except ImportError:
+    ahocorasick = None
+
+# 可选：未安装 pyahocorasick 时，人物很多的情况下用 Numba 并行逐名扫描
+try:
+    import numpy as np
+    from numba import njit, prange
+except ImportError:
+    np = None
+    njit = None
+
+# 人物数达到该值才走 Numba 内核（人物少时编码开销大于收益）
+_NUMBA_MIN_CHARACTERS = 512
+
+if njit is not None:
+    @njit(parallel=True, cache=True)
+    def _find_names_kernel(text_codes, name_codes, offsets, hits):
+        """并行检查每个人名是否出现在文本中，输入均为 uint32 码点数组；命中时 hits[i] = 1"""
+        n = text_codes.shape[0]
+        for i in prange(offsets.shape[0] - 1):
+            start = offsets[i]
+            m = offsets[i + 1] - start
+            if m == 0 or m > n:
+                continue
+            first = name_codes[start]
+            for j in range(n - m + 1):
+                if text_codes[j] != first:
+                    continue
+                k = 1
+                while k < m and text_codes[j + k] == name_codes[start + k]:
+                    k += 1
+                if k == m:
+                    hits[i] = 1
+                    break
+else:
+    _find_names_kernel = None
+
+
+# 简单规则提取：姓名模式（中文姓名通常2-4个字）与常见的非人名词汇
+_NAME_RE = re.compile(r'[A-Za-z]{2,}|[\u4e00-\u9fa5]{2,4}')
+_STOPWORDS = frozenset(('这个', '那个', '什么', '怎么', '哪里'))
+
+# LLM 返回内容首尾可能带的 markdown 代码块标记
+_FENCE_RE = re.compile(r'^\s*```(?:json)?\s*|\s*```\s*$')
+
+# 人物提取提示词中单片段与批量请求共用的部分
+_EXTRACT_INSTRUCTIONS = """请识别：
+1. 片段中出现的所有人物名称（包括替名、昵称等）
+2. 每个人物的外貌描述（头发、眼睛、身高、体型等，若没有则根据小说构思）
+3. 人物性别和年龄信息
+4. 人物服装描述
+5. 替名关系（如果一个人物有多个名字）"""
+
+_CHARACTER_JSON_FORMAT = """    {
+      "name": "人物主名",
+      "aliases": ["替名1", "替名2"],
+      "gender": "男/女/未知",
+      "age": 具体年龄或null,
+      "age_range": "少年/青年/中年/老年/未知",
+      "appearance": {
+        "hair_color": "发色",
+        "hair_style": "发型",
+        "eye_color": "眼色",
+        "height": "身高描述",
+        "build": "体型描述",
+        "other": "其他外貌特征"
+      },
+      "clothing": {
+        "description": "服装描述，若没有则根据小说构思"
+      },
+      "role": "主角/配角/反派/未知"
+    }"""
+
+
+def _locked(method):
+    """在状态机的可重入锁内执行方法（流水线模式下阶段1写入、阶段2读取可能并发）"""
+    @functools.wraps(method)
+    def wrapper(self, *args, **kwargs):
+        with self._lock:
+            return method(self, *args, **kwargs)
+    return wrapper
+
+
+# 性别/年龄段/角色和外貌字段在人物之间大量重复（"男"、"青年"、"hair_color"、"黑色"……），
+# 但每次解析 JSON 都会生成新的字符串对象；驻留后所有人物共用同一份
+_INTERNED_FIELDS = ('gender', 'age_range', 'role')
+
+
+def _intern(value):
+    return sys.intern(value) if type(value) is str else value
+
+
+def _intern_fields(char_info: Dict) -> None:
+    """驻留一个人物的分类字段与外貌字段（加载状态文件后调用）"""
+    for field in _INTERNED_FIELDS:
+        if field in char_info:
+            char_info[field] = _intern(char_info[field])
+    appearance = char_info.get('appearance')
+    if appearance:
+        char_info['appearance'] = {_intern(k): _intern(v) for k, v in appearance.items()}
+
+
+# 提示词中外貌字段的输出顺序与标签
+_APPEARANCE_LABELS = (
+    ('hair_color', '发色'),
+    ('hair_style', '发型'),
+    ('eye_color', '眼色'),
+    ('height', '身高'),
+    ('build', '体型'),
+    ('other', '其他'),
+)
+_EMPTY: Dict[str, Any] = {}  # 只读的空字典，用于缺省的 appearance / clothing
+
+
+def _format_character(char: Dict) -> str:
+    """单个人物的提示词文本：人物 | 性别 | 年龄 | 外貌 | 服装"""
+    names = char.get('names')
+    name = names[0] if names else '未知'
+    aliases = char.get('aliases')
+    if aliases:
+        name += f"（别名：{', '.join(aliases)}）"
+    info_parts = [f"人物：{name}"]
+    
+    gender = char.get('gender')
+    if gender:
+        info_parts.append(f"性别：{gender}")
+    
+    if char.get('age'):
+        info_parts.append(f"年龄：{char['age']}岁")
+    elif char.get('age_range'):
+        info_parts.append(f"年龄段：{char['age_range']}")
+    
+    appearance = char.get('appearance') or _EMPTY
+    looks = "，".join(
+        f"{label}：{appearance[key]}" for key, label in _APPEARANCE_LABELS if appearance.get(key)
+    )
+    if looks:
+        info_parts.append("外貌：" + looks)
+    
+    description = (char.get('clothing') or _EMPTY).get('description')
+    if description:
+        info_parts.append(f"服装：{description}")
+    
+    return " | ".join(info_parts)
 
 class CharacterStateMachine:
     """人物状态机：存储和更新人物信息"""
     
+    # 状态文件名：优先 msgpack；旧版 JSON 文件仍可加载，下次保存时自动迁移
+    STATE_FILE_NAME = "character_state.msgpack" if msgpack is not None else "character_state.json"
+    LEGACY_STATE_FILE_NAME = "character_state.json"
+    
+    # 修改人物提取提示词后递增，使旧的缓存结果失效
+    EXTRACT_CACHE_VERSION = 1
+    
     def __init__(
         self,
         api_key: Optional[str] = None,
         base_url: Optional[str] = None,
-        model: str = "qwen3.5-397b-a17b"
+        model: str = "qwen3.5-397b-a17b",
+        max_retries: int = 2,
     ):
         """
         初始化人物状态机
@@ -29,6 +204,7 @@ class CharacterStateMachine:
             api_key: API密钥
             base_url: API基础URL
             model: 使用的模型名称
+            max_retries: 限流(429)/服务端错误时 SDK 自动退避重试的次数
         """
         # 人物信息字典：{人物ID: 人物信息}
         self.characters: Dict[str, Dict] = {}
@@ -39,6 +215,20 @@ class CharacterStateMachine:
         # 人物ID计数器
         self.character_id_counter = 0
         
+        # 主名索引：{主名: 人物ID}（与 characters 同步维护，get_character_id 免去线性扫描）
+        self._name_to_id: Dict[str, str] = {}
+        
+        self._lock = threading.RLock()
+        
+        # 自上次保存/加载以来是否有改动（未改动时 save 跳过写盘）
+        self._dirty = False
+        
+        # 人名匹配结构（Aho-Corasick 自动机或 Numba 码点数组；懒构建，人名/替名变化时置为 None）
+        self._name_matcher = None
+        
+        # 可选：LLM 结果缓存（src.llm_cache.LLMCache），由调用方设置
+        self.cache = None
+        
         # LLM客户端（用于提取人物信息）
         self.model = model
         is_qwen = "qwen" in model.lower()
@@ -52,9 +242,12 @@ class CharacterStateMachine:
         
         if api_key:
             final_base_url = base_url or os.getenv("OPENAI_BASE_URL") or (default_base_url if is_qwen else None)
+            # 并发提取时容易触发限流：交给 SDK 按 Retry-After 指数退避重试，
+            # 避免失败后退回简单规则、把普通词语当成人物写进状态机
             self.client = openai.OpenAI(
                 api_key=api_key,
-                base_url=final_base_url
+                base_url=final_base_url,
+                max_retries=max_retries,
             )
             self.use_llm = True
         else:
@@ -71,17 +264,10 @@ class CharacterStateMachine:
         Returns:
             人物ID，如果不存在则返回None
         """
-        # 先检查替名映射
-        if name in self.name_mapping:
-            name = self.name_mapping[name]
-        
-        # 查找人物ID
-        for char_id, char_info in self.characters.items():
-            if name in char_info.get('names', []):
-                return char_id
-        
-        return None
+        # 先检查替名映射，再查主名索引
+        return self._name_to_id.get(self.name_mapping.get(name, name))
     
+    @_locked
     def get_or_create_character(self, name: str) -> str:
         """
         获取或创建人物
@@ -101,6 +287,8 @@ class CharacterStateMachine:
         self.character_id_counter += 1
         char_id = f"char_{self.character_id_counter:04d}"
         
+        self._name_matcher = None
+        self._name_to_id.setdefault(name, char_id)
         self.characters[char_id] = {
             'id': char_id,
             'names': [name],  # 主名
@@ -115,6 +303,7 @@ class CharacterStateMachine:
             'first_appearance': None,  # 首次出现位置
             'last_updated': None       # 最后更新时间
         }
+        self._dirty = True
         
         return char_id
     
@@ -134,86 +323,343 @@ class CharacterStateMachine:
         Returns:
             文本中提到的人物ID列表
         """
+        extracted = self.extract_characters(text, cost_tracker=cost_tracker)
+        return self.apply_extracted_characters(extracted, text, fragment_index=fragment_index)
+    
+    def extract_characters(
+        self,
+        text: str,
+        cost_tracker: Optional[Any] = None,
+    ) -> Optional[Dict]:
+        """
+        调用LLM提取片段中的人物信息（不修改状态机，可在多线程中并发调用）
+        
+        Args:
+            text: 文本内容
+        
+        Returns:
+            LLM 返回的人物信息字典；不使用LLM或提取失败时返回None
+        """
         if not self.use_llm:
-            # 如果不使用LLM，使用简单规则提取
-            return self._extract_characters_simple(text)
+            return None
         
-        # 使用LLM提取人物信息
-        mentioned_char_ids = []
+        cached = self._cache_get(text)
+        if cached is not None:
+            return cached
+        return self._extract_uncached(text, cost_tracker)
+    
+    def _extract_uncached(self, text: str, cost_tracker: Optional[Any] = None) -> Optional[Dict]:
+        """单片段提取（不查缓存，成功后写入缓存）"""
+        try:
+            prompt = self._single_extract_prompt(text)
+            result = self._request_json(prompt, cost_tracker)
+            self._cache_put(text, result)
+            return result
+            
+        except Exception as e:
+            print(f"⚠️ 提取人物信息失败: {e}，使用简单规则")
+            return None
+    
+    def _cache_key(self, text: str) -> str:
+        """提取结果的缓存键（只有前 1000 字会发给 LLM，按此截断）"""
+        return self.cache.make_key("character", self.EXTRACT_CACHE_VERSION, self.model, text[:1000])
+    
+    def _cache_get(self, text: str) -> Optional[Dict]:
+        if self.cache is None:
+            return None
+        cached = self.cache.get(self._cache_key(text))
+        return cached if isinstance(cached, dict) else None
+    
+    def _cache_put(self, text: str, result: Any):
+        if self.cache is not None and isinstance(result, dict):
+            self.cache.set(self._cache_key(text), result)
+    
+    def extract_characters_marshaled(
+        self,
+        texts: List[str],
+        cost_tracker: Optional[Any] = None,
+    ) -> List[Optional[Dict]]:
+        """
+        将多个片段合并到一次LLM调用中提取人物信息（以 ### FRAG n ### 分隔）
         
+        Args:
+            texts: 片段文本列表（一个批次）
+        
+        Returns:
+            与 texts 一一对应的 extract_characters 结果；解析失败时逐个调用 extract_characters
+        """
+        if not self.use_llm:
+            return [None] * len(texts)
+        
+        # 命中缓存的片段不再请求；内容相同的片段（按实际发送的前 1000 字）只请求一次
+        results: List[Optional[Dict]] = [None] * len(texts)
+        pending: Dict[str, List[int]] = {}
+        for k, t in enumerate(texts):
+            cached = self._cache_get(t)
+            if cached is not None:
+                results[k] = cached
+            else:
+                pending.setdefault(t[:1000], []).append(k)
+        
+        snippets = list(pending)
+        if len(snippets) <= 1:
+            extracted = [self._extract_uncached(t, cost_tracker) for t in snippets]
+        else:
+            extracted = self._extract_marshaled_uncached(snippets, cost_tracker)
+        for snippet, result in zip(snippets, extracted):
+            for k in pending[snippet]:
+                results[k] = result
+        return results
+    
+    def _extract_marshaled_uncached(
+        self,
+        texts: List[str],
+        cost_tracker: Optional[Any] = None,
+    ) -> List[Optional[Dict]]:
+        """合并请求多个未缓存片段，成功后逐个写入缓存"""
+        n = len(texts)
+        joined = "\n\n".join(f"### FRAG {k} ###\n{t[:1000]}" for k, t in enumerate(texts, 1))
         try:
-            prompt = f"""请分析以下小说片段，提取和更新人物信息。
+            prompt = f"""请分析以下 {n} 个小说片段（以 ### FRAG n ### 分隔），逐一提取和更新人物信息。
 
 小说片段：
-{text[:1000]}
+{joined}
 
-请识别：
-1. 片段中出现的所有人物名称（包括替名、昵称等）
-2. 每个人物的外貌描述（头发、眼睛、身高、体型等，若没有则根据小说构思）
-3. 人物性别和年龄信息
-4. 人物服装描述
-5. 替名关系（如果一个人物有多个名字）
+对每个片段分别：
+{_EXTRACT_INSTRUCTIONS}
 
 请以JSON格式返回，格式：
 {{
-  "characters": [
+  "fragments": [
     {{
-      "name": "人物主名",
-      "aliases": ["替名1", "替名2"],
-      "gender": "男/女/未知",
-      "age": 具体年龄或null,
-      "age_range": "少年/青年/中年/老年/未知",
-      "appearance": {{
-        "hair_color": "发色",
-        "hair_style": "发型",
-        "eye_color": "眼色",
-        "height": "身高描述",
-        "build": "体型描述",
-        "other": "其他外貌特征"
-      }},
-      "clothing": {{
-        "description": "服装描述，若没有则根据小说构思"
-      }},
-      "role": "主角/配角/反派/未知"
+      "frag": 1,
+      "characters": [
+{_CHARACTER_JSON_FORMAT}
+      ]
     }}
   ]
 }}
 
+fragments 必须恰好包含 {n} 项并按片段顺序排列。只返回JSON，不要其他内容。"""
+            items = self._request_json(prompt, cost_tracker).get("fragments")
+            if not isinstance(items, list) or len(items) != n:
+                raise ValueError(f"期望 {n} 项结果，实际 {len(items) if isinstance(items, list) else 0} 项")
+            results = [{"characters": item.get("characters", [])} for item in items]
+        except Exception as e:
+            print(f"⚠️ 批量提取人物信息失败: {e}，逐个提取")
+            return [self._extract_uncached(t, cost_tracker) for t in texts]
+        for t, result in zip(texts, results):
+            self._cache_put(t, result)
+        return results
+    
+    def update_characters_from_texts(
+        self,
+        texts: List[str],
+        fragment_indices: List[Optional[int]],
+        cost_tracker: Optional[Any] = None,
+    ) -> List[List[str]]:
+        """
+        一次LLM调用提取多个片段的人物信息，再按片段顺序合并
+        
+        Returns:
+            每个片段中提到的人物ID列表
+        """
+        extracted = self.extract_characters_marshaled(texts, cost_tracker=cost_tracker)
+        return [
+            self.apply_extracted_characters(result, text, fragment_index=index)
+            for result, text, index in zip(extracted, texts, fragment_indices)
+        ]
+    
+    @staticmethod
+    def _single_extract_prompt(text: str) -> str:
+        """单个片段的人物提取提示词"""
+        return f"""请分析以下小说片段，提取和更新人物信息。
+
+小说片段：
+{text[:1000]}
+
+{_EXTRACT_INSTRUCTIONS}
+
+请以JSON格式返回，格式：
+{{
+  "characters": [
+{_CHARACTER_JSON_FORMAT}
+  ]
+}}
+
 只返回JSON，不要其他内容。"""
-            
-            response = self.client.chat.completions.create(
-                model=self.model,
-                messages=[
-                    {
-                        "role": "system",
-                        "content": "你是一个专业的小说人物信息提取专家。请严格按照JSON格式返回结果，只返回JSON，不要其他内容。"
+    
+    @staticmethod
+    def _extract_messages(prompt: str) -> List[Dict[str, str]]:
+        """人物提取请求的 messages"""
+        return [
+            {
+                "role": "system",
+                "content": "你是一个专业的小说人物信息提取专家。请严格按照JSON格式返回结果，只返回JSON，不要其他内容。"
+            },
+            {
+                "role": "user",
+                "content": prompt
+            }
+        ]
+    
+    @staticmethod
+    def _parse_json_text(result_text: str) -> Dict:
+        """解析LLM返回的JSON文本（移除可能的markdown代码块标记）"""
+        # json_object 模式下通常没有代码块标记，先用子串检查跳过正则；首尾空白两种解析器都接受
+        if "```" in result_text:
+            result_text = _FENCE_RE.sub("", result_text)
+        return _json_loads(result_text)
+    
+    def _request_json(self, prompt: str, cost_tracker: Optional[Any] = None) -> Dict:
+        """发送人物提取请求并解析返回的JSON"""
+        response = self.client.chat.completions.create(
+            model=self.model,
+            messages=self._extract_messages(prompt),
+            temperature=0.3,
+            response_format={"type": "json_object"}
+        )
+        
+        if cost_tracker and hasattr(cost_tracker, "record_from_response"):
+            cost_tracker.record_from_response("character_state", response)
+        
+        return self._parse_json_text(response.choices[0].message.content)
+    
+    def submit_batch(self, texts: List[str], jsonl_path: str, completion_window: str = "24h") -> str:
+        """
+        离线模式：将所有片段的人物提取请求写成 JSONL，通过 Batch API 提交（费用约为同步调用的一半）
+        
+        Args:
+            texts: 片段文本列表（custom_id 为 frag_{序号}）
+            jsonl_path: 请求文件的保存路径
+            completion_window: 完成时限
+        
+        Returns:
+            batch_id，交给 poll_and_apply 取回结果
+        """
+        if not self.use_llm:
+            raise RuntimeError("未配置 API Key，无法使用 Batch API")
+        
+        with open(jsonl_path, 'w', encoding='utf-8') as f:
+            for i, text in enumerate(texts):
+                request = {
+                    "custom_id": f"frag_{i}",
+                    "method": "POST",
+                    "url": "/v1/chat/completions",
+                    "body": {
+                        "model": self.model,
+                        "messages": self._extract_messages(self._single_extract_prompt(text)),
+                        "temperature": 0.3,
+                        "response_format": {"type": "json_object"},
                     },
-                    {
-                        "role": "user",
-                        "content": prompt
-                    }
-                ],
-                temperature=0.3,
-                response_format={"type": "json_object"}
-            )
-            
-            if cost_tracker and hasattr(cost_tracker, "record_from_response"):
-                cost_tracker.record_from_response("character_state", response)
-            
-            result_text = response.choices[0].message.content.strip()
-            # 移除可能的markdown代码块标记
-            if result_text.startswith("```json"):
-                result_text = result_text[7:]
-            if result_text.startswith("```"):
-                result_text = result_text[3:]
-            if result_text.endswith("```"):
-                result_text = result_text[:-3]
-            result_text = result_text.strip()
-            
-            result = json.loads(result_text)
-            
+                }
+                f.write(json.dumps(request, ensure_ascii=False) + "\n")
+        
+        with open(jsonl_path, 'rb') as f:
+            input_file = self.client.files.create(file=f, purpose="batch")
+        batch = self.client.batches.create(
+            input_file_id=input_file.id,
+            endpoint="/v1/chat/completions",
+            completion_window=completion_window,
+        )
+        print(f"✅ 已提交人物提取批任务: {batch.id}（{len(texts)} 个片段）")
+        return batch.id
+    
+    def poll_and_apply(
+        self,
+        batch_id: str,
+        texts: List[str],
+        fragment_indices: Optional[List[Optional[int]]] = None,
+        poll_interval: float = 30.0,
+        cost_tracker: Optional[Any] = None,
+        timeout_s: float = 24 * 3600.0,
+    ) -> List[List[str]]:
+        """
+        等待 submit_batch 提交的批任务完成，按片段顺序合并结果
+        
+        Args:
+            batch_id: submit_batch 的返回值
+            texts: 与提交时相同的片段文本列表
+            fragment_indices: 片段索引（用于记录位置），默认使用序号
+            poll_interval: 轮询间隔（秒）
+            cost_tracker: 可选，批任务用量按 Batch 折扣价记在 character_state_batch 步骤下
+            timeout_s: 最长等待时间（秒），超时抛出 TimeoutError（批任务不会被取消）
+        
+        Returns:
+            每个片段中提到的人物ID列表；批任务中失败的片段改为同步提取
+        """
+        deadline = time.monotonic() + timeout_s
+        while True:
+            batch = self.client.batches.retrieve(batch_id)
+            if batch.status == "completed":
+                break
+            if batch.status in ("failed", "expired", "cancelled"):
+                raise RuntimeError(f"批任务 {batch_id} 未完成: {batch.status}")
+            remaining = deadline - time.monotonic()
+            if remaining <= 0:
+                raise TimeoutError(f"等待批任务 {batch_id} 超时（{timeout_s:g} 秒），当前状态: {batch.status}")
+            time.sleep(min(poll_interval, remaining))
+        
+        extracted: Dict[str, Dict] = {}
+        if batch.output_file_id:
+            content = self.client.files.content(batch.output_file_id).text
+            for line in content.splitlines():
+                if not line.strip():
+                    continue
+                item = _json_loads(line)
+                response = item.get("response") or {}
+                if response.get("status_code") != 200:
+                    continue
+                body = response.get("body") or {}
+                usage = body.get("usage") or {}
+                if cost_tracker and hasattr(cost_tracker, "record_usage"):
+                    cost_tracker.record_usage(
+                        "character_state_batch",
+                        input_tokens=usage.get("prompt_tokens", 0),
+                        output_tokens=usage.get("completion_tokens", 0),
+                        price_factor=BATCH_PRICE_FACTOR,
+                    )
+                try:
+                    extracted[item["custom_id"]] = self._parse_json_text(body["choices"][0]["message"]["content"])
+                except (KeyError, IndexError, ValueError) as e:
+                    print(f"⚠️ 批任务结果解析失败 {item.get('custom_id')}: {e}")
+        
+        if fragment_indices is None:
+            fragment_indices = list(range(len(texts)))
+        mentioned = []
+        for i, (text, index) in enumerate(zip(texts, fragment_indices)):
+            result = extracted.get(f"frag_{i}")
+            if result is None:
+                result = self.extract_characters(text, cost_tracker=cost_tracker)
+            mentioned.append(self.apply_extracted_characters(result, text, fragment_index=index))
+        return mentioned
+    
+    @_locked
+    def apply_extracted_characters(
+        self,
+        extracted: Optional[Dict],
+        text: str,
+        fragment_index: Optional[int] = None,
+    ) -> List[str]:
+        """
+        将 extract_characters 的结果合并进状态机
+        
+        Args:
+            extracted: extract_characters 的返回值，None 时使用简单规则提取
+            text: 文本内容
+            fragment_index: 片段索引（用于记录位置）
+        
+        Returns:
+            文本中提到的人物ID列表
+        """
+        if extracted is None:
+            return self._extract_characters_simple(text)
+        
+        mentioned_char_ids = []
+        
+        try:
             # 处理提取的人物信息
-            for char_data in result.get('characters', []):
+            for char_data in extracted.get('characters', []):
                 name = char_data.get('name', '')
                 if not name:
                     continue
@@ -221,6 +667,7 @@ class CharacterStateMachine:
                 # 获取或创建人物
                 char_id = self.get_or_create_character(name)
                 char_info = self.characters[char_id]
+                self._dirty = True
                 
                 # 更新替名映射
                 aliases = char_data.get('aliases', [])
@@ -229,28 +676,29 @@ class CharacterStateMachine:
                         self.name_mapping[alias] = name
                         if alias not in char_info['aliases']:
                             char_info['aliases'].append(alias)
+                            self._name_matcher = None
                 
                 # 更新基本信息
                 if char_data.get('gender'):
                     if not char_info['gender'] or char_info['gender'] == '未知':
-                        char_info['gender'] = char_data['gender']
+                        char_info['gender'] = _intern(char_data['gender'])
                 
                 if char_data.get('age'):
                     char_info['age'] = char_data['age']
                 
                 if char_data.get('age_range'):
                     if not char_info['age_range'] or char_info['age_range'] == '未知':
-                        char_info['age_range'] = char_data['age_range']
+                        char_info['age_range'] = _intern(char_data['age_range'])
                 
                 if char_data.get('role'):
                     if not char_info['role'] or char_info['role'] == '未知':
-                        char_info['role'] = char_data['role']
+                        char_info['role'] = _intern(char_data['role'])
                 
                 # 更新外貌信息（合并，保留已有信息）
                 appearance = char_data.get('appearance', {})
                 for key, value in appearance.items():
                     if value and (not char_info['appearance'].get(key) or char_info['appearance'][key] == '未知'):
-                        char_info['appearance'][key] = value
+                        char_info['appearance'][_intern(key)] = _intern(value)
                 
                 # 更新服装信息
                 clothing = char_data.get('clothing', {})
@@ -274,6 +722,7 @@ class CharacterStateMachine:
             print(f"⚠️ 提取人物信息失败: {e}，使用简单规则")
             return self._extract_characters_simple(text)
     
+    @_locked
     def _extract_characters_simple(self, text: str) -> List[str]:
         """
         使用简单规则提取人物名称（备用方案）
@@ -284,20 +733,20 @@ class CharacterStateMachine:
         Returns:
             提到的人物ID列表
         """
-        # 简单的姓名模式（中文姓名通常2-4个字）
-        name_pattern = r'[A-Za-z]{2,}|[\u4e00-\u9fa5]{2,4}'
-        potential_names = re.findall(name_pattern, text)
-        
         mentioned_char_ids = []
-        for name in set(potential_names):
+        seen = set()
+        # dict.fromkeys 去重并保持出现顺序（set 的遍历顺序每次运行都不同，人物ID分配不可复现）
+        for name in dict.fromkeys(_NAME_RE.findall(text)):
             # 过滤掉常见的非人名词汇
-            if len(name) >= 2 and name not in ['这个', '那个', '什么', '怎么', '哪里']:
+            if len(name) >= 2 and name not in _STOPWORDS:
                 char_id = self.get_or_create_character(name)
-                if char_id not in mentioned_char_ids:
+                if char_id not in seen:
+                    seen.add(char_id)
                     mentioned_char_ids.append(char_id)
         
         return mentioned_char_ids
     
+    @_locked
     def get_characters_in_text(self, text: str) -> List[Dict]:
         """
         获取文本中提到的人物及其状态信息
@@ -308,16 +757,21 @@ class CharacterStateMachine:
         Returns:
             人物信息列表
         """
-        mentioned_char_ids = []
-        
-        # 检查所有已知人物名称
-        for char_id, char_info in self.characters.items():
-            all_names = [char_info['names'][0]] + char_info.get('aliases', [])
-            for name in all_names:
-                if name in text:
-                    if char_id not in mentioned_char_ids:
-                        mentioned_char_ids.append(char_id)
-                    break
+        if ahocorasick is not None:
+            mentioned_char_ids = self._match_names(text)
+        elif _find_names_kernel is not None and len(self.characters) >= _NUMBA_MIN_CHARACTERS:
+            mentioned_char_ids = self._match_names_numba(text)
+        else:
+            mentioned_char_ids = []
+            
+            # 检查所有已知人物名称
+            for char_id, char_info in self.characters.items():
+                all_names = [char_info['names'][0]] + char_info.get('aliases', [])
+                for name in all_names:
+                    if name in text:
+                        if char_id not in mentioned_char_ids:
+                            mentioned_char_ids.append(char_id)
+                        break
         
         # 返回人物信息
         result = []
@@ -330,6 +784,52 @@ class CharacterStateMachine:
         
         return result
     
+    def _match_names(self, text: str) -> List[str]:
+        """用 Aho-Corasick 自动机单次扫描文本，按人物顺序返回匹配到的人物ID"""
+        if not self.characters or not text:
+            return []
+        if self._name_matcher is None:
+            automaton = ahocorasick.Automaton()
+            for name, char_ids in self._ids_by_name().items():
+                automaton.add_word(name, char_ids)
+            automaton.make_automaton()
+            self._name_matcher = automaton
+        
+        matched = set()
+        for _, char_ids in self._name_matcher.iter(text):
+            matched.update(char_ids)
+        return [char_id for char_id in self.characters if char_id in matched]
+    
+    def _match_names_numba(self, text: str) -> List[str]:
+        """用 Numba 内核并行扫描所有人名，按人物顺序返回匹配到的人物ID"""
+        if not text:
+            return []
+        if self._name_matcher is None:
+            ids_by_name = self._ids_by_name()
+            names = list(ids_by_name)
+            offsets = np.zeros(len(names) + 1, dtype=np.int64)
+            np.cumsum([len(name) for name in names], out=offsets[1:])
+            name_codes = np.frombuffer("".join(names).encode('utf-32-le'), dtype=np.uint32)
+            self._name_matcher = (name_codes, offsets, list(ids_by_name.values()))
+        name_codes, offsets, owners = self._name_matcher
+        
+        text_codes = np.frombuffer(text.encode('utf-32-le'), dtype=np.uint32)
+        hits = np.zeros(len(owners), dtype=np.uint8)
+        _find_names_kernel(text_codes, name_codes, offsets, hits)
+        matched = set()
+        for i in np.flatnonzero(hits).tolist():
+            matched.update(owners[i])
+        return [char_id for char_id in self.characters if char_id in matched]
+    
+    def _ids_by_name(self) -> Dict[str, List[str]]:
+        """所有主名/替名到人物ID列表的映射（同一替名可能属于多个人物）"""
+        ids_by_name: Dict[str, List[str]] = {}
+        for char_id, char_info in self.characters.items():
+            for name in [char_info['names'][0]] + char_info.get('aliases', []):
+                if name and char_id not in ids_by_name.setdefault(name, []):
+                    ids_by_name[name].append(char_id)
+        return ids_by_name
+    
     def format_characters_for_prompt(self, characters: List[Dict]) -> str:
         """
         格式化人物信息用于提示词生成
@@ -343,66 +843,46 @@ class CharacterStateMachine:
         if not characters:
             return "无"
         
-        formatted = []
-        for char in characters:
-            info_parts = []
-            
-            # 基本信息
-            name = char['names'][0] if char.get('names') else '未知'
-            if char.get('aliases'):
-                name += f"（别名：{', '.join(char['aliases'])}）"
-            
-            info_parts.append(f"人物：{name}")
-            
-            if char.get('gender'):
-                info_parts.append(f"性别：{char['gender']}")
-            
-            if char.get('age'):
-                info_parts.append(f"年龄：{char['age']}岁")
-            elif char.get('age_range'):
-                info_parts.append(f"年龄段：{char['age_range']}")
-            
-            # 外貌特征
-            appearance = char.get('appearance', {})
-            if appearance:
-                appearance_parts = []
-                if appearance.get('hair_color'):
-                    appearance_parts.append(f"发色：{appearance['hair_color']}")
-                if appearance.get('hair_style'):
-                    appearance_parts.append(f"发型：{appearance['hair_style']}")
-                if appearance.get('eye_color'):
-                    appearance_parts.append(f"眼色：{appearance['eye_color']}")
-                if appearance.get('height'):
-                    appearance_parts.append(f"身高：{appearance['height']}")
-                if appearance.get('build'):
-                    appearance_parts.append(f"体型：{appearance['build']}")
-                if appearance.get('other'):
-                    appearance_parts.append(f"其他：{appearance['other']}")
-                
-                if appearance_parts:
-                    info_parts.append("外貌：" + "，".join(appearance_parts))
-            
-            # 服装
-            if char.get('clothing', {}).get('description'):
-                info_parts.append(f"服装：{char['clothing']['description']}")
-            
-            formatted.append(" | ".join(info_parts))
-        
-        return "\n".join(formatted)
+        return "\n".join(map(_format_character, characters))
     
-    def save(self, file_path: str):
-        """保存状态机到文件"""
-        data = {
+    def to_dict(self) -> Dict[str, Any]:
+        """导出可序列化的状态"""
+        return {
             'characters': self.characters,
             'name_mapping': self.name_mapping,
             'character_id_counter': self.character_id_counter
         }
+    
+    @_locked
+    def save(self, file_path: str):
+        """
+        保存状态机到文件（先写临时文件再替换，中途崩溃不会留下损坏的状态文件）
         
-        with open(file_path, 'w', encoding='utf-8') as f:
-            json.dump(data, f, ensure_ascii=False, indent=2)
+        自上次保存/加载后没有改动且目标文件已存在时不写盘
+        """
+        if not self._dirty and Path(file_path).exists():
+            return
+        
+        tmp_path = f"{file_path}.tmp"
+        if str(file_path).endswith(".msgpack"):
+            with open(tmp_path, 'wb') as f:
+                f.write(msgpack.packb(self.to_dict(), use_bin_type=True))
+        elif orjson is not None:
+            with open(tmp_path, 'wb') as f:
+                f.write(orjson.dumps(
+                    self.to_dict(),
+                    option=orjson.OPT_INDENT_2 | orjson.OPT_NON_STR_KEYS | orjson.OPT_APPEND_NEWLINE,
+                ))
+        else:
+            # json.dump 按 token 逐段写入，用大缓冲区把上万次小写合并为少量系统调用
+            with open(tmp_path, 'w', encoding='utf-8', buffering=_JSON_WRITE_BUFFER) as f:
+                json.dump(self.to_dict(), f, ensure_ascii=False, indent=2)
+        os.replace(tmp_path, file_path)
+        self._dirty = False
         
         print(f"✅ 人物状态机已保存至: {file_path}")
     
+    @_locked
     def load(self, file_path: str):
         """从文件加载状态机"""
         path = Path(file_path)
@@ -410,11 +890,24 @@ class CharacterStateMachine:
             print(f"⚠️ 状态机文件不存在: {file_path}")
             return
         
-        with open(path, 'r', encoding='utf-8') as f:
-            data = json.load(f)
+        if path.suffix == ".msgpack":
+            with open(path, 'rb') as f:
+                data = msgpack.unpackb(f.read(), raw=False)
+        else:
+            with open(path, 'rb') as f:
+                data = _json_loads(f.read())
         
         self.characters = data.get('characters', {})
         self.name_mapping = data.get('name_mapping', {})
         self.character_id_counter = data.get('character_id_counter', 0)
+        for char_info in self.characters.values():
+            _intern_fields(char_info)
+        self._dirty = False
+        self._name_matcher = None
+        # 重建主名索引（同名时保留先出现的人物，与按顺序查找一致）
+        self._name_to_id = {}
+        for char_id, char_info in self.characters.items():
+            for name in char_info.get('names', []):
+                self._name_to_id.setdefault(name, char_id)
         
         print(f"✅ 人物状态机已加载: {len(self.characters)} 个人物")
@@ -1,21 +1,55 @@
 """
 片段筛选模块：使用大模型筛选适合生成插图的片段
 """
+import logging
 import os
 from typing import List, Dict, Optional, Any
 from pydantic import BaseModel, Field
 import openai
 from dotenv import load_dotenv
+from tqdm import tqdm
 
 # 加载环境变量
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 # 可选：API 消耗追踪
 try:
     from src.api_cost_tracker import APICostTracker
 except ImportError:
     APICostTracker = None
 
+# 出错时默认结果的原因前缀（此类结果不写入缓存）
+_ERROR_REASON_PREFIX = "筛选过程出错"
+
+# 默认筛选标准（单片段与批量提示词共用）
+_DEFAULT_CRITERIA = """1. 包含丰富的视觉元素（场景、动作、人物、物品等）
+2. 有明确的画面感，能够用图像表现出来
+3. 避免纯对话或心理描写
+4. 避免过于抽象的概念
+5. 优先选择有动作、场景描述的片段"""
+
+# 每个片段需要给出的字段
+_FILTER_FIELDS = """- selected: 是否选中（true/false）
+- score: 适合度评分（0-10分，10分最合适）
+- reason: 选中或未选中的原因
+- visual_description: 如果选中，请提取或改写为适合转换为图像的视觉描述（简洁明了，突出视觉元素）"""
+
+
+def _single_filter_template(criteria: str) -> str:
+    """单片段筛选提示词模板（保留 {text} 占位符）"""
+    return f"""你是一个专业的插图内容筛选专家。你的任务是判断小说片段是否适合生成插图。
+
+筛选标准：
+{criteria}
+
+小说片段：
+{{text}}
+
+请分析这个片段是否适合生成插图，并给出：
+{_FILTER_FIELDS}"""
+
 
 class FilterResult(BaseModel):
     """筛选结果模型"""
@@ -73,24 +107,12 @@ class FragmentFilter:
         )
         self.temperature = temperature
         
-        # 筛选提示词模板
-        self.filter_prompt_template = """你是一个专业的插图内容筛选专家。你的任务是判断小说片段是否适合生成插图。
-
-筛选标准：
-1. 包含丰富的视觉元素（场景、动作、人物、物品等）
-2. 有明确的画面感，能够用图像表现出来
-3. 避免纯对话或心理描写
-4. 避免过于抽象的概念
-5. 优先选择有动作、场景描述的片段
-
-小说片段：
-{text}
-
-请分析这个片段是否适合生成插图，并给出：
-- selected: 是否选中（true/false）
-- score: 适合度评分（0-10分，10分最合适）
-- reason: 选中或未选中的原因
-- visual_description: 如果选中，请提取或改写为适合转换为图像的视觉描述（简洁明了，突出视觉元素）"""
+        # 可选：LLM 结果缓存（src.llm_cache.LLMCache），由调用方设置
+        self.cache = None
+        
+        # 筛选标准与提示词模板（filter_with_criteria 临时替换二者）
+        self.filter_criteria = _DEFAULT_CRITERIA
+        self.filter_prompt_template = _single_filter_template(self.filter_criteria)
 
     def filter_single(
         self,
@@ -198,16 +220,91 @@ class FragmentFilter:
             return FilterResult(
                 selected=False,
                 score=0.0,
-                reason=f"筛选过程出错: {str(e)}",
+                reason=f"{_ERROR_REASON_PREFIX}: {str(e)}",
                 visual_description=""
             )
     
+    def filter_marshaled(
+        self,
+        fragments: List[Dict[str, any]],
+        cost_tracker: Optional[Any] = None,
+    ) -> List[FilterResult]:
+        """
+        将多个片段合并到一次LLM调用中筛选（以 ### FRAG n ### 分隔）
+        
+        Args:
+            fragments: 片段列表（一个批次）
+            cost_tracker: 可选，API 消耗追踪器
+        
+        Returns:
+            与 fragments 一一对应的筛选结果；解析失败时逐个调用 filter_single
+        """
+        if len(fragments) <= 1:
+            return [self.filter_single(f, cost_tracker=cost_tracker) for f in fragments]
+        
+        n = len(fragments)
+        joined = "\n\n".join(
+            f"### FRAG {k} ###\n{frag['text']}" for k, frag in enumerate(fragments, 1)
+        )
+        user_content = f"""你是一个专业的插图内容筛选专家。你的任务是逐一判断以下小说片段是否适合生成插图。
+
+筛选标准：
+{self.filter_criteria}
+
+以下共 {n} 个小说片段（以 ### FRAG n ### 分隔）：
+{joined}
+
+请分别分析每个片段是否适合生成插图，并对每个片段给出：
+{_FILTER_FIELDS}
+
+请以JSON格式返回结果，格式：{{"results": [{{"frag": 1, "selected": true/false, "score": 0-10, "reason": "...", "visual_description": "..."}}, ...]}}
+results 必须恰好包含 {n} 项并按片段顺序排列。"""
+        try:
+            import json
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "你是一个专业的插图内容筛选专家。请严格按照JSON格式返回结果，只返回JSON，不要其他内容。"
+                    },
+                    {
+                        "role": "user",
+                        "content": user_content
+                    }
+                ],
+                temperature=self.temperature,
+                response_format={"type": "json_object"}
+            )
+            if cost_tracker and hasattr(cost_tracker, "record_from_response"):
+                cost_tracker.record_from_response("fragment_filter", response)
+            
+            result_text = response.choices[0].message.content.strip()
+            # 移除可能的markdown代码块标记
+            if result_text.startswith("```json"):
+                result_text = result_text[7:]
+            if result_text.startswith("```"):
+                result_text = result_text[3:]
+            if result_text.endswith("```"):
+                result_text = result_text[:-3]
+            items = json.loads(result_text.strip()).get("results")
+            if not isinstance(items, list) or len(items) != n:
+                raise ValueError(f"期望 {n} 项结果，实际 {len(items) if isinstance(items, list) else 0} 项")
+            return [
+                FilterResult(**{k: v for k, v in item.items() if k != "frag"})
+                for item in items
+            ]
+        except Exception as e:
+            print(f"⚠️ 批量筛选解析失败: {e}，逐个筛选")
+            return [self.filter_single(f, cost_tracker=cost_tracker) for f in fragments]
+    
     def filter_batch(
         self,
         fragments: List[Dict[str, any]],
         min_score: float = 6.0,
         max_selected: Optional[int] = None,
         cost_tracker: Optional[Any] = None,
+        batch_size: int = 1,
     ) -> List[Dict[str, any]]:
         """
         批量筛选片段
@@ -216,6 +313,7 @@ class FragmentFilter:
             fragments: 片段列表
             min_score: 最低评分阈值，低于此分的片段不选中
             max_selected: 最多选中的片段数量，None表示不限制
+            batch_size: 每次LLM调用合并的片段数，1 表示逐个筛选
         
         Returns:
             筛选后的片段列表（包含筛选结果）
@@ -223,13 +321,72 @@ class FragmentFilter:
         print(f"🔍 开始筛选 {len(fragments)} 个片段...")
         
         filtered_fragments = []
+        batch_size = max(1, batch_size)
         
-        for i, fragment in enumerate(fragments):
-            print(f"正在筛选片段 {i+1}/{len(fragments)}: {fragment['text'][:50]}...")
-            
-            # 调用LLM筛选
-            filter_result = self.filter_single(fragment, cost_tracker=cost_tracker)
-            
+        with tqdm(total=len(fragments), desc="筛选片段", unit="段", leave=False) as progress:
+            for start in range(0, len(fragments), batch_size):
+                chunk = fragments[start:start + batch_size]
+                logger.debug("正在筛选片段 %d-%d/%d: %s...", start + 1, start + len(chunk), len(fragments), chunk[0]['text'][:50])
+                
+                # 调用LLM筛选（已缓存的片段不再请求）
+                results = self._filter_chunk(chunk, batch_size, cost_tracker)
+                
+                progress.update(len(chunk))
+                if self._collect_filtered(chunk, results, filtered_fragments, min_score, max_selected):
+                    print(f"✅ 已选中 {max_selected} 个片段，停止筛选")
+                    break
+        
+        # 按评分排序（从高到低）
+        filtered_fragments.sort(key=lambda x: x['filter_result']['score'], reverse=True)
+        
+        print(f"✅ 筛选完成，共选中 {len(filtered_fragments)} 个片段（最低分: {min_score}）")
+        
+        return filtered_fragments
+    
+    def _filter_chunk(
+        self,
+        chunk: List[Dict[str, any]],
+        batch_size: int,
+        cost_tracker: Optional[Any] = None,
+    ) -> List[FilterResult]:
+        """筛选一个批次：先查缓存，只把未命中的片段发给LLM，成功结果写回缓存"""
+        def dispatch(frags):
+            if batch_size > 1:
+                return self.filter_marshaled(frags, cost_tracker=cost_tracker)
+            return [self.filter_single(f, cost_tracker=cost_tracker) for f in frags]
+        
+        if self.cache is None:
+            return dispatch(chunk)
+        
+        # 模板随自定义标准变化，一并计入键
+        keys = [
+            self.cache.make_key("filter", self.model, self.temperature, self.filter_prompt_template, f['text'])
+            for f in chunk
+        ]
+        results: List[Optional[FilterResult]] = [None] * len(chunk)
+        for k, key in enumerate(keys):
+            cached = self.cache.get(key)
+            if cached is not None:
+                results[k] = FilterResult(**cached)
+        
+        pending = [k for k, r in enumerate(results) if r is None]
+        if pending:
+            for k, result in zip(pending, dispatch([chunk[k] for k in pending])):
+                results[k] = result
+                if not result.reason.startswith(_ERROR_REASON_PREFIX):
+                    self.cache.set(keys[k], result.model_dump())
+        return results
+    
+    @staticmethod
+    def _collect_filtered(
+        fragments: List[Dict[str, any]],
+        results: List[FilterResult],
+        filtered_fragments: List[Dict[str, any]],
+        min_score: float,
+        max_selected: Optional[int],
+    ) -> bool:
+        """将筛选结果写入片段并收集选中项；达到 max_selected 时返回 True"""
+        for fragment, filter_result in zip(fragments, results):
             # 添加筛选结果到片段
             fragment['filter_result'] = {
                 'selected': filter_result.selected,
@@ -244,15 +401,8 @@ class FragmentFilter:
             
             # 如果达到最大选中数量，停止筛选
             if max_selected and len(filtered_fragments) >= max_selected:
-                print(f"✅ 已选中 {max_selected} 个片段，停止筛选")
-                break
-        
-        # 按评分排序（从高到低）
-        filtered_fragments.sort(key=lambda x: x['filter_result']['score'], reverse=True)
-        
-        print(f"✅ 筛选完成，共选中 {len(filtered_fragments)} 个片段（最低分: {min_score}）")
-        
-        return filtered_fragments
+                return True
+        return False
     
     def filter_with_criteria(
         self,
@@ -261,6 +411,7 @@ class FragmentFilter:
         min_score: float = 6.0,
         max_selected: Optional[int] = None,
         cost_tracker: Optional[Any] = None,
+        batch_size: int = 1,
     ) -> List[Dict[str, any]]:
         """
         使用自定义标准筛选片段
@@ -270,34 +421,26 @@ class FragmentFilter:
             criteria: 自定义筛选标准描述
             min_score: 最低评分阈值
             max_selected: 最多选中的片段数量
+            batch_size: 每次LLM调用合并的片段数
         
         Returns:
             筛选后的片段列表
         """
-        # 更新提示词模板
+        # 更新筛选标准与提示词模板
+        original_criteria = self.filter_criteria
         original_template = self.filter_prompt_template
-        self.filter_prompt_template = f"""你是一个专业的插图内容筛选专家。你的任务是判断小说片段是否适合生成插图。
-
-筛选标准：
-1. {criteria}
+        self.filter_criteria = f"""1. {criteria}
 2. 包含丰富的视觉元素（场景、动作、人物、物品等）
 3. 有明确的画面感，能够用图像表现出来
 4. 避免纯对话或心理描写
-5. 避免过于抽象的概念
-
-小说片段：
-{{text}}
-
-请分析这个片段是否适合生成插图，并给出：
-- selected: 是否选中（true/false）
-- score: 适合度评分（0-10分，10分最合适）
-- reason: 选中或未选中的原因
-- visual_description: 如果选中，请提取或改写为适合转换为图像的视觉描述（简洁明了，突出视觉元素）"""
+5. 避免过于抽象的概念"""
+        self.filter_prompt_template = _single_filter_template(self.filter_criteria)
         
         try:
-            result = self.filter_batch(fragments, min_score, max_selected, cost_tracker=cost_tracker)
+            result = self.filter_batch(fragments, min_score, max_selected, cost_tracker=cost_tracker, batch_size=batch_size)
         finally:
-            # 恢复原始模板
+            # 恢复原始标准与模板
+            self.filter_criteria = original_criteria
             self.filter_prompt_template = original_template
         
         return result
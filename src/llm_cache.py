@@ -0,0 +1,66 @@
+"""
+LLM 结果缓存模块：按内容哈希缓存筛选/提示词生成结果，重跑时跳过已处理的片段
+"""
+import hashlib
+import json
+import sqlite3
+import threading
+from pathlib import Path
+from typing import Any, Optional
+
+
+class LLMCache:
+    """基于 sqlite3 的键值缓存，键为内容哈希，值为 JSON"""
+
+    def __init__(self, path: str):
+        """
+        初始化缓存
+
+        Args:
+            path: sqlite 数据库文件路径（不存在时自动创建）
+        """
+        Path(path).parent.mkdir(parents=True, exist_ok=True)
+        # 流水线模式下多个线程共用同一连接，读写加锁
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS llm_cache (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+        )
+        self._conn.commit()
+        self._lock = threading.Lock()
+        self.hits = 0
+        self.misses = 0
+
+    @staticmethod
+    def make_key(*parts: Any) -> str:
+        """由模型、温度、模板、片段文本等组成部分计算 sha256 键"""
+        h = hashlib.sha256()
+        for part in parts:
+            h.update(str(part).encode("utf-8"))
+            h.update(b"\x00")
+        return h.hexdigest()
+
+    def get(self, key: str) -> Optional[Any]:
+        """读取缓存，未命中返回 None"""
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT value FROM llm_cache WHERE key = ?", (key,)
+            ).fetchone()
+            if row is None:
+                self.misses += 1
+                return None
+            self.hits += 1
+        return json.loads(row[0])
+
+    def set(self, key: str, value: Any):
+        """写入缓存（覆盖同键旧值）"""
+        data = json.dumps(value, ensure_ascii=False)
+        with self._lock:
+            self._conn.execute(
+                "INSERT OR REPLACE INTO llm_cache (key, value) VALUES (?, ?)", (key, data)
+            )
+            self._conn.commit()
+
+    def close(self):
+        """关闭数据库连接"""
+        with self._lock:
+            self._conn.close()
@@ -3,6 +3,7 @@ Markdown生成模块：将生成的插图插入到小说文本中，生成带插
 """
 import json
 import re
+from concurrent.futures import ThreadPoolExecutor
 from pathlib import Path
 from typing import Dict, List, Optional
 import shutil
@@ -11,14 +12,16 @@ import shutil
 class MarkdownGenerator:
     """Markdown生成器：将插图插入小说文本"""
     
-    def __init__(self, output_dir: str = "output"):
+    def __init__(self, output_dir: str = "output", max_workers: int = 8):
         """
         初始化Markdown生成器
         
         Args:
             output_dir: 输出目录
+            max_workers: 并发检查/复制图片文件的线程数
         """
         self.output_dir = Path(output_dir)
+        self.max_workers = max(1, max_workers)
     
     def find_text_position(self, full_text: str, target_text: str, start_pos: int = 0) -> Optional[int]:
         """
@@ -147,9 +150,6 @@ class MarkdownGenerator:
         with open(overview_file, 'r', encoding='utf-8') as f:
             overview = json.load(f)
         
-        # 按章节处理
-        chapters_data = overview.get('chapters', {})
-        
         # 按章节切分原始文本
         # 导入NovelProcessor（避免循环导入）
         from src.novel_processor import NovelProcessor
@@ -161,65 +161,64 @@ class MarkdownGenerator:
         markdown_lines.append("# " + novel_file.stem + "\n\n")
         markdown_lines.append("---\n\n")
         
-        # 处理每个章节
-        for chapter_num in sorted(chapters_data.keys(), key=int):
-            chapter_info = chapters_data[str(chapter_num)]
-            chapter_title = chapter_info['title']
-            results = chapter_info['results']
-            
-            # 添加章节标题
-            markdown_lines.append(f"## {chapter_title}\n\n")
-            
-            # 获取章节文本
-            chapter_text = None
-            if chapters:
-                # 找到对应的章节
-                for ch in chapters:
-                    if ch['chapter_num'] == int(chapter_num):
-                        start_pos = ch['start_pos']
-                        end_pos = ch['end_pos']
-                        chapter_text = novel_text[start_pos:end_pos]
-                        break
-            
-            if not chapter_text:
-                # 如果找不到章节，使用整个文本
-                chapter_text = novel_text
-            
-            # 按index排序结果（确保按顺序插入）
-            sorted_results = sorted(results, key=lambda x: x.get('index', 0))
-            
-            # 从后往前插入图片（避免位置偏移）
-            current_text = chapter_text
-            for result in reversed(sorted_results):
-                if result.get('generated') and result.get('image_path'):
-                    image_path = result['image_path']
-                    fragment_text = result.get('text', '')
-                    
-                    # 构建完整的图片路径
-                    image_path_normalized = image_path.replace('\\', '/')  # 统一使用正斜杠
-                    
-                    if not Path(image_path).is_absolute():
-                        full_image_path = output_path / image_path_normalized
-                    else:
-                        full_image_path = Path(image_path)
-                    
-                    # 检查图片是否存在
-                    if full_image_path.exists():
+        # 处理每个章节（线程池用于并发检查图片文件）
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            for chapter_num, chapter_info in self._iter_overview_chapters(output_path, overview):
+                chapter_title = chapter_info['title']
+                results = chapter_info['results']
+                
+                # 添加章节标题
+                markdown_lines.append(f"## {chapter_title}\n\n")
+                
+                # 获取章节文本
+                chapter_text = None
+                if chapters:
+                    # 找到对应的章节
+                    for ch in chapters:
+                        if ch['chapter_num'] == int(chapter_num):
+                            start_pos = ch['start_pos']
+                            end_pos = ch['end_pos']
+                            chapter_text = novel_text[start_pos:end_pos]
+                            break
+                
+                if not chapter_text:
+                    # 如果找不到章节，使用整个文本
+                    chapter_text = novel_text
+                
+                # 按index排序结果（确保按顺序插入）
+                sorted_results = sorted(results, key=lambda x: x.get('index', 0))
+                
+                # 构建完整的图片路径，并发检查图片是否存在
+                candidates = []
+                for result in sorted_results:
+                    if result.get('generated') and result.get('image_path'):
+                        image_path = result['image_path']
+                        image_path_normalized = image_path.replace('\\', '/')  # 统一使用正斜杠
+                        if not Path(image_path).is_absolute():
+                            full_image_path = output_path / image_path_normalized
+                        else:
+                            full_image_path = Path(image_path)
+                        candidates.append((result, image_path_normalized, full_image_path))
+                exists = list(pool.map(lambda c: c[2].exists(), candidates))
+                
+                # 从后往前插入图片（避免位置偏移）
+                current_text = chapter_text
+                for (result, image_path_normalized, full_image_path), found in zip(reversed(candidates), reversed(exists)):
+                    if found:
                         # 在文本中插入图片
                         # 使用相对路径（相对于Markdown文件）
-                        rel_image_path = image_path_normalized
                         current_text = self.insert_image_markdown(
                             current_text,
-                            rel_image_path,
-                            fragment_text,
+                            image_path_normalized,
+                            result.get('text', ''),
                             relative_to=output_path
                         )
                     else:
                         print(f"⚠️ 图片文件不存在: {full_image_path}")
-            
-            # 添加章节内容
-            markdown_lines.append(current_text)
-            markdown_lines.append("\n\n---\n\n")
+                
+                # 添加章节内容
+                markdown_lines.append(current_text)
+                markdown_lines.append("\n\n---\n\n")
         
         # 写入Markdown文件
         output_md_file = output_path / output_filename
@@ -230,6 +229,27 @@ class MarkdownGenerator:
         
         return str(output_md_file)
     
+    @staticmethod
+    def _iter_overview_chapters(output_path: Path, overview: Dict):
+        """
+        按章节顺序逐个产出 (章节号, 章节信息)
+        
+        新格式的章节结果逐行存放在 overview.jsonl（overview.json 中的 chapters_file），
+        旧格式直接内嵌在 overview.json 的 chapters 字段中
+        """
+        chapters_file = overview.get('chapters_file')
+        if chapters_file:
+            with open(output_path / chapters_file, 'r', encoding='utf-8') as f:
+                for line in f:
+                    if line.strip():
+                        record = json.loads(line)
+                        yield record['chapter_num'], record
+            return
+        
+        chapters_data = overview.get('chapters', {})
+        for chapter_num in sorted(chapters_data.keys(), key=int):
+            yield chapter_num, chapters_data[str(chapter_num)]
+    
     def copy_images_to_markdown_dir(
         self,
         output_dir: str,
@@ -246,12 +266,19 @@ class MarkdownGenerator:
         md_file = Path(markdown_file)
         md_dir = md_file.parent
         
-        # 查找所有图片文件
+        def copy_one(img_file: Path):
+            # 复制到Markdown目录
+            dest_file = md_dir / img_file.name
+            if not dest_file.exists():
+                shutil.copy2(img_file, dest_file)
+                print(f"✅ 已复制图片: {img_file.name}")
+        
+        # 查找所有图片文件；各章节图片同名，按目标文件名去重（与逐个复制时一样先找到的优先），
+        # 避免多个线程同时写同一个目标文件
+        img_files: Dict[str, Path] = {}
         for chapter_dir in output_path.glob("第*章_*"):
             if chapter_dir.is_dir():
                 for img_file in chapter_dir.glob("illustration_*.png"):
-                    # 复制到Markdown目录
-                    dest_file = md_dir / img_file.name
-                    if not dest_file.exists():
-                        shutil.copy2(img_file, dest_file)
-                        print(f"✅ 已复制图片: {img_file.name}")
+                    img_files.setdefault(img_file.name, img_file)
+        with ThreadPoolExecutor(max_workers=self.max_workers) as pool:
+            list(pool.map(copy_one, img_files.values()))
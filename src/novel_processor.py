@@ -5,6 +5,71 @@ import re
 from typing import List, Dict, Union
 from pathlib import Path
 
+# 可选：Numba 加速句子边界扫描，未安装时使用纯 Python 实现
+try:
+    import numpy as np
+    from numba import njit
+except ImportError:
+    np = None
+    njit = None
+
+# 引号字符（直引号、中文引号）；成对引号按 开 -> 闭 映射
+_QUOTE_CHARS = frozenset('"\'『』「」')
+_QUOTE_CLOSERS = {'『': '』', '「': '」'}
+_SENTENCE_END_CHARS = frozenset('。！？')
+
+# 段落长度达到该值才走 Numba 内核（短段落编码开销大于收益）
+_NUMBA_MIN_CHARS = 256
+
+
+def _sentence_ends(paragraph: str) -> List[int]:
+    """返回段落内各句子的结束位置（不含），引号内不切分，连续句号视为省略号"""
+    ends = []
+    in_quotes = False
+    quote_char = ''
+    n = len(paragraph)
+    for i, char in enumerate(paragraph):
+        if char in _QUOTE_CHARS:
+            if not in_quotes:
+                in_quotes = True
+                quote_char = char
+            elif char == quote_char or _QUOTE_CLOSERS.get(quote_char) == char:
+                in_quotes = False
+        if not in_quotes and char in _SENTENCE_END_CHARS:
+            if char == '。' and i + 1 < n and paragraph[i + 1] == '。':
+                continue
+            ends.append(i + 1)
+    return ends
+
+
+if njit is not None:
+    @njit(cache=True)
+    def _sentence_ends_kernel(codes):
+        """_sentence_ends 的 Numba 版本，输入为 uint32 码点数组"""
+        n = codes.shape[0]
+        ends = np.empty(n, dtype=np.int64)
+        count = 0
+        in_quotes = False
+        quote = 0
+        for i in range(n):
+            c = codes[i]
+            # " ' 『 』 「 」
+            if c == 0x22 or c == 0x27 or c == 0x300E or c == 0x300F or c == 0x300C or c == 0x300D:
+                if not in_quotes:
+                    in_quotes = True
+                    quote = c
+                elif c == quote or (quote == 0x300E and c == 0x300F) or (quote == 0x300C and c == 0x300D):
+                    in_quotes = False
+            # 。 ！ ？
+            if not in_quotes and (c == 0x3002 or c == 0xFF01 or c == 0xFF1F):
+                if c == 0x3002 and i + 1 < n and codes[i + 1] == 0x3002:
+                    continue
+                ends[count] = i + 1
+                count += 1
+        return ends[:count]
+else:
+    _sentence_ends_kernel = None
+
 
 class NovelProcessor:
     """小说处理器：负责切分小说为片段"""
@@ -124,60 +189,23 @@ class NovelProcessor:
         Returns:
             句子列表（包含标点符号）
         """
-        sentences = []
-        
-        # 使用状态机方法处理引号
-        # 避免在引号内切分句子
-        current_sentence = ""
-        in_quotes = False
-        quote_char = None  # 支持不同的引号："" "" '' 『』 「」等
+        # 使用状态机方法找出句子结束位置，避免在引号内切分句子
+        # 支持的引号：直引号 " '，中文引号『』「」
+        if _sentence_ends_kernel is not None and len(paragraph) >= _NUMBA_MIN_CHARS:
+            codes = np.frombuffer(paragraph.encode('utf-32-le'), dtype=np.uint32)
+            ends = _sentence_ends_kernel(codes).tolist()
+        else:
+            ends = _sentence_ends(paragraph)
         
-        i = 0
-        while i < len(paragraph):
-            char = paragraph[i]
-            
-            # 检测引号开始/结束
-            # 支持多种引号类型：英文引号、中文引号、书名号等
-            # 使用Unicode字符码避免字符串解析问题
-            quote_chars = [
-                '"', '"', '"', '"',  # 英文双引号（左、右、直引号）
-                "'", "'", "'", "'",  # 英文单引号（左、右、直引号）
-                '『', '』', '「', '」'  # 中文引号（书名号、引号）
-            ]
-            if char in quote_chars:
-                if not in_quotes:
-                    in_quotes = True
-                    quote_char = char
-                else:
-                    # 检查是否是配对的引号
-                    is_pair = (char == quote_char) or \
-                             (char in ['"', '"'] and quote_char in ['"', '"']) or \
-                             (char in ["'", "'"] and quote_char in ["'", "'"]) or \
-                             (char == '』' and quote_char == '『') or \
-                             (char == '」' and quote_char == '「')
-                    if is_pair:
-                        in_quotes = False
-                        quote_char = None
-            
-            current_sentence += char
-            
-            # 如果不在引号内，检查句子结束标志
-            if not in_quotes and char in ['。', '！', '？']:
-                # 检查是否是真正的句子结尾（不是省略号的一部分）
-                # 简单处理：如果是连续的句号，可能是省略号
-                if char == '。' and i + 1 < len(paragraph) and paragraph[i + 1] == '。':
-                    # 可能是省略号，继续
-                    i += 1
-                    continue
-                
-                sentences.append(current_sentence.strip())
-                current_sentence = ""
-            
-            i += 1
+        sentences = []
+        start = 0
+        for end in ends:
+            sentences.append(paragraph[start:end].strip())
+            start = end
         
         # 处理最后一个句子（可能没有结尾标点）
-        if current_sentence.strip():
-            sentences.append(current_sentence.strip())
+        if paragraph[start:].strip():
+            sentences.append(paragraph[start:].strip())
         
         # 过滤空句子
         sentences = [s for s in sentences if s]
@@ -1,13 +1,17 @@
 """
 Prompt生成模块：将筛选后的片段转换为适合Counterfeit-V3.0的提示词
 """
-from typing import Dict, Optional, List
+import logging
+from typing import Any, Dict, Optional, List
 import openai
 import os
 from dotenv import load_dotenv
+from tqdm import tqdm
 
 load_dotenv()
 
+logger = logging.getLogger(__name__)
+
 
 class PromptGenerator:
     """提示词生成器：将文本片段转换为SD提示词"""
@@ -18,6 +22,9 @@ class PromptGenerator:
     # Counterfeit-V3.0的基础负面提示词（固定90%部分）
     BASE_NEGATIVE = "(worst quality, low quality:1.4), (zombie, sketch, interlocked fingers, comic), (modern, modern architecture, modern clothing, modern background:1.2), (western style, western castle, plate armor:1.2), (jeans, denim, suit, tie, glasses, wristwatch, sneakers), (car, vehicle, building, skyscraper), watermark, text, signature, username, nsfw, EasyNegative, ng_deepnegative_v1_75t"
     
+    # 修改LLM提示词模板后递增，使旧的缓存结果失效
+    PROMPT_CACHE_VERSION = 1
+    
     def __init__(
         self,
         api_key: Optional[str] = None,
@@ -43,6 +50,9 @@ class PromptGenerator:
         self.lora = lora
         self.character_state_machine = character_state_machine
         
+        # 可选：LLM 结果缓存（src.llm_cache.LLMCache），由调用方设置
+        self.cache = None
+        
         if use_llm:
             # 判断是否使用 qwen 模型
             is_qwen = "qwen" in model.lower()
@@ -92,6 +102,13 @@ class PromptGenerator:
         Returns:
             包含positive_prompt和negative_prompt的字典
         """
+        cache_key = None
+        if self.cache is not None:
+            cache_key = self._cache_key(visual_description, fragment_text, characters_info)
+            cached = self.cache.get(cache_key)
+            if self._is_valid_llm_result(cached):
+                return self._finalize_llm_prompts(cached, fragment_text, characters_info)
+        
         # 构建人物信息部分
         characters_section = ""
         if characters_info:
@@ -178,41 +195,186 @@ Counterfeit-V3.0是一个二次元风格的模型，擅长生成：
             result_text = result_text.strip()
             
             result = json.loads(result_text)
+            if not self._is_valid_llm_result(result):
+                raise ValueError("返回的JSON缺少 positive_prompt/negative_prompt 字符串")
+            prompts = self._finalize_llm_prompts(result, fragment_text, characters_info)
+            if cache_key is not None:
+                self.cache.set(cache_key, result)
+            return prompts
             
-            # 确保包含基础提示词
-            positive_prompt = result.get("positive_prompt", "")
-            if not positive_prompt.startswith("(masterpiece, best quality)"):
-                positive_prompt = self.BASE_POSITIVE + positive_prompt
-            
-            # 添加 LoRA 标签（如果配置了）
-            if self.lora:
-                positive_prompt = positive_prompt + ", " + self.lora
-            
-            # 获取LLM生成的负面提示词（如果有，作为额外补充）
-            llm_negative = result.get("negative_prompt", "")
-            
-            # 生成完整的负面提示词（固定部分 + 动态部分）
-            negative_prompt = self.generate_negative_prompt(
-                fragment_text=fragment_text,
-                characters_info=characters_info
+        except Exception as e:
+            print(f"⚠️ LLM生成提示词失败: {e}，使用规则生成")
+            return self.generate_with_rules(visual_description, fragment_text)
+    
+    def _cache_key(
+        self,
+        visual_description: str,
+        fragment_text: str = "",
+        characters_info: Optional[str] = None,
+    ) -> str:
+        """LLM 原始结果的缓存键（LoRA 与负面词在补全阶段添加，不计入）"""
+        return self.cache.make_key(
+            "prompt",
+            self.PROMPT_CACHE_VERSION,
+            self.model,
+            visual_description,
+            fragment_text[:200] if fragment_text else "",
+            characters_info or "",
+        )
+    
+    @staticmethod
+    def _is_valid_llm_result(result: Any) -> bool:
+        """LLM 原始结果是否可补全（缓存中的旧/坏条目也按此校验，不合格视为未命中）"""
+        return (
+            isinstance(result, dict)
+            and isinstance(result.get("positive_prompt"), str)
+            and isinstance(result.get("negative_prompt", ""), str)
+        )
+    
+    def _finalize_llm_prompts(
+        self,
+        result: Dict,
+        fragment_text: str = "",
+        characters_info: Optional[str] = None,
+    ) -> Dict[str, str]:
+        """补全LLM返回的提示词：基础正面词、LoRA 标签、固定+动态负面词"""
+        # 确保包含基础提示词
+        positive_prompt = result.get("positive_prompt", "")
+        if not positive_prompt.startswith("(masterpiece, best quality)"):
+            positive_prompt = self.BASE_POSITIVE + positive_prompt
+        
+        # 添加 LoRA 标签（如果配置了）
+        if self.lora:
+            positive_prompt = positive_prompt + ", " + self.lora
+        
+        # 获取LLM生成的负面提示词（如果有，作为额外补充）
+        llm_negative = result.get("negative_prompt", "")
+        
+        # 生成完整的负面提示词（固定部分 + 动态部分）
+        negative_prompt = self.generate_negative_prompt(
+            fragment_text=fragment_text,
+            characters_info=characters_info
+        )
+        
+        # 如果LLM生成了额外的负面词，可以追加（可选）
+        if llm_negative and llm_negative.strip():
+            # 移除可能的基础提示词前缀
+            if "EasyNegative" in llm_negative:
+                llm_negative = llm_negative.replace("EasyNegative", "").strip()
+            if llm_negative:
+                negative_prompt = negative_prompt + ", " + llm_negative
+        
+        return {
+            'positive_prompt': positive_prompt,
+            'negative_prompt': negative_prompt
+        }
+    
+    def generate_marshaled(
+        self,
+        fragments: List[Dict[str, any]],
+        cost_tracker=None,
+    ) -> List[Dict[str, str]]:
+        """
+        将多个片段合并到一次LLM调用中生成提示词（以 ### FRAG n ### 分隔）
+        
+        Args:
+            fragments: 片段列表（一个批次）
+            cost_tracker: 可选，API 消耗追踪器
+        
+        Returns:
+            与 fragments 一一对应的提示词字典；解析失败时逐个调用 generate
+        """
+        if not self.use_llm or len(fragments) <= 1:
+            return [self.generate(f, cost_tracker=cost_tracker) for f in fragments]
+        
+        inputs = [self._prepare_inputs(f) for f in fragments]
+        
+        # 命中缓存的片段直接补全，只把其余片段合并请求
+        results: List[Optional[Dict[str, str]]] = [None] * len(fragments)
+        keys: List[Optional[str]] = [None] * len(fragments)
+        if self.cache is not None:
+            for k, (visual_description, fragment_text, characters_info) in enumerate(inputs):
+                keys[k] = self._cache_key(visual_description, fragment_text, characters_info)
+                cached = self.cache.get(keys[k])
+                if self._is_valid_llm_result(cached):
+                    results[k] = self._finalize_llm_prompts(cached, fragment_text, characters_info)
+        pending = [k for k, r in enumerate(results) if r is None]
+        if len(pending) <= 1:
+            for k in pending:
+                results[k] = self.generate(fragments[k], cost_tracker=cost_tracker)
+            return results
+        if len(pending) < len(fragments):
+            fragments = [fragments[k] for k in pending]
+            inputs = [inputs[k] for k in pending]
+        n = len(inputs)
+        sections = []
+        for k, (visual_description, fragment_text, characters_info) in enumerate(inputs, 1):
+            section = (
+                f"### FRAG {k} ###\n"
+                f"视觉描述：\n{visual_description}\n\n"
+                f"原始文本（参考）：\n{fragment_text[:200] if fragment_text else '无'}"
+            )
+            if characters_info:
+                section += f"\n\n相关人物信息（请确保在提示词中准确体现这些特征，不要出现人物名称）：\n{characters_info}"
+            sections.append(section)
+        
+        user_content = (
+            "你是一个专业的Stable Diffusion提示词工程师，专门为Counterfeit-V3.0模型生成提示词（二次元、玄幻修仙风格）。\n\n"
+            + "\n\n".join(sections)
+            + f"\n\n以上共 {n} 个片段。请为每个片段分别生成：\n"
+            "1. positive_prompt: 以 \"(masterpiece, best quality), \" 开头的英文逗号分隔关键词，"
+            "重点描述人物外貌、服装和环境，包含风格标签，长度150-250个词，人物特征必须与人物信息一致\n"
+            "2. negative_prompt: 针对内容的额外负面词，不需要则返回空字符串\n\n"
+            "请用JSON格式返回，格式如下：\n"
+            "{\"results\": [{\"frag\": 1, \"positive_prompt\": \"...\", \"negative_prompt\": \"...\"}, ...]}\n"
+            f"results 必须恰好包含 {n} 项并按片段顺序排列。"
+        )
+        
+        try:
+            response = self.client.chat.completions.create(
+                model=self.model,
+                messages=[
+                    {
+                        "role": "system",
+                        "content": "你是一个专业的Stable Diffusion提示词工程师。请严格按照JSON格式返回结果，只返回JSON，不要其他内容。"
+                    },
+                    {
+                        "role": "user",
+                        "content": user_content
+                    }
+                ],
+                temperature=0.7,
+                response_format={"type": "json_object"}
             )
             
-            # 如果LLM生成了额外的负面词，可以追加（可选）
-            if llm_negative and llm_negative.strip():
-                # 移除可能的基础提示词前缀
-                if "EasyNegative" in llm_negative:
-                    llm_negative = llm_negative.replace("EasyNegative", "").strip()
-                if llm_negative:
-                    negative_prompt = negative_prompt + ", " + llm_negative
-            
-            return {
-                'positive_prompt': positive_prompt,
-                'negative_prompt': negative_prompt
-            }
+            if cost_tracker and hasattr(cost_tracker, "record_from_response"):
+                cost_tracker.record_from_response("prompt_generator", response)
             
+            import json
+            result_text = response.choices[0].message.content.strip()
+            # 移除可能的markdown代码块标记
+            if result_text.startswith("```json"):
+                result_text = result_text[7:]
+            if result_text.startswith("```"):
+                result_text = result_text[3:]
+            if result_text.endswith("```"):
+                result_text = result_text[:-3]
+            items = json.loads(result_text.strip()).get("results")
+            if not isinstance(items, list) or len(items) != n:
+                raise ValueError(f"期望 {n} 项结果，实际 {len(items) if isinstance(items, list) else 0} 项")
+            for k, item, (_, fragment_text, characters_info) in zip(pending, items, inputs):
+                # 格式不合格的单项留给下面逐个生成
+                if not self._is_valid_llm_result(item):
+                    continue
+                results[k] = self._finalize_llm_prompts(item, fragment_text, characters_info)
+                if keys[k] is not None:
+                    self.cache.set(keys[k], item)
         except Exception as e:
-            print(f"⚠️ LLM生成提示词失败: {e}，使用规则生成")
-            return self.generate_with_rules(visual_description, fragment_text)
+            print(f"⚠️ 批量生成提示词失败: {e}，逐个生成")
+        for k, f in zip(pending, fragments):
+            if results[k] is None:
+                results[k] = self.generate(f, cost_tracker=cost_tracker)
+        return results
     
     def generate_negative_prompt(
         self,
@@ -352,6 +514,15 @@ Counterfeit-V3.0是一个二次元风格的模型，擅长生成：
         Returns:
             包含positive_prompt和negative_prompt的字典
         """
+        visual_description, fragment_text, characters_info = self._prepare_inputs(fragment)
+        
+        if self.use_llm:
+            return self.generate_with_llm(visual_description, fragment_text, characters_info, cost_tracker=cost_tracker)
+        else:
+            return self.generate_with_rules(visual_description, fragment_text)
+    
+    def _prepare_inputs(self, fragment: Dict[str, any]):
+        """提取生成提示词所需的 (视觉描述, 原始文本, 人物信息)"""
         # 优先使用筛选结果中的视觉描述
         if 'filter_result' in fragment:
             visual_description = fragment['filter_result'].get('visual_description', '')
@@ -370,15 +541,13 @@ Counterfeit-V3.0是一个二次元风格的模型，擅长生成：
             if characters:
                 characters_info = self.character_state_machine.format_characters_for_prompt(characters)
         
-        if self.use_llm:
-            return self.generate_with_llm(visual_description, fragment_text, characters_info, cost_tracker=cost_tracker)
-        else:
-            return self.generate_with_rules(visual_description, fragment_text)
+        return visual_description, fragment_text, characters_info
     
     def batch_generate(
         self,
         fragments: List[Dict[str, any]],
         cost_tracker=None,
+        batch_size: int = 1,
     ) -> List[Dict[str, any]]:
         """
         批量生成提示词
@@ -386,20 +555,29 @@ Counterfeit-V3.0是一个二次元风格的模型，擅长生成：
         Args:
             fragments: 片段列表（应已筛选）
             cost_tracker: 可选，API 消耗追踪器
+            batch_size: 每次LLM调用合并的片段数，1 表示逐个生成
         
         Returns:
             添加了prompt字段的片段列表
         """
         print(f"🎨 开始为 {len(fragments)} 个片段生成提示词...")
         
-        for i, fragment in enumerate(fragments):
-            print(f"正在生成提示词 {i+1}/{len(fragments)}...")
-            
-            prompts = self.generate(fragment, cost_tracker=cost_tracker)
-            fragment['prompts'] = prompts
-            
-            # 显示生成的提示词（前50个字符）
-            print(f"  ✅ Positive: {prompts['positive_prompt'][:50]}...")
+        batch_size = max(1, batch_size)
+        with tqdm(total=len(fragments), desc="生成提示词", unit="段", leave=False) as progress:
+            for start in range(0, len(fragments), batch_size):
+                chunk = fragments[start:start + batch_size]
+                logger.debug("正在生成提示词 %d-%d/%d...", start + 1, start + len(chunk), len(fragments))
+                
+                if batch_size > 1:
+                    chunk_prompts = self.generate_marshaled(chunk, cost_tracker=cost_tracker)
+                else:
+                    chunk_prompts = [self.generate(chunk[0], cost_tracker=cost_tracker)]
+                
+                for fragment, prompts in zip(chunk, chunk_prompts):
+                    fragment['prompts'] = prompts
+                    # 记录生成的提示词（前50个字符）
+                    logger.debug("  ✅ Positive: %s...", prompts['positive_prompt'][:50])
+                progress.update(len(chunk))
         
         print(f"✅ 提示词生成完成")
         
@@ -1,10 +1,15 @@
 import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
 import io
 import base64
+import logging
 from PIL import Image
 from datetime import datetime
 from pathlib import Path
-from typing import Optional
+from typing import List, Optional
+
+logger = logging.getLogger(__name__)
 
 
 class SDClient:
@@ -40,29 +45,19 @@ class SDClient:
         self.steps = steps
         self.cfg_scale = cfg_scale
         self.sampler_name = sampler_name
-    
-    def generate_illustration(
-        self,
-        prompt: str,
-        negative_prompt: str = "",
-        output_filename: Optional[str] = None,
-        output_dir: Optional[str] = None,
-        seed: int = -1
-    ) -> Optional[str]:
-        """
-        调用本地 SD WebUI 生成图片
         
-        Args:
-            prompt: 正面提示词
-            negative_prompt: 负面提示词
-            output_filename: 输出文件名（不含路径），None则自动生成
-            output_dir: 输出目录，None则使用初始化时的output_dir
-            seed: 随机种子，-1表示随机
-        
-        Returns:
-            保存的图片文件路径，失败返回None
-        """
-        # 构造请求体 (Payload)
+        # 复用连接：各次绘图请求共享连接池，连接失败时退避重试（POST 不会因读超时而重发）
+        self._session = requests.Session()
+        adapter = HTTPAdapter(
+            pool_connections=8,
+            pool_maxsize=8,
+            max_retries=Retry(total=3, backoff_factor=0.3),
+        )
+        self._session.mount("http://", adapter)
+        self._session.mount("https://", adapter)
+    
+    def _build_payload(self, prompt: str, negative_prompt: str = "", seed: int = -1, batch_size: int = 1) -> dict:
+        """构造 txt2img 请求体"""
         # 这些参数是专门针对 Counterfeit-V3.0 优化的
         payload = {
             "prompt": prompt,
@@ -83,41 +78,21 @@ class SDClient:
             # 面部修复 (二次元模型通常建议关闭，否则脸会变三次元)
             "restore_faces": False,
         }
+        if batch_size > 1:
+            # 一次前向生成多张（同一提示词）
+            payload["batch_size"] = batch_size
+        return payload
 
-        print(f"正在请求绘图 API... Prompt: {prompt[:50]}...")
+    def _txt2img(self, payload: dict) -> Optional[List[str]]:
+        """发送 txt2img 请求，返回 Base64 图片列表，失败返回 None"""
+        logger.debug("正在请求绘图 API... Prompt: %s...", payload["prompt"][:50])
 
         try:
             # 发送 POST 请求到 /sdapi/v1/txt2img
-            response = requests.post(f"{self.url}/sdapi/v1/txt2img", json=payload)
+            response = self._session.post(f"{self.url}/sdapi/v1/txt2img", json=payload)
 
             if response.status_code == 200:
-                r = response.json()
-
-                # 获取 Base64 编码的图片数据
-                # WebUI 返回的是一个列表，通常我们只取第一张
-                image_b64 = r['images'][0]
-
-                # 解码并保存图片
-                image = Image.open(io.BytesIO(base64.b64decode(image_b64)))
-
-                # 确定输出目录
-                if output_dir:
-                    output_path = Path(output_dir)
-                    output_path.mkdir(parents=True, exist_ok=True)
-                else:
-                    output_path = self.output_dir
-
-                # 生成文件名
-                if output_filename:
-                    file_path = output_path / output_filename
-                else:
-                    timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
-                    file_path = output_path / f"illustration_{timestamp}.png"
-                
-                image.save(file_path)
-
-                print(f"✅ 图片已保存至: {file_path}")
-                return str(file_path)
+                return response.json()['images']
             else:
                 print(f"❌ 请求失败，状态码: {response.status_code}")
                 print(response.text)
@@ -127,6 +102,97 @@ class SDClient:
             print(f"❌ 连接错误: {e}")
             return None
 
+    def _save_image(
+        self,
+        image_b64: str,
+        output_filename: Optional[str] = None,
+        output_dir: Optional[str] = None
+    ) -> str:
+        """解码 Base64 图片并保存，返回文件路径"""
+        image = Image.open(io.BytesIO(base64.b64decode(image_b64)))
+
+        # 确定输出目录
+        if output_dir:
+            output_path = Path(output_dir)
+            output_path.mkdir(parents=True, exist_ok=True)
+        else:
+            output_path = self.output_dir
+
+        # 生成文件名
+        if output_filename:
+            file_path = output_path / output_filename
+        else:
+            timestamp = datetime.now().strftime("%Y%m%d_%H%M%S_%f")[:-3]
+            file_path = output_path / f"illustration_{timestamp}.png"
+        
+        image.save(file_path)
+
+        logger.debug("✅ 图片已保存至: %s", file_path)
+        return str(file_path)
+
+    def generate_illustration(
+        self,
+        prompt: str,
+        negative_prompt: str = "",
+        output_filename: Optional[str] = None,
+        output_dir: Optional[str] = None,
+        seed: int = -1
+    ) -> Optional[str]:
+        """
+        调用本地 SD WebUI 生成图片
+        
+        Args:
+            prompt: 正面提示词
+            negative_prompt: 负面提示词
+            output_filename: 输出文件名（不含路径），None则自动生成
+            output_dir: 输出目录，None则使用初始化时的output_dir
+            seed: 随机种子，-1表示随机
+        
+        Returns:
+            保存的图片文件路径，失败返回None
+        """
+        images = self._txt2img(self._build_payload(prompt, negative_prompt, seed))
+        if not images:
+            return None
+        try:
+            # WebUI 返回的是一个列表，通常我们只取第一张
+            return self._save_image(images[0], output_filename, output_dir)
+        except Exception as e:
+            print(f"❌ 保存图片失败: {e}")
+            return None
+
+    def generate_batch(
+        self,
+        prompt: str,
+        negative_prompt: str,
+        output_filenames: List[str],
+        output_dir: Optional[str] = None,
+        seed: int = -1
+    ) -> List[Optional[str]]:
+        """
+        用同一组提示词一次请求生成多张图片（WebUI 的 batch_size 只支持同一提示词）
+        
+        Args:
+            prompt: 正面提示词
+            negative_prompt: 负面提示词
+            output_filenames: 各张图片的文件名，数量即 batch_size
+            output_dir: 输出目录，None则使用初始化时的output_dir
+            seed: 随机种子，-1表示随机
+        
+        Returns:
+            与 output_filenames 一一对应的文件路径，失败项为None
+        """
+        n = len(output_filenames)
+        images = self._txt2img(self._build_payload(prompt, negative_prompt, seed, batch_size=n)) or []
+        paths: List[Optional[str]] = []
+        for k, filename in enumerate(output_filenames):
+            try:
+                paths.append(self._save_image(images[k], filename, output_dir) if k < len(images) else None)
+            except Exception as e:
+                print(f"❌ 保存图片失败: {e}")
+                paths.append(None)
+        return paths
+
 
 # 为了向后兼容，保留原有函数
 def generate_illustration(prompt, negative_prompt="", output_dir="output"):
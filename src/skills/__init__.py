@@ -449,7 +449,7 @@ def get_skill_specs() -> List[Dict[str, Any]]:
                     "properties": {
                         "session_id": {"type": "string", "description": "Browser session id"},
                         "url": {"type": "string", "description": "URL to open"},
-                        "wait_ms": {"type": "integer", "description": "Wait time after load (ms)"},
+                        "wait_ms": {"type": "integer", "description": "Max wait for network idle after load (ms)"},
                     },
                     "required": ["session_id", "url"],
                 },
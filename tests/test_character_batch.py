@@ -0,0 +1,110 @@
+import json
+import re
+from types import SimpleNamespace
+
+import pytest
+
+from src.api_cost_tracker import APICostTracker
+from src.character_state_machine import CharacterStateMachine
+
+
+class _StubBatchClient:
+    """Batch API 客户端替身：files/batches 按给定状态序列与输出文件应答，同步请求按片段文本应答"""
+
+    def __init__(self, statuses=("completed",), output_lines=()):
+        self.uploaded = None
+        self.retrieves = 0
+        self.sync_requests = []
+        self._statuses = list(statuses)
+        self._output = "\n".join(json.dumps(line, ensure_ascii=False) for line in output_lines)
+        self.files = SimpleNamespace(create=self._upload, content=self._content)
+        self.batches = SimpleNamespace(create=self._create_batch, retrieve=self._retrieve)
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._sync))
+
+    def _upload(self, file, purpose):
+        self.uploaded = file.read()
+        return SimpleNamespace(id="file-in")
+
+    def _create_batch(self, input_file_id, endpoint, completion_window):
+        return SimpleNamespace(id="batch-1")
+
+    def _retrieve(self, batch_id):
+        status = self._statuses[min(self.retrieves, len(self._statuses) - 1)]
+        self.retrieves += 1
+        return SimpleNamespace(status=status, output_file_id="file-out" if status == "completed" else None)
+
+    def _content(self, file_id):
+        return SimpleNamespace(text=self._output)
+
+    def _sync(self, messages, **kwargs):
+        text = re.search(r"小说片段：\n(.+)", messages[-1]["content"]).group(1)
+        self.sync_requests.append(text)
+        content = json.dumps({"characters": [{"name": text}]}, ensure_ascii=False)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=content))], usage=None)
+
+
+def _output_line(custom_id, name, status_code=200, tokens=(1000, 1000)):
+    body = {
+        "choices": [{"message": {"content": json.dumps({"characters": [{"name": name}]}, ensure_ascii=False)}}],
+        "usage": {"prompt_tokens": tokens[0], "completion_tokens": tokens[1]},
+    }
+    return {"custom_id": custom_id, "response": {"status_code": status_code, "body": body}}
+
+
+def _machine(client):
+    csm = CharacterStateMachine(api_key="test", model="qwen-plus")
+    csm.client = client
+    return csm
+
+
+def test_submit_batch_writes_one_request_per_fragment_in_order(tmp_path):
+    client = _StubBatchClient()
+    csm = _machine(client)
+    path = tmp_path / "batch.jsonl"
+    assert csm.submit_batch(["甲在此", "乙在此", "丙在此"], str(path)) == "batch-1"
+
+    requests = [json.loads(line) for line in path.read_text(encoding="utf-8").splitlines()]
+    assert [r["custom_id"] for r in requests] == ["frag_0", "frag_1", "frag_2"]
+    for request, text in zip(requests, ["甲在此", "乙在此", "丙在此"]):
+        assert request["url"] == "/v1/chat/completions"
+        assert request["body"]["model"] == "qwen-plus"
+        assert text in request["body"]["messages"][-1]["content"]
+    assert client.uploaded == path.read_bytes()
+
+
+def test_poll_and_apply_merges_in_fragment_order():
+    # 输出文件顺序与提交顺序不同；frag_1 返回非 200，改为同步提取
+    client = _StubBatchClient(
+        statuses=("validating", "in_progress", "completed"),
+        output_lines=[_output_line("frag_2", "丙"), _output_line("frag_1", "乙", status_code=500),
+                      _output_line("frag_0", "甲")],
+    )
+    csm = _machine(client)
+    tracker = APICostTracker(model="qwen-plus")
+    mentioned = csm.poll_and_apply("batch-1", ["甲", "乙", "丙"], poll_interval=0, cost_tracker=tracker)
+
+    assert client.retrieves == 3
+    assert client.sync_requests == ["乙"]
+    assert mentioned == [["char_0001"], ["char_0002"], ["char_0003"]]
+    assert [csm.characters[ids[0]]["names"][0] for ids in mentioned] == ["甲", "乙", "丙"]
+    assert [csm.characters[ids[0]]["first_appearance"] for ids in mentioned] == [0, 1, 2]
+
+    # 批任务用量单独记账，按 Batch 折扣价
+    step = tracker.get_step_cost("character_state_batch")
+    assert step.calls == 2
+    assert step.cost_cny == pytest.approx(tracker.tokens_to_cny(2000, 2000) * 0.5)
+
+
+@pytest.mark.parametrize("status", ["failed", "expired", "cancelled"])
+def test_poll_and_apply_raises_on_terminal_failure(status):
+    csm = _machine(_StubBatchClient(statuses=("in_progress", status)))
+    with pytest.raises(RuntimeError, match=status):
+        csm.poll_and_apply("batch-1", ["甲"], poll_interval=0)
+
+
+def test_poll_and_apply_times_out():
+    client = _StubBatchClient(statuses=("in_progress",))
+    csm = _machine(client)
+    with pytest.raises(TimeoutError):
+        csm.poll_and_apply("batch-1", ["甲"], poll_interval=0.01, timeout_s=0.05)
+    assert client.retrieves >= 2
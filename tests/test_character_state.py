@@ -0,0 +1,101 @@
+import json
+
+import pytest
+
+from src import character_state_machine as csm_module
+from src.character_state_machine import CharacterStateMachine
+
+
+def _populated():
+    csm = CharacterStateMachine(api_key="test")
+    csm.apply_extracted_characters(
+        {"characters": [
+            {"name": "罗索", "aliases": ["小索"], "gender": "男", "age_range": "少年",
+             "appearance": {"hair_color": "黑色"}, "clothing": {"description": "布衣"}},
+            {"name": "独臂大叔", "gender": "男"},
+        ]},
+        "罗索和独臂大叔",
+        fragment_index=3,
+    )
+    return csm
+
+
+def _assert_same_state(loaded, original):
+    assert loaded.to_dict() == original.to_dict()
+    assert loaded.get_character_id("小索") == original.get_character_id("罗索")
+    assert loaded.get_character_id("独臂大叔") == original.get_character_id("独臂大叔")
+
+
+def test_msgpack_round_trip(tmp_path):
+    pytest.importorskip("msgpack")
+    original = _populated()
+    path = tmp_path / "character_state.msgpack"
+    original.save(str(path))
+
+    loaded = CharacterStateMachine(api_key="test")
+    loaded.load(str(path))
+    _assert_same_state(loaded, original)
+
+
+def test_json_round_trip(tmp_path):
+    original = _populated()
+    path = tmp_path / "character_state.json"
+    original.save(str(path))
+    assert json.loads(path.read_text(encoding="utf-8")) == original.to_dict()
+
+    loaded = CharacterStateMachine(api_key="test")
+    loaded.load(str(path))
+    _assert_same_state(loaded, original)
+
+
+def test_legacy_json_migrates_to_msgpack(tmp_path):
+    pytest.importorskip("msgpack")
+    original = _populated()
+    legacy = tmp_path / CharacterStateMachine.LEGACY_STATE_FILE_NAME
+    # 旧版文件由标准库 json 写出
+    legacy.write_text(json.dumps(original.to_dict(), ensure_ascii=False, indent=2), encoding="utf-8")
+
+    migrated = CharacterStateMachine(api_key="test")
+    migrated.load(str(legacy))
+    new_path = tmp_path / "character_state.msgpack"
+    # 加载后未改动，但新格式文件还不存在，仍需写出
+    migrated.save(str(new_path))
+    assert new_path.exists()
+
+    loaded = CharacterStateMachine(api_key="test")
+    loaded.load(str(new_path))
+    _assert_same_state(loaded, original)
+
+
+def test_save_skips_when_unchanged(tmp_path):
+    csm = _populated()
+    path = tmp_path / "character_state.json"
+    csm.save(str(path))
+    path.write_text("{}", encoding="utf-8")
+    csm.save(str(path))
+    assert path.read_text(encoding="utf-8") == "{}"
+
+
+def test_failed_save_keeps_previous_file(tmp_path, monkeypatch):
+    pytest.importorskip("msgpack")
+    csm = _populated()
+    path = tmp_path / "character_state.msgpack"
+    csm.save(str(path))
+    before = path.read_bytes()
+
+    csm.get_or_create_character("新人物")
+
+    def boom(*args, **kwargs):
+        raise RuntimeError("disk full")
+
+    monkeypatch.setattr(csm_module.msgpack, "packb", boom)
+    with pytest.raises(RuntimeError):
+        csm.save(str(path))
+    assert path.read_bytes() == before
+
+    monkeypatch.undo()
+    csm.save(str(path))
+    assert not (tmp_path / "character_state.msgpack.tmp").exists()
+    loaded = CharacterStateMachine(api_key="test")
+    loaded.load(str(path))
+    assert loaded.get_character_id("新人物") is not None
@@ -0,0 +1,26 @@
+from cli import _format_result_for_log, _tool_call_text, parse_novel_path
+
+
+def test_format_small_result_is_single_line():
+    assert _format_result_for_log({"success": True}) == "{'success': True}"
+
+
+def test_format_elides_bulky_fields():
+    s = _format_result_for_log({"success": True, "html": "x" * 10000})
+    assert "<truncated 10000 chars>" in s
+    assert "xxxx" not in s
+
+
+def test_format_truncates_long_text():
+    s = _format_result_for_log("y" * 5000, max_len=100)
+    assert s.startswith("y" * 100)
+    assert s.endswith("... (truncated)")
+
+
+def test_tool_call_text_skips_session_id():
+    assert _tool_call_text("web_search", {"query": "长沙", "session_id": "s"}) == 'web_search("长沙")'
+
+
+def test_parse_novel_path():
+    assert parse_novel_path('run "data/a b.txt"') == "data/a b.txt"
+    assert parse_novel_path("runtime.txt") == "runtime.txt"
@@ -0,0 +1,58 @@
+import random
+
+import pytest
+
+from src import character_state_machine as csm_module
+from src import novel_processor
+from src.character_state_machine import CharacterStateMachine
+
+_ALPHABET = "罗索大叔小明红玉青山剑客师父村长李王张陈林风云天"
+_SENTENCE_ALPHABET = "甲乙丙ab 。。！？\"'『』「」\n"
+
+
+def _random_cast(rng, n_characters=700):
+    csm = CharacterStateMachine(api_key="test")
+    names = ["".join(rng.choices(_ALPHABET, k=rng.randint(2, 4))) for _ in range(n_characters)]
+    for name in names:
+        # 替名从同一批名字里抽，会出现多个人物共用替名、名字互为子串的情况
+        aliases = rng.sample(names, rng.randint(0, 2))
+        csm.apply_extracted_characters({"characters": [{"name": name, "aliases": aliases}]}, name)
+    return csm
+
+
+def _plain_match(csm, text, monkeypatch):
+    with monkeypatch.context() as m:
+        m.setattr(csm_module, "ahocorasick", None)
+        m.setattr(csm_module, "_find_names_kernel", None)
+        return [c["id"] for c in csm.get_characters_in_text(text)]
+
+
+def _random_texts(rng, n=200):
+    return ["".join(rng.choices(_ALPHABET + "，。的了", k=rng.randint(0, 300))) for _ in range(n)]
+
+
+@pytest.mark.skipif(csm_module.ahocorasick is None, reason="pyahocorasick not installed")
+def test_aho_corasick_matches_plain_loop(monkeypatch):
+    rng = random.Random(0)
+    csm = _random_cast(rng)
+    for text in _random_texts(rng):
+        assert csm._match_names(text) == _plain_match(csm, text, monkeypatch)
+
+
+@pytest.mark.skipif(csm_module._find_names_kernel is None, reason="numba not installed")
+def test_numba_matches_plain_loop(monkeypatch):
+    rng = random.Random(1)
+    csm = _random_cast(rng)
+    csm._name_matcher = None
+    for text in _random_texts(rng):
+        assert csm._match_names_numba(text) == _plain_match(csm, text, monkeypatch)
+
+
+@pytest.mark.skipif(novel_processor._sentence_ends_kernel is None, reason="numba not installed")
+def test_sentence_ends_kernel_matches_python():
+    np = novel_processor.np
+    rng = random.Random(2)
+    for _ in range(300):
+        paragraph = "".join(rng.choices(_SENTENCE_ALPHABET, k=rng.randint(0, 400)))
+        codes = np.frombuffer(paragraph.encode("utf-32-le"), dtype=np.uint32)
+        assert novel_processor._sentence_ends_kernel(codes).tolist() == novel_processor._sentence_ends(paragraph)
@@ -0,0 +1,248 @@
+import json
+import re
+import subprocess
+from types import SimpleNamespace
+
+import pytest
+
+from main import NovelIllustrationAgent
+from src import android_tool
+from src.character_state_machine import CharacterStateMachine
+from src.fragment_filter import FragmentFilter
+from src.llm_cache import LLMCache
+from src.prompt_generator import PromptGenerator
+
+_FRAG_RE = re.compile(r"### FRAG \d+ ###\n(.+)")
+
+
+class _StubClient:
+    """OpenAI 兼容客户端替身：记录每次请求的 user 内容，由 responder 根据内容返回 JSON"""
+
+    def __init__(self, responder):
+        self.requests = []
+        self._responder = responder
+        self.chat = SimpleNamespace(completions=SimpleNamespace(create=self._create))
+
+    def _create(self, messages, **kwargs):
+        content = messages[-1]["content"]
+        self.requests.append(content)
+        text = json.dumps(self._responder(content), ensure_ascii=False)
+        return SimpleNamespace(choices=[SimpleNamespace(message=SimpleNamespace(content=text))], usage=None)
+
+
+def _batch_sizes(client):
+    return [len(_FRAG_RE.findall(c)) for c in client.requests]
+
+
+# ---------- 人物提取 ----------
+
+def _character_responder(drop_one=False):
+    def respond(content):
+        texts = _FRAG_RE.findall(content)
+        if not texts:
+            return {"characters": [{"name": re.search(r"小说片段：\n(.+)", content).group(1)}]}
+        if drop_one:
+            texts = texts[:-1]
+        return {"fragments": [{"frag": k, "characters": [{"name": t}]} for k, t in enumerate(texts, 1)]}
+    return respond
+
+
+def _names(results):
+    return [r["characters"][0]["name"] for r in results]
+
+
+def test_extract_marshaled_one_request_in_order():
+    csm = CharacterStateMachine(api_key="test")
+    csm.client = _StubClient(_character_responder())
+    assert _names(csm.extract_characters_marshaled(["甲", "乙", "丙"])) == ["甲", "乙", "丙"]
+    assert _batch_sizes(csm.client) == [3]
+
+
+def test_extract_marshaled_wrong_count_falls_back_per_fragment():
+    csm = CharacterStateMachine(api_key="test")
+    csm.client = _StubClient(_character_responder(drop_one=True))
+    assert _names(csm.extract_characters_marshaled(["甲", "乙", "丙"])) == ["甲", "乙", "丙"]
+    assert _batch_sizes(csm.client) == [3, 0, 0, 0]
+
+
+def test_extract_marshaled_sends_only_uncached_unique_fragments(tmp_path):
+    csm = CharacterStateMachine(api_key="test")
+    csm.client = _StubClient(_character_responder())
+    csm.cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    csm.extract_characters("甲")
+
+    results = csm.extract_characters_marshaled(["甲", "乙", "丙", "乙"])
+    assert _names(results) == ["甲", "乙", "丙", "乙"]
+    assert _batch_sizes(csm.client) == [0, 2]
+    assert _FRAG_RE.findall(csm.client.requests[-1]) == ["乙", "丙"]
+
+    # 全部命中时不再请求
+    csm.extract_characters_marshaled(["乙", "丙"])
+    assert len(csm.client.requests) == 2
+    csm.cache.close()
+
+
+# ---------- 片段筛选 ----------
+
+def _filter_responder(drop_one=False):
+    def item(text):
+        return {"selected": True, "score": float(len(text)), "reason": text, "visual_description": text}
+
+    def respond(content):
+        texts = _FRAG_RE.findall(content)
+        if not texts:
+            return item(re.search(r"小说片段：\n(.+)", content).group(1))
+        if drop_one:
+            texts = texts[:-1]
+        return {"results": [dict(item(t), frag=k) for k, t in enumerate(texts, 1)]}
+    return respond
+
+
+def _fragments(*texts):
+    return [{"index": k, "text": t} for k, t in enumerate(texts)]
+
+
+def test_filter_marshaled_one_request_in_order():
+    ff = FragmentFilter(api_key="test")
+    ff.client = _StubClient(_filter_responder())
+    results = ff.filter_marshaled(_fragments("甲", "乙乙", "丙丙丙"))
+    assert [r.reason for r in results] == ["甲", "乙乙", "丙丙丙"]
+    assert [r.score for r in results] == [1.0, 2.0, 3.0]
+    assert _batch_sizes(ff.client) == [3]
+
+
+def test_filter_marshaled_wrong_count_falls_back_per_fragment():
+    ff = FragmentFilter(api_key="test")
+    ff.client = _StubClient(_filter_responder(drop_one=True))
+    results = ff.filter_marshaled(_fragments("甲", "乙", "丙"))
+    assert [r.reason for r in results] == ["甲", "乙", "丙"]
+    assert _batch_sizes(ff.client) == [3, 0, 0, 0]
+
+
+def test_filter_chunk_mixes_cache_hits_and_pending(tmp_path):
+    ff = FragmentFilter(api_key="test")
+    ff.client = _StubClient(_filter_responder())
+    ff.cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    ff._filter_chunk(_fragments("乙"), batch_size=1)
+
+    results = ff._filter_chunk(_fragments("甲", "乙", "丙"), batch_size=3)
+    assert [r.reason for r in results] == ["甲", "乙", "丙"]
+    assert _FRAG_RE.findall(ff.client.requests[-1]) == ["甲", "丙"]
+    ff.cache.close()
+
+
+# ---------- 提示词生成 ----------
+
+_VISUAL_RE = re.compile(r"视觉描述：\n(.+)")
+
+
+def _prompt_responder(drop_one=False, bad=()):
+    def item(desc):
+        return {"positive_prompt": None if desc in bad else desc, "negative_prompt": ""}
+
+    def respond(content):
+        descs = re.findall(r"### FRAG \d+ ###\n视觉描述：\n(.+)", content)
+        if not descs:
+            return item(_VISUAL_RE.search(content).group(1))
+        if drop_one:
+            descs = descs[:-1]
+        return {"results": [dict(item(d), frag=k) for k, d in enumerate(descs, 1)]}
+    return respond
+
+
+def _positive(results):
+    return [r["positive_prompt"].replace(PromptGenerator.BASE_POSITIVE, "", 1) for r in results]
+
+
+def test_generate_marshaled_wrong_count_falls_back_per_fragment():
+    pg = PromptGenerator(api_key="test")
+    pg.client = _StubClient(_prompt_responder(drop_one=True))
+    assert _positive(pg.generate_marshaled(_fragments("甲", "乙", "丙"))) == ["甲", "乙", "丙"]
+    assert len(pg.client.requests) == 4
+
+
+def test_generate_marshaled_mixes_cache_hits_and_pending(tmp_path):
+    pg = PromptGenerator(api_key="test")
+    pg.client = _StubClient(_prompt_responder())
+    pg.cache = LLMCache(str(tmp_path / "cache.sqlite"))
+    pg.generate(_fragments("乙")[0])
+
+    assert _positive(pg.generate_marshaled(_fragments("甲", "乙", "丙"))) == ["甲", "乙", "丙"]
+    assert re.findall(r"### FRAG \d+ ###\n视觉描述：\n(.+)", pg.client.requests[-1]) == ["甲", "丙"]
+    pg.cache.close()
+
+
+def test_generate_does_not_cache_invalid_results(tmp_path):
+    pg = PromptGenerator(api_key="test")
+    pg.client = _StubClient(_prompt_responder(bad=("甲",)))
+    pg.cache = LLMCache(str(tmp_path / "cache.sqlite"))
+
+    # 格式不合格的单项按规则生成，且不写入缓存
+    results = pg.generate_marshaled(_fragments("甲", "乙"))
+    assert _positive(results)[1] == "乙"
+    assert pg.cache.get(pg._cache_key("甲", "甲", None)) is None
+
+    # 缓存中已有的坏条目视为未命中
+    pg.cache.set(pg._cache_key("乙", "乙", None), {"positive_prompt": None})
+    pg.client = _StubClient(_prompt_responder())
+    assert _positive([pg.generate(_fragments("乙")[0])]) == ["乙"]
+    assert len(pg.client.requests) == 1
+    pg.cache.close()
+
+
+# ---------- 全书去重 ----------
+
+def test_dedupe_fragments_across_chapters():
+    agent = SimpleNamespace(_seen_fragments={})
+    chapter1 = _fragments("甲", "乙", "甲")
+    unique, duplicates = NovelIllustrationAgent._dedupe_fragments(agent, chapter1)
+    assert unique == [chapter1[0], chapter1[1]]
+    assert duplicates == [(chapter1[2], chapter1[0])]
+
+    chapter2 = _fragments("乙", "丙")
+    unique, duplicates = NovelIllustrationAgent._dedupe_fragments(agent, chapter2)
+    assert unique == [chapter2[1]]
+    assert duplicates == [(chapter2[0], chapter1[1])]
+
+
+# ---------- android batch ----------
+
+_OPS = [{"op": "tap", "x": 1, "y": 2}, {"op": "key", "code": "back"}, {"op": "text", "s": "hi"}]
+
+
+@pytest.fixture
+def adb_session(monkeypatch):
+    replayed = []
+    monkeypatch.setitem(android_tool._SESSIONS, "s", {"device_id": "d", "driver": None})
+    monkeypatch.setattr(android_tool, "_run_single_op",
+                        lambda sid, op: replayed.append(op) or {"success": True})
+    return replayed
+
+
+def _shell_result(rc, stdout=""):
+    return lambda sess, argv, timeout_s=20: subprocess.CompletedProcess(["shell"], rc, stdout=stdout, stderr="")
+
+
+def test_batch_success_runs_once(adb_session, monkeypatch):
+    monkeypatch.setattr(android_tool, "_run_adb_shell", _shell_result(0))
+    res = android_tool.batch("s", _OPS)
+    assert res["success"] and res["method"] == "adb_shell_batch"
+    assert adb_session == []
+
+
+def test_batch_falls_back_from_failed_op(adb_session, monkeypatch):
+    # 第 2 个 op（下标 1）开始后失败：只重试它和之后的 op
+    monkeypatch.setattr(android_tool, "_run_adb_shell", _shell_result(1, "__OP__0\n__OP__1\nerror\n"))
+    res = android_tool.batch("s", _OPS)
+    assert res["method"] == "per_op_fallback" and res["fallback_from"] == 1
+    assert adb_session == _OPS[1:]
+
+
+def test_batch_does_not_replay_after_shell_exception(adb_session, monkeypatch):
+    def boom(sess, argv, timeout_s=20):
+        raise TimeoutError("shell timed out")
+
+    monkeypatch.setattr(android_tool, "_run_adb_shell", boom)
+    res = android_tool.batch("s", _OPS)
+    assert not res["success"] and res["error"] == "batch_failed"
+    assert adb_session == []